@@ -26,8 +26,15 @@ Chernozhukov et al. (2017). Double/debiased machine learning for treatment and s
 
 import numpy as np
 import copy
+import hashlib
+import os
+import pickle
+import types
+import scipy.sparse
+from functools import reduce
+from joblib import Parallel, delayed, effective_n_jobs
 from warnings import warn
-from .utilities import (shape, reshape, ndim, hstack, cross_product, transpose,
+from .utilities import (shape, reshape, ndim, hstack, cross_product, transpose, _shared_memmaps, _memmapping_parallel,
                         broadcast_unit_treatments, reshape_treatmentwise_effects,
                         StatsModelsLinearRegression, LassoCVWrapper)
 from sklearn.model_selection import KFold, StratifiedKFold, check_cv
@@ -37,12 +44,17 @@ from sklearn.preprocessing import (PolynomialFeatures, LabelEncoder, OneHotEncod
 from sklearn.base import clone, TransformerMixin
 from sklearn.pipeline import Pipeline
 from sklearn.utils import check_random_state
+from sklearn.exceptions import NotFittedError
+try:
+    import cloudpickle
+except ImportError:
+    from joblib.externals import cloudpickle
 from .cate_estimator import (BaseCateEstimator, LinearCateEstimator,
                              TreatmentExpansionMixin, StatsModelsCateEstimatorMixin)
 from .inference import StatsModelsInference
 
 
-def _crossfit(model, folds, *args, **kwargs):
+def _crossfit(model, folds, *args, n_jobs=None, backend='loky', **kwargs):
     """
     General crossfit based calculation of nuisance parameters.
 
@@ -70,6 +82,13 @@ def _crossfit(model, folds, *args, **kwargs):
         `model.predict(*args, **kwargs)`. Key-value arguments that have value
         None, are ommitted from the two calls. So all the args and the non None
         kwargs variables must be part of the models signature.
+    n_jobs : int or None, optional (default=None)
+        The number of folds that are fitted concurrently. ``None`` means 1 unless in a
+        :obj:`joblib.parallel_backend` context and ``-1`` means using all processors.
+    backend : string, optional (default='loky')
+        The joblib backend used to fit the folds when `n_jobs` is not 1. With a process based
+        backend the data is dumped once to read-only memory maps that all the workers share,
+        rather than being pickled for every fold.
 
     Returns
     -------
@@ -117,44 +136,165 @@ def _crossfit(model, folds, *args, **kwargs):
     array([   0,    1,    2, ..., 4997, 4998, 4999])
 
     """
-    model_list = []
-    fitted_inds = []
-    for idx, (train_idxs, test_idxs) in enumerate(folds):
-        model_list.append(clone(model, safe=False))
-        if len(np.intersect1d(train_idxs, test_idxs)) > 0:
-            raise AttributeError("Invalid crossfitting fold structure." +
-                                 "Train and test indices of each fold must be disjoint.")
-        if len(np.intersect1d(fitted_inds, test_idxs)) > 0:
-            raise AttributeError("Invalid crossfitting fold structure. The same index appears in two test folds.")
-        fitted_inds = np.concatenate((fitted_inds, test_idxs))
+    return _repeated_crossfit(model, [folds], *args, n_jobs=n_jobs, backend=backend, **kwargs)[0]
 
-        args_train = ()
-        args_test = ()
-        for var in args:
-            args_train += (var[train_idxs],) if var is not None else (None,)
-            args_test += (var[test_idxs],) if var is not None else (None,)
 
-        kwargs_train = {}
-        kwargs_test = {}
-        for key, var in kwargs.items():
-            if var is not None:
-                kwargs_train[key] = var[train_idxs]
-                kwargs_test[key] = var[test_idxs]
+def _repeated_crossfit(model, fold_repeats, *args, n_jobs=None, backend='loky', **kwargs):
+    """
+    Crossfit based calculation of nuisance parameters for several crossfitting fold structures at once.
 
-        model_list[idx].fit(*args_train, **kwargs_train)
+    The folds of all the repetitions are fitted in a single parallel batch, which shares the (memory
+    mapped) data, so `n_jobs` can be as large as the total number of folds.
 
-        nuisance_temp = model_list[idx].predict(*args_test, **kwargs_test)
+    Parameters
+    ----------
+    model : object
+        The nuisance model, as in `_crossfit`.
+    fold_repeats : list of lists of tuples
+        A crossfitting fold structure, as in `_crossfit`, for every repetition.
+    args, n_jobs, backend, kwargs
+        As in `_crossfit`.
 
-        if not isinstance(nuisance_temp, tuple):
-            nuisance_temp = (nuisance_temp,)
+    Returns
+    -------
+    results : list of tuples
+        The `(nuisances, model_list, fitted_inds)` output of `_crossfit` for every repetition.
+    """
+    fold_repeats = [list(folds) for folds in fold_repeats]
+    fitted_inds_repeats = []
+    for folds in fold_repeats:
+        fitted_inds = []
+        for train_idxs, test_idxs in folds:
+            if len(np.intersect1d(train_idxs, test_idxs)) > 0:
+                raise AttributeError("Invalid crossfitting fold structure." +
+                                     "Train and test indices of each fold must be disjoint.")
+            if len(np.intersect1d(fitted_inds, test_idxs)) > 0:
+                raise AttributeError("Invalid crossfitting fold structure. "
+                                     "The same index appears in two test folds.")
+            fitted_inds = np.concatenate((fitted_inds, test_idxs))
+        fitted_inds_repeats.append(fitted_inds)
+    all_folds = [fold for folds in fold_repeats for fold in folds]
+
+    if effective_n_jobs(n_jobs) == 1:
+        results = [_fit_fold(clone(model, safe=False), train_idxs, test_idxs, args, kwargs)
+                   for train_idxs, test_idxs in all_folds]
+    elif backend == 'threading':
+        results = Parallel(n_jobs=n_jobs, backend=backend)(
+            delayed(_fit_fold)(clone(model, safe=False), train_idxs, test_idxs, args, kwargs)
+            for train_idxs, test_idxs in all_folds)
+    else:
+        # Memory map the data once for all the folds, so that only file names are sent to the workers
+        with _shared_memmaps(*args, *kwargs.values()) as shared:
+            shared_args = tuple(shared[:len(args)])
+            shared_kwargs = dict(zip(kwargs.keys(), shared[len(args):]))
+            results = _memmapping_parallel(n_jobs=n_jobs, backend=backend)(
+                delayed(_fit_fold)(clone(model, safe=False), train_idxs, test_idxs, shared_args, shared_kwargs)
+                for train_idxs, test_idxs in all_folds)
+
+    # Results are returned in the order of the folds, so the scatter below does not depend on which
+    # fold finished first and, as in the serial case, the last fold that tests an index wins
+    output = []
+    start = 0
+    for folds, fitted_inds in zip(fold_repeats, fitted_inds_repeats):
+        model_list = []
+        for idx, ((train_idxs, test_idxs), (fitted_model, nuisance_temp)) in enumerate(zip(folds, results[start:])):
+            model_list.append(fitted_model)
 
-        if idx == 0:
-            nuisances = tuple([np.full((args[0].shape[0],) + nuis.shape[1:], np.nan) for nuis in nuisance_temp])
+            if idx == 0:
+                nuisances = tuple([np.full((args[0].shape[0],) + nuis.shape[1:], np.nan)
+                                   for nuis in nuisance_temp])
 
-        for it, nuis in enumerate(nuisance_temp):
-            nuisances[it][test_idxs] = nuis
+            for it, nuis in enumerate(nuisance_temp):
+                nuisances[it][test_idxs] = nuis
+        start += len(folds)
+        output.append((nuisances, model_list, np.sort(fitted_inds.astype(int))))
+
+    return output
+
+
+def _fit_fold(model, train_idxs, test_idxs, args, kwargs):
+    # Fits the (already cloned) model on the training part of a fold and predicts on its test part.
+    # The full, possibly memory mapped, data is passed in and only the fold is materialized here.
+    args_train = ()
+    args_test = ()
+    for var in args:
+        args_train += (var[train_idxs],) if var is not None else (None,)
+        args_test += (var[test_idxs],) if var is not None else (None,)
+
+    kwargs_train = {}
+    kwargs_test = {}
+    for key, var in kwargs.items():
+        if var is not None:
+            kwargs_train[key] = var[train_idxs]
+            kwargs_test[key] = var[test_idxs]
+
+    model.fit(*args_train, **kwargs_train)
+
+    nuisance_temp = model.predict(*args_test, **kwargs_test)
+
+    if not isinstance(nuisance_temp, tuple):
+        nuisance_temp = (nuisance_temp,)
+
+    return model, nuisance_temp
+
+
+def _fingerprint(*objs):
+    # Deterministic digest of the data and of the unfitted nuisance model, used as the key of the nuisance cache.
+    # Arrays are hashed by content, estimators by their class and parameters and any other object by its class,
+    # attributes and the closures of its methods, so that the wrappers that the estimators define in their
+    # constructors are identified by the settings they capture (e.g. `linear_first_stages` in DML).
+    digest = hashlib.sha1()
+    # the visited objects are kept alive, so that the ids of temporaries are not reused within one digest
+    seen = {}
+
+    def update(obj):
+        if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+            digest.update(repr((type(obj).__name__, obj)).encode())
+            return
+        if id(obj) in seen:
+            digest.update(b'<cycle>')
+            return
+        seen[id(obj)] = obj
+        if isinstance(obj, np.ndarray):
+            digest.update(repr(('ndarray', obj.dtype.str, obj.shape)).encode())
+            if obj.dtype == object:
+                update(obj.ravel().tolist())
+            else:
+                digest.update(np.ascontiguousarray(obj).tobytes())
+        elif scipy.sparse.issparse(obj):
+            obj = obj.tocsr()
+            digest.update(repr(('sparse', obj.shape)).encode())
+            update((obj.data, obj.indices, obj.indptr))
+        elif isinstance(obj, (list, tuple)):
+            digest.update(repr((type(obj).__name__, len(obj))).encode())
+            for item in obj:
+                update(item)
+        elif isinstance(obj, dict):
+            digest.update(repr(('dict', len(obj))).encode())
+            for key in sorted(obj, key=repr):
+                update(key)
+                update(obj[key])
+        elif isinstance(obj, np.random.RandomState):
+            update(obj.get_state())
+        elif isinstance(obj, type):
+            digest.update(repr(('type', obj.__module__, obj.__qualname__)).encode())
+            if '<locals>' in obj.__qualname__:
+                update([value for _, value in sorted(vars(obj).items()) if isinstance(value, types.FunctionType)])
+        elif isinstance(obj, types.FunctionType):
+            digest.update(repr(('function', obj.__module__, obj.__qualname__)).encode())
+            digest.update(obj.__code__.co_code)
+            update([cell.cell_contents for cell in obj.__closure__ or ()])
+        elif hasattr(obj, 'get_params'):
+            update(type(obj))
+            update(obj.get_params(deep=False))
+        elif hasattr(obj, '__dict__'):
+            update(type(obj))
+            update(vars(obj))
+        else:
+            digest.update(repr(obj).encode())
 
-    return nuisances, model_list, np.sort(fitted_inds.astype(int))
+    update(objs)
+    return digest.hexdigest()
 
 
 class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
@@ -267,6 +407,30 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
         If None, the random number generator is the :class:`~numpy.random.mtrand.RandomState` instance used
         by `np.random`.
 
+    n_jobs: int or None, optional (default=None)
+        The number of crossfitting folds whose nuisance models are fitted concurrently. ``None`` means 1
+        unless in a :obj:`joblib.parallel_backend` context and ``-1`` means using all processors.
+
+    backend: string, optional (default='loky')
+        The joblib backend used to fit the folds concurrently. With a process based backend (e.g. ``'loky'``)
+        the data is shared with the workers through read-only memory maps, rather than pickled for every fold;
+        ``'threading'`` is preferable for nuisance models that release the GIL.
+
+    nuisance_cache: string or None, optional (default=None)
+        A directory in which the cross-fitted nuisances, the fitted nuisance models and the indices they were
+        computed on are stored. The entries are keyed by a fingerprint of the data, of the crossfitting folds
+        and of the parameters of the nuisance model, so that later calls to `fit` with the same first stage
+        inputs, in this or in any other process, only fit the final model.
+
+    n_crossfit_repeats: int, optional (default=1)
+        The number of independent draws of the crossfitting folds. The nuisances of every draw are calculated
+        (all the folds of all the draws are fitted in one parallel batch) and aggregated before the final model
+        is fit, which makes the estimate less dependent on a single random split. Only useful if the splits
+        are random, i.e. unless an iterable of folds is passed as `n_splits`.
+
+    crossfit_aggregation: 'mean' or 'median', optional (default='mean')
+        How the nuisances of the repeated crossfitting draws are aggregated for every sample.
+
     Examples
     --------
 
@@ -384,21 +548,50 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
     ----------
     models_nuisance: list of objects of type(model_nuisance)
         A list of instances of the model_nuisance object. Each element corresponds to a crossfitting
-        fold and is the model instance that was fitted for that training fold.
+        fold and is the model instance that was fitted for that training fold. With repeated crossfitting
+        the folds of all the draws are listed one draw after the other.
     model_final: object of type(model_final)
         An instance of the model_final object that was fitted after calling fit.
     score_ : float or array of floats
         If the model_final has a score method, then `score_` contains the outcome of the final model
         score when evaluated on the fitted nuisances from the first stage. Represents goodness of fit,
         of the final CATE model.
+    nuisances_: tuple of arrays
+        The cross-fitted nuisance values of the last call to fit, which `refit_final` reuses.
+    fitted_inds_: array of int
+        The indices of the samples for which the nuisances were calculated (in every crossfitting draw).
+    nuisances_std_: tuple of arrays or None
+        The standard deviation of each nuisance value across the repeated crossfitting draws, a diagnostic
+        of the sensitivity of the estimate to the random split. None if `n_crossfit_repeats` is 1.
     """
 
+    # The per sample results and the inputs of the last fit, kept so that `refit_final` can reuse the
+    # nuisances; the inputs are references to the caller's data, and none of these are pickled or copied
+    # along with the estimator
+    _FIT_CACHE = ('_fit_data', '_nuisances', '_fitted_inds', '_nuisances_std')
+
     def __init__(self, model_nuisance, model_final,
-                 discrete_treatment, n_splits, random_state):
+                 discrete_treatment, n_splits, random_state, n_jobs=None, backend='loky', nuisance_cache=None,
+                 n_crossfit_repeats=1, crossfit_aggregation='mean'):
+        if n_crossfit_repeats < 1:
+            raise ValueError("The number of crossfitting repeats must be at least 1, "
+                             "got {}".format(n_crossfit_repeats))
+        if crossfit_aggregation not in ('mean', 'median'):
+            raise ValueError("crossfit_aggregation must be 'mean' or 'median', "
+                             "got {}".format(crossfit_aggregation))
         self._model_nuisance = clone(model_nuisance, safe=False)
         self._models_nuisance = None
         self._model_final = clone(model_final, safe=False)
         self._n_splits = n_splits
+        self._n_jobs = n_jobs
+        self._backend = backend
+        self._nuisance_cache = nuisance_cache
+        self._n_crossfit_repeats = n_crossfit_repeats
+        self._crossfit_aggregation = crossfit_aggregation
+        self._fit_data = None
+        self._nuisances = None
+        self._fitted_inds = None
+        self._nuisances_std = None
         self._discrete_treatment = discrete_treatment
         self._random_state = check_random_state(random_state)
         if discrete_treatment:
@@ -406,6 +599,12 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
             self._one_hot_encoder = OneHotEncoder(categories='auto', sparse=False)
         super().__init__()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._FIT_CACHE:
+            state[name] = None
+        return state
+
     def _check_input_dims(self, Y, T, X=None, W=None, Z=None, sample_weight=None, sample_var=None):
         assert shape(Y)[0] == shape(T)[0], "Dimension mis-match!"
         for arr in [X, W, Z, sample_weight, sample_var]:
@@ -459,6 +658,47 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
         """
         self._check_input_dims(Y, T, X, W, Z, sample_weight, sample_var)
         nuisances, fitted_inds = self._fit_nuisances(Y, T, X, W, Z, sample_weight=sample_weight)
+        self._fit_data = (Y, T, X, W, Z, sample_weight, sample_var)
+        self._nuisances = nuisances
+        self._fitted_inds = fitted_inds
+        self._fit_final_on_nuisances()
+        return self
+
+    def refit_final(self, *, inference=None):
+        """
+        Estimate the final model again, reusing the nuisances that were cross-fitted by the last call to `fit`.
+
+        This is useful after changing the parameters of the final model (or of its featurizer), since
+        only the final stage is run.
+
+        Parameters
+        ----------
+        inference: string, `Inference` instance, or None
+            Method for performing inference.  This estimator supports 'bootstrap'
+            (or an instance of `BootstrapInference`). Bootstrap inference refits the first stages on each
+            bootstrap sample.
+
+        Returns
+        -------
+        self : _OrthoLearner instance
+        """
+        if self._nuisances is None:
+            raise NotFittedError("There are no cross-fitted nuisances to reuse; call fit first. "
+                                 "The nuisances are not kept when the estimator is pickled or copied.")
+        Y, T, X, W, Z, sample_weight, sample_var = self._fit_data
+        fit_kwargs = self._filter_none_kwargs(X=X, W=W, Z=Z, sample_weight=sample_weight, sample_var=sample_var)
+        inference = self._get_inference(inference)
+        if inference is not None:
+            inference.prefit(self, Y, T, **fit_kwargs)
+        self._fit_final_on_nuisances()
+        if inference is not None:
+            inference.fit(self, Y, T, **fit_kwargs)
+        self._inference = inference
+        return self
+
+    def _fit_final_on_nuisances(self):
+        Y, T, X, W, Z, sample_weight, sample_var = self._fit_data
+        nuisances, fitted_inds = self._nuisances, self._fitted_inds
         self._fit_final(self._subinds_check_none(Y, fitted_inds),
                         self._subinds_check_none(T, fitted_inds),
                         X=self._subinds_check_none(X, fitted_inds),
@@ -467,7 +707,6 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
                         nuisances=tuple([self._subinds_check_none(nuis, fitted_inds) for nuis in nuisances]),
                         sample_weight=self._subinds_check_none(sample_weight, fitted_inds),
                         sample_var=self._subinds_check_none(sample_var, fitted_inds))
-        return self
 
     def _fit_nuisances(self, Y, T, X=None, W=None, Z=None, sample_weight=None):
         # use a binary array to get stratified split in case of discrete treatment
@@ -480,9 +719,10 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
         all_vars = [var if np.ndim(var) == 2 else var.reshape(-1, 1) for var in [Z, W, X] if var is not None]
         if all_vars:
             all_vars = np.hstack(all_vars)
-            folds = splitter.split(all_vars, T)
         else:
-            folds = splitter.split(np.ones((T.shape[0], 1)), T)
+            all_vars = np.ones((T.shape[0], 1))
+        # the stacked variables are reused to draw the folds of every crossfitting repetition
+        fold_repeats = [list(splitter.split(all_vars, T)) for _ in range(self._n_crossfit_repeats)]
 
         if self._discrete_treatment:
             T = self._label_encoder.fit_transform(T)
@@ -495,10 +735,53 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
                           reshape(self._label_encoder.transform(T), (-1, 1)))[:, 1:]),
                 validate=False)
 
-        nuisances, fitted_models, fitted_inds = _crossfit(self._model_nuisance, folds,
-                                                          Y, T, X=X, W=W, Z=Z, sample_weight=sample_weight)
-        self._models_nuisance = fitted_models
-        return nuisances, fitted_inds
+        X, W = self._nuisance_features(X, W, shape(T)[0])
+
+        cache_file = None
+        if self._nuisance_cache is not None:
+            key = _fingerprint(self._model_nuisance, self._discrete_treatment, fold_repeats,
+                               Y, T, X, W, Z, sample_weight)
+            cache_file = os.path.join(self._nuisance_cache, 'nuisances_{}.pkl'.format(key))
+
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                repeats = pickle.load(f)
+        else:
+            repeats = _repeated_crossfit(self._model_nuisance, fold_repeats,
+                                         Y, T, X=X, W=W, Z=Z, sample_weight=sample_weight,
+                                         n_jobs=self._n_jobs, backend=self._backend)
+            if cache_file is not None:
+                # the nuisance models are usually instances of classes defined inside the estimators'
+                # constructors, which only cloudpickle can serialize; write to a temporary file and rename
+                # it so that concurrent fits never read a partially written entry
+                os.makedirs(self._nuisance_cache, exist_ok=True)
+                temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+                with open(temp_file, 'wb') as f:
+                    cloudpickle.dump(repeats, f)
+                os.replace(temp_file, cache_file)
+        self._models_nuisance = [mdl for _, fitted_models, _ in repeats for mdl in fitted_models]
+
+        if len(repeats) == 1:
+            nuisances, _, fitted_inds = repeats[0]
+            self._nuisances_std = None
+            return nuisances, fitted_inds
+        # only the samples for which every repetition calculated the nuisances are used by the final model
+        fitted_inds = reduce(np.intersect1d, [fitted_inds for _, _, fitted_inds in repeats])
+        aggregate = np.mean if self._crossfit_aggregation == 'mean' else np.median
+        nuisances = []
+        nuisances_std = []
+        for nuisance_repeats in zip(*[repeat_nuisances for repeat_nuisances, _, _ in repeats]):
+            nuisance_repeats = np.stack(nuisance_repeats)
+            nuisances.append(aggregate(nuisance_repeats, axis=0))
+            nuisances_std.append(np.std(nuisance_repeats, axis=0))
+        self._nuisances_std = tuple(nuisances_std)
+        return tuple(nuisances), fitted_inds
+
+    def _nuisance_features(self, X, W, n_samples, fitting=True):
+        # The features and controls that are passed to the nuisance model, both when crossfitting and when
+        # scoring. Subclasses can override this to transform them once for all the folds (and for all the
+        # models of a nuisance), rather than in every fold; the result must be sliceable by rows.
+        return X, W
 
     def _fit_final(self, Y, T, X=None, W=None, Z=None, nuisances=None, sample_weight=None, sample_var=None):
         self._model_final.fit(Y, T, **self._filter_none_kwargs(X=X, W=W, Z=Z,
@@ -561,9 +844,10 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
         if not hasattr(self._model_final, 'score'):
             raise AttributeError("Final model does not have a score method!")
         X, T = self._expand_treatments(X, T)
+        X_nuisance, W_nuisance = self._nuisance_features(X, W, shape(T)[0], fitting=False)
         n_splits = len(self._models_nuisance)
         for idx, mdl in enumerate(self._models_nuisance):
-            nuisance_temp = mdl.predict(Y, T, **self._filter_none_kwargs(X=X, W=W, Z=Z))
+            nuisance_temp = mdl.predict(Y, T, **self._filter_none_kwargs(X=X_nuisance, W=W_nuisance, Z=Z))
             if not isinstance(nuisance_temp, tuple):
                 nuisance_temp = (nuisance_temp,)
 
@@ -585,3 +869,15 @@ class _OrthoLearner(TreatmentExpansionMixin, LinearCateEstimator):
     @property
     def models_nuisance(self):
         return self._models_nuisance
+
+    @property
+    def nuisances_(self):
+        return self._nuisances
+
+    @property
+    def fitted_inds_(self):
+        return self._fitted_inds
+
+    @property
+    def nuisances_std_(self):
+        return self._nuisances_std
@@ -100,6 +100,24 @@ class _RLearner(_OrthoLearner):
         If None, the random number generator is the :class:`~numpy.random.mtrand.RandomState` instance used
         by `np.random`.
 
+    n_jobs: int or None, optional (default=None)
+        The number of crossfitting folds whose first stage models are fitted concurrently. ``None`` means 1
+        unless in a :obj:`joblib.parallel_backend` context and ``-1`` means using all processors.
+
+    backend: string, optional (default='loky')
+        The joblib backend used to fit the folds concurrently, see :class:`~econml._ortho_learner._OrthoLearner`.
+
+    nuisance_cache: string or None, optional (default=None)
+        A directory in which the cross-fitted residuals are cached across fits and processes,
+        see :class:`~econml._ortho_learner._OrthoLearner`.
+
+    n_crossfit_repeats: int, optional (default=1)
+        The number of independent draws of the crossfitting folds, whose residuals are aggregated
+        before the final model is fit.
+
+    crossfit_aggregation: 'mean' or 'median', optional (default='mean')
+        How the residuals of the repeated crossfitting draws are aggregated for every sample.
+
     Examples
     --------
     The example code below implements a very simple version of the double machine learning
@@ -181,7 +199,8 @@ class _RLearner(_OrthoLearner):
     """
 
     def __init__(self, model_y, model_t, model_final,
-                 discrete_treatment, n_splits, random_state):
+                 discrete_treatment, n_splits, random_state, n_jobs=None, backend='loky', nuisance_cache=None,
+                 n_crossfit_repeats=1, crossfit_aggregation='mean'):
         class ModelNuisance:
             """
             Nuisance model fits the model_y and model_t at fit time and at predict time
@@ -246,7 +265,9 @@ class _RLearner(_OrthoLearner):
                     return np.mean((Y_res - Y_res_pred)**2)
 
         super().__init__(ModelNuisance(model_y, model_t),
-                         ModelFinal(model_final), discrete_treatment, n_splits, random_state)
+                         ModelFinal(model_final), discrete_treatment, n_splits, random_state,
+                         n_jobs=n_jobs, backend=backend, nuisance_cache=nuisance_cache,
+                         n_crossfit_repeats=n_crossfit_repeats, crossfit_aggregation=crossfit_aggregation)
 
     def fit(self, Y, T, X=None, W=None, *, sample_weight=None, sample_var=None, inference=None):
         """
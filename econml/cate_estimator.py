@@ -8,6 +8,7 @@ import numpy as np
 from functools import wraps
 from copy import deepcopy
 from warnings import warn
+from joblib import Parallel, delayed
 from .bootstrap import BootstrapEstimator
 from .inference import BootstrapInference
 from .utilities import tensordot, ndim, reshape, shape
@@ -180,6 +181,26 @@ class BaseCateEstimator(metaclass=abc.ABCMeta):
         pass
 
 
+def _row_blocks(X, chunk_size):
+    # Yields the (offset, block) pairs of consecutive row blocks of an array, or of the blocks of an iterable
+    if hasattr(X, 'shape'):
+        for start in range(0, shape(X)[0], chunk_size):
+            yield start, X[start:start + chunk_size]
+    else:
+        start = 0
+        for block in X:
+            yield start, block
+            start += shape(block)[0]
+
+
+def _predict_block(estimator, method, out, start, X, kwargs):
+    # Evaluates one block of rows and writes the result in place, so that nothing is returned to the caller
+    rows = slice(start, start + shape(X)[0])
+    block_kwargs = {key: value[rows] if ndim(value) > 0 else value for key, value in kwargs.items()}
+    out[rows] = getattr(estimator, method)(X=X, **block_kwargs)
+    return shape(X)[0]
+
+
 class LinearCateEstimator(BaseCateEstimator):
     """Base class for all CATE estimators with linear treatment effects in this package."""
 
@@ -284,6 +305,55 @@ class LinearCateEstimator(BaseCateEstimator):
     def const_marginal_effect_interval(self, X=None, *, alpha=0.1):
         pass
 
+    def chunked_predict(self, X, out, method='const_marginal_effect', *,
+                        chunk_size=10000, n_jobs=1, backend='threading', **kwargs):
+        """
+        Evaluate `const_marginal_effect`, `effect` or `marginal_effect` block by block, writing into `out`.
+
+        Only one block of rows per job is held in memory at a time, so arbitrarily large inputs
+        stored on disk (e.g. as a `numpy.memmap`) can be scored into a preallocated output memmap.
+
+        Parameters
+        ----------
+        X: (m, d_x) matrix or iterable of (k, d_x) matrices
+            Features for each sample. Either an array (which can be a `numpy.memmap`) that is
+            split into blocks of `chunk_size` rows, or an iterable that yields consecutive blocks of rows.
+        out: array
+            Output array whose first dimension is m and whose remaining dimensions are the
+            dimensions of the output of `method`. Typically a writable `numpy.memmap`.
+        method: string, optional (default='const_marginal_effect')
+            One of 'const_marginal_effect', 'effect' or 'marginal_effect'.
+        chunk_size: int, optional (default=10000)
+            Number of rows in each block when `X` is an array.
+        n_jobs: int or None, optional (default=1)
+            Number of blocks evaluated in parallel.
+        backend: string, optional (default='threading')
+            The joblib backend used when `n_jobs` is not 1. With a process based backend
+            `out` must be a `numpy.memmap` so that the workers can write into it.
+        kwargs: optional
+            Other arguments of `method`, such as `T0` and `T1` for `effect` or `T` for `marginal_effect`.
+            Scalars are passed to every block and arrays with m rows are split like `X`.
+
+        Returns
+        -------
+        out: array
+            The array that was passed in, filled with the output of `method` for each sample.
+        """
+        if method not in ('const_marginal_effect', 'effect', 'marginal_effect'):
+            raise ValueError("method must be one of 'const_marginal_effect', 'effect' or 'marginal_effect', "
+                             "got '{0}'".format(method))
+        if hasattr(X, 'shape') and shape(X)[0] != shape(out)[0]:
+            raise ValueError("The output must have {0} rows, instead got {1}.".format(shape(X)[0], shape(out)[0]))
+        # Parallel consumes the blocks lazily, so at most a few blocks per job are loaded at once
+        n_rows = Parallel(n_jobs=n_jobs, backend=backend)(
+            delayed(_predict_block)(self, method, out, start, block, kwargs)
+            for start, block in _row_blocks(X, chunk_size))
+        if sum(n_rows) != shape(out)[0]:
+            raise ValueError("The output must have {0} rows, instead got {1}.".format(sum(n_rows), shape(out)[0]))
+        if hasattr(out, 'flush'):
+            out.flush()
+        return out
+
 
 class TreatmentExpansionMixin(BaseCateEstimator):
     """Mixin which automatically handles promotions of scalar treatments to the appropriate shape."""
@@ -4,7 +4,8 @@
 """Basic tree utilities and methods.
 
 Class `CausalTree` is the base estimator for the Orthogonal Random Forest, whereas
-class `Node` represents the core unit of the `CausalTree` class.
+class `Node` represents the core unit of the `CausalTree` class. Once grown, a `CausalTree`
+also keeps a flat, array-backed copy of its structure that is used for vectorized traversal.
 """
 
 import numpy as np
@@ -12,6 +13,63 @@ import warnings
 from sklearn.model_selection import train_test_split
 from sklearn.utils import check_random_state
 import scipy.special
+from .utilities import PhaseProfile
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _score_random_splits(X, split_inds, est_inds, rho, dims, thresholds,
+                         lower_bound, upper_bound, lower_bound_est, upper_bound_est):
+    # Scores the proposed splits (dims[j], thresholds[j]) of a node directly on the sample indices
+    # of the node, without materializing the n_samples x n_proposals side matrices. Returns the
+    # max and the mean over the coordinates of the score vector of every split and whether the split is valid.
+    n_split = split_inds.shape[0]
+    d_rho = rho.shape[1]
+    n_proposals = dims.shape[0]
+    rho_sum = np.zeros(d_rho)
+    for i in range(n_split):
+        for k in range(d_rho):
+            rho_sum[k] += rho[i, k]
+    max_scores = np.zeros(n_proposals)
+    mean_scores = np.zeros(n_proposals)
+    valid = np.zeros(n_proposals, dtype=np.bool_)
+    left_diff = np.zeros(d_rho)
+    for j in range(n_proposals):
+        dim = dims[j]
+        thr = thresholds[j]
+        # the side indicators are accumulated without branching, since they are close to random
+        size_est_left = 0
+        for i in range(est_inds.shape[0]):
+            size_est_left += X[est_inds[i], dim] < thr
+        if size_est_left < lower_bound_est or size_est_left > upper_bound_est:
+            continue
+        size_left = 0
+        for k in range(d_rho):
+            left_diff[k] = 0
+        for i in range(n_split):
+            side = X[split_inds[i], dim] < thr
+            size_left += side
+            for k in range(d_rho):
+                left_diff[k] += side * rho[i, k]
+        if size_left < lower_bound or size_left > upper_bound:
+            continue
+        valid[j] = True
+        max_scores[j] = -np.inf
+        for k in range(d_rho):
+            right_diff = rho_sum[k] - left_diff[k]
+            score = (left_diff[k]**2 / size_left + right_diff**2 / (n_split - size_left)) / 2
+            max_scores[j] = max(max_scores[j], score)
+            mean_scores[j] += score / d_rho
+    return max_scores, mean_scores, valid
+
+
+if numba is not None:
+    _score_random_splits = numba.njit(_score_random_splits)
+else:
+    # Without numba the vectorized NumPy implementation in CausalTree is used instead
+    _score_random_splits = None
 
 
 class Node:
@@ -88,11 +146,77 @@ class CausalTree:
         With the default value we guarantee that each child of a split contains
         at least 20% and at most 80% of the data of the parent node.
 
+    split_finder : string, optional (default='random')
+        How candidate splits are generated. ``'random'`` evaluates `n_proposals` random
+        (feature, sample threshold) pairs at each node. ``'histogram'`` bins each feature once
+        per tree into at most `max_bins` quantile bins and evaluates every bin boundary
+        of every feature using per-bin sums and prefix sums of the pseudo-outcomes.
+
+    max_bins : int, optional (default=255)
+        Maximum number of bins per feature when ``split_finder='histogram'``. Must lie between 2 and 256,
+        since the bin codes are stored as uint8.
+
+    nuisance_scope : string, optional (default='node')
+        Where the nuisances are estimated. With ``'node'`` the nuisance estimator is called
+        on the sample of every node that is split. With ``'root'`` it is called once on the
+        root sample and every node only recomputes the parameter estimate, the moments and
+        the gradient on its slice of the root nuisance estimates.
+
+    growth : string, optional (default='depth_first')
+        Order in which the nodes are grown. ``'depth_first'`` estimates and splits one node at a time.
+        ``'level'`` grows the tree breadth first: the samples of all the nodes of a depth are stacked,
+        their parameters, moments and gradients are estimated together (with the batch estimators,
+        if given) and all the gradients of the level are inverted with a single call.
+
+    batch_parameter_estimator : method, optional (default=None)
+        Batched version of `parameter_estimator` used when ``growth='level'``.
+        Takes in (Y, T, X, nuisance_estimates, node_ids, n_nodes), where `node_ids` assigns every
+        sample to one of `n_nodes` nodes, and returns the parameter estimates of all the nodes.
+
+    batch_moment_and_mean_gradient_estimator : method, optional (default=None)
+        Batched version of `moment_and_mean_gradient_estimator` used when ``growth='level'``.
+        Takes in (Y, T, X, W, nuisance_estimates, parameter_estimates, node_ids, n_nodes) and returns
+        the moments of every sample and the stacked mean moment gradients of all the nodes.
+
+    profile : bool, optional (default=False)
+        Whether to record the time spent in the nuisance estimation (``'node_nuisance'``), the parameter,
+        moment and gradient estimation (``'node_parameter'``) and the split search (``'split_search'``)
+        of the nodes in `profiler`.
+
     random_state : int, RandomState instance or None, optional (default=None)
         If int, random_state is the seed used by the random number generator;
         If RandomState instance, random_state is the random number generator;
         If None, the random number generator is the RandomState instance used
         by `np.random`.
+
+    Attributes
+    ----------
+    feature : array, shape (n_nodes, )
+        Feature used to split each node, or -1 for leaves. Nodes are numbered in
+        pre-order, with the root at position 0.
+
+    threshold : array, shape (n_nodes, )
+        Threshold used to split each node; samples with a feature value smaller than
+        the threshold go to the left child.
+
+    children_left : array, shape (n_nodes, )
+        Index of the left child of each node, or -1 for leaves.
+
+    children_right : array, shape (n_nodes, )
+        Index of the right child of each node, or -1 for leaves.
+
+    leaf_id : array, shape (n_nodes, )
+        Index of each node among the leaves of the tree, or -1 for internal nodes.
+
+    leaf_est_indptr : array, shape (n_leaves + 1, )
+        Index pointer of the CSR leaf to estimation sample mapping. The estimation sample
+        indices of leaf `l` are ``leaf_est_inds[leaf_est_indptr[l]:leaf_est_indptr[l + 1]]``.
+
+    leaf_est_inds : array, shape (n_est, )
+        Concatenated estimation sample indices of all leaves.
+
+    profiler : PhaseProfile
+        Time, calls and rows of the phases of the growth of the tree, recorded when `profile` is True.
     """
 
     def __init__(self,
@@ -103,19 +227,49 @@ class CausalTree:
                  max_depth=10,
                  n_proposals=1000,
                  balancedness_tol=.3,
+                 split_finder='random',
+                 max_bins=255,
+                 nuisance_scope='node',
+                 growth='depth_first',
+                 batch_parameter_estimator=None,
+                 batch_moment_and_mean_gradient_estimator=None,
+                 profile=False,
                  random_state=None):
+        if split_finder not in ('random', 'histogram'):
+            raise ValueError("split_finder must be 'random' or 'histogram', got {}".format(split_finder))
+        if not 2 <= max_bins <= 256:
+            raise ValueError("max_bins must lie between 2 and 256, got {}".format(max_bins))
+        if nuisance_scope not in ('node', 'root'):
+            raise ValueError("nuisance_scope must be 'node' or 'root', got {}".format(nuisance_scope))
+        if growth not in ('depth_first', 'level'):
+            raise ValueError("growth must be 'depth_first' or 'level', got {}".format(growth))
         # Estimators
         self.nuisance_estimator = nuisance_estimator
         self.parameter_estimator = parameter_estimator
         self.moment_and_mean_gradient_estimator = moment_and_mean_gradient_estimator
+        self.batch_parameter_estimator = batch_parameter_estimator
+        self.batch_moment_and_mean_gradient_estimator = batch_moment_and_mean_gradient_estimator
         # Causal tree parameters
         self.min_leaf_size = min_leaf_size
         self.max_depth = max_depth
         self.balancedness_tol = balancedness_tol
         self.n_proposals = n_proposals
+        self.split_finder = split_finder
+        self.max_bins = max_bins
+        self.nuisance_scope = nuisance_scope
+        self.growth = growth
         self.random_state = check_random_state(random_state)
+        self.profiler = PhaseProfile(enabled=profile)
         # Tree structure
         self.tree = None
+        # Flat tree structure
+        self.feature = None
+        self.threshold = None
+        self.children_left = None
+        self.children_right = None
+        self.leaf_id = None
+        self.leaf_est_indptr = None
+        self.leaf_est_inds = None
 
     def create_splits(self, Y, T, X, W):
         """
@@ -139,132 +293,407 @@ class CausalTree:
         # a random subsample from the original input
         n = Y.shape[0] // 2
         self.tree = Node(np.arange(n), np.arange(n, Y.shape[0]))
+        binned_X, bin_edges = self._bin_features(X) if self.split_finder == 'histogram' else (None, None)
+        root_nuisance_estimates = None
+        if self.nuisance_scope == 'root':
+            # Estimate the nuisances once on the root sample; nodes reuse the slices of their samples
+            root_inds = self.tree.split_sample_inds
+            with self.profiler.phase('node_nuisance', n_rows=root_inds.shape[0]):
+                root_nuisance_estimates = self.nuisance_estimator(Y[root_inds], T[root_inds], X[root_inds],
+                                                                  W[root_inds] if W is not None else None)
+            if root_nuisance_estimates is None:
+                # Nuisance estimate cannot be calculated, the tree is a single leaf
+                self._build_flat_tree()
+                return
+
+        if self.growth == 'level':
+            self._grow_by_level(Y, T, X, W, root_nuisance_estimates, binned_X, bin_edges)
+        else:
+            self._grow_depth_first(Y, T, X, W, root_nuisance_estimates, binned_X, bin_edges)
+        self._build_flat_tree()
+
+    def _can_split(self, node, depth):
+        # If by splitting we have too small leaves or if we reached the maximum number of splits we stop
+        return node.split_sample_inds.shape[0] // 2 >= self.min_leaf_size and depth < self.max_depth
+
+    def _node_nuisance_estimates(self, node, node_Y, node_T, node_X, node_W, root_nuisance_estimates):
+        if self.nuisance_scope == 'root':
+            # The root split sample indices are 0, ..., n - 1, so they index the root estimates directly
+            return tuple(nuisance[node.split_sample_inds] for nuisance in root_nuisance_estimates)
+        with self.profiler.phase('node_nuisance', n_rows=node_Y.shape[0]):
+            return self.nuisance_estimator(node_Y, node_T, node_X, node_W)
+
+    def _grow_depth_first(self, Y, T, X, W, root_nuisance_estimates, binned_X, bin_edges):
         # node list stores the nodes that are yet to be splitted
         node_list = [(self.tree, 0)]
 
         while len(node_list) > 0:
             node, depth = node_list.pop()
 
-            # If by splitting we have too small leaves or if we reached the maximum number of splits we stop
-            if node.split_sample_inds.shape[0] // 2 >= self.min_leaf_size and depth < self.max_depth:
+            if self._can_split(node, depth):
 
                 # Create local sample set
                 node_X = X[node.split_sample_inds]
                 node_W = W[node.split_sample_inds] if W is not None else None
                 node_T = T[node.split_sample_inds]
                 node_Y = Y[node.split_sample_inds]
-                node_X_estimate = X[node.est_sample_inds]
-                node_size_split = node_X.shape[0]
-                node_size_est = node_X_estimate.shape[0]
 
                 # Compute nuisance estimates for the current node
-                nuisance_estimates = self.nuisance_estimator(node_Y, node_T, node_X, node_W)
+                nuisance_estimates = self._node_nuisance_estimates(node, node_Y, node_T, node_X, node_W,
+                                                                   root_nuisance_estimates)
                 if nuisance_estimates is None:
                     # Nuisance estimate cannot be calculated
                     continue
-                # Estimate parameter for current node
-                node_estimate = self.parameter_estimator(node_Y, node_T, node_X, nuisance_estimates)
-                if node_estimate is None:
-                    # Node estimate cannot be calculated
+                with self.profiler.phase('node_parameter', n_rows=node_Y.shape[0]):
+                    # Estimate parameter for current node
+                    node_estimate = self.parameter_estimator(node_Y, node_T, node_X, nuisance_estimates)
+                    if node_estimate is None:
+                        # Node estimate cannot be calculated
+                        continue
+                    # Calculate moments and gradient of moments for current data
+                    moments, mean_grad = self.moment_and_mean_gradient_estimator(
+                        node_Y, node_T, node_X, node_W,
+                        nuisance_estimates,
+                        node_estimate)
+                    # Calculate inverse gradient
+                    try:
+                        inverse_grad = np.linalg.inv(mean_grad)
+                    except np.linalg.LinAlgError as exc:
+                        if 'Singular matrix' in str(exc):
+                            # The gradient matrix is not invertible.
+                            # No good split can be found
+                            continue
+                        else:
+                            raise exc
+                    # Calculate point-wise pseudo-outcomes rho
+                    rho = np.matmul(moments, inverse_grad)
+
+                if self._split_node(node, X, node_X, rho, binned_X, bin_edges):
+                    # add the created children to the list of not yet split nodes
+                    node_list.append((node.left, depth + 1))
+                    node_list.append((node.right, depth + 1))
+
+    def _grow_by_level(self, Y, T, X, W, root_nuisance_estimates, binned_X, bin_edges):
+        # Grow the tree breadth first: the nodes of each depth are estimated together
+        frontier = [self.tree]
+        depth = 0
+        while len(frontier) > 0:
+            nodes = []
+            level_nuisance_estimates = []
+            for node in frontier:
+                if not self._can_split(node, depth):
                     continue
-                # Calculate moments and gradient of moments for current data
-                moments, mean_grad = self.moment_and_mean_gradient_estimator(
-                    node_Y, node_T, node_X, node_W,
-                    nuisance_estimates,
-                    node_estimate)
-                # Calculate inverse gradient
+                # Compute nuisance estimates for the current node
+                nuisance_estimates = self._node_nuisance_estimates(
+                    node, Y[node.split_sample_inds], T[node.split_sample_inds], X[node.split_sample_inds],
+                    W[node.split_sample_inds] if W is not None else None, root_nuisance_estimates)
+                if nuisance_estimates is not None:
+                    nodes.append(node)
+                    level_nuisance_estimates.append(nuisance_estimates)
+            if len(nodes) == 0:
+                break
+
+            # Stack the samples of all the nodes of the level
+            node_sizes = np.array([node.split_sample_inds.shape[0] for node in nodes])
+            node_ids = np.repeat(np.arange(len(nodes)), node_sizes)
+            node_ends = np.cumsum(node_sizes)
+            level_inds = np.concatenate([node.split_sample_inds for node in nodes])
+            level_Y, level_T, level_X = Y[level_inds], T[level_inds], X[level_inds]
+            level_W = W[level_inds] if W is not None else None
+            nuisance_estimates = tuple(np.concatenate(nuisances) for nuisances in zip(*level_nuisance_estimates))
+
+            with self.profiler.phase('node_parameter', n_rows=level_inds.shape[0]):
+                if (self.batch_parameter_estimator is not None and
+                        self.batch_moment_and_mean_gradient_estimator is not None):
+                    node_estimates = self.batch_parameter_estimator(level_Y, level_T, level_X, nuisance_estimates,
+                                                                    node_ids, len(nodes))
+                    moments, mean_grads = self.batch_moment_and_mean_gradient_estimator(
+                        level_Y, level_T, level_X, level_W, nuisance_estimates, node_estimates, node_ids,
+                        len(nodes))
+                    valid_nodes = np.ones(len(nodes), dtype=bool)
+                else:
+                    moments, mean_grads, valid_nodes = self._level_moments_and_mean_gradients(
+                        level_Y, level_T, level_X, level_W, nuisance_estimates, node_ends)
+
+                # Calculate the inverse gradients of all the nodes at once
                 try:
-                    inverse_grad = np.linalg.inv(mean_grad)
-                except np.linalg.LinAlgError as exc:
-                    if 'Singular matrix' in str(exc):
-                        # The gradient matrix is not invertible.
-                        # No good split can be found
-                        continue
-                    else:
-                        raise exc
+                    inverse_grads = np.linalg.inv(mean_grads)
+                except np.linalg.LinAlgError:
+                    # Some gradient matrix is not invertible, no good split can be found for its node
+                    inverse_grads = np.zeros_like(mean_grads)
+                    for i, mean_grad in enumerate(mean_grads):
+                        try:
+                            inverse_grads[i] = np.linalg.inv(mean_grad)
+                        except np.linalg.LinAlgError:
+                            valid_nodes[i] = False
                 # Calculate point-wise pseudo-outcomes rho
-                rho = np.matmul(moments, inverse_grad)
-
-                # a split is determined by a feature and a sample pair
-                # the number of possible splits is at most (number of features) * (number of node samples)
-                n_proposals = min(self.n_proposals, node_X.size)
-                #  we draw random such pairs by drawing a random number in {0, n_feats * n_node_samples}
-                random_pair = self.random_state.choice(node_X.size, size=n_proposals, replace=False)
-                # parse row and column of random pair
-                thr_inds, dim_proposals = np.unravel_index(random_pair, node_X.shape)
-                # the sample of the pair is the integer division of the random number with n_feats
-                thr_proposals = node_X[thr_inds, dim_proposals]
-
-                # calculate the binary indicator of whether sample i is on the left or the right
-                # side of proposed split j. So this is an n_samples x n_proposals matrix
-                side = node_X[:, dim_proposals] < thr_proposals
-                # calculate the number of samples on the left child for each proposed split
-                size_left = np.sum(side, axis=0)
-                # calculate the analogous binary indicator for the samples in the estimation set
-                side_est = node_X_estimate[:, dim_proposals] < thr_proposals
-                # calculate the number of estimation samples on the left child of each proposed split
-                size_est_left = np.sum(side_est, axis=0)
-
-                # find the upper and lower bound on the size of the left split for the split
-                # to be valid so as for the split to be balanced and leave at least min_leaf_size
-                # on each side.
-                lower_bound = max((.5 - self.balancedness_tol) * node_size_split, self.min_leaf_size)
-                upper_bound = min((.5 + self.balancedness_tol) * node_size_split, node_size_split - self.min_leaf_size)
-                valid_split = (lower_bound <= size_left)
-                valid_split &= (size_left <= upper_bound)
-
-                # similarly for the estimation sample set
-                lower_bound_est = max((.5 - self.balancedness_tol) * node_size_est, self.min_leaf_size)
-                upper_bound_est = min((.5 + self.balancedness_tol) * node_size_est, node_size_est - self.min_leaf_size)
-                valid_split &= (lower_bound_est <= size_est_left)
-                valid_split &= (size_est_left <= upper_bound_est)
-
-                # if there is no valid split then don't create any children
-                if ~np.any(valid_split):
-                    continue
+                rho = np.einsum('ij,ijk->ik', moments, inverse_grads[node_ids])
+
+            frontier = []
+            for i, node in enumerate(nodes):
+                node_slice = slice(node_ends[i] - node_sizes[i], node_ends[i])
+                if valid_nodes[i] and self._split_node(node, X, level_X[node_slice], rho[node_slice],
+                                                       binned_X, bin_edges):
+                    frontier.append(node.left)
+                    frontier.append(node.right)
+            depth += 1
+
+    def _level_moments_and_mean_gradients(self, Y, T, X, W, nuisance_estimates, node_ends):
+        # Calls the per node estimators on the consecutive slices of the stacked samples of a level
+        node_slices = np.split(np.arange(Y.shape[0]), node_ends[:-1])
+        node_moments = [None] * len(node_slices)
+        mean_grads = [None] * len(node_slices)
+        for i, node_slice in enumerate(node_slices):
+            node_nuisance_estimates = tuple(nuisance[node_slice] for nuisance in nuisance_estimates)
+            node_estimate = self.parameter_estimator(Y[node_slice], T[node_slice], X[node_slice],
+                                                     node_nuisance_estimates)
+            if node_estimate is not None:
+                node_moments[i], mean_grads[i] = self.moment_and_mean_gradient_estimator(
+                    Y[node_slice], T[node_slice], X[node_slice], W[node_slice] if W is not None else None,
+                    node_nuisance_estimates, node_estimate)
+        valid_nodes = np.array([mean_grad is not None for mean_grad in mean_grads])
+        # Nodes whose parameter cannot be estimated are not split, pad them to keep the stacks aligned
+        d = mean_grads[np.argmax(valid_nodes)].shape[0] if np.any(valid_nodes) else 1
+        for i in np.flatnonzero(~valid_nodes):
+            node_moments[i] = np.zeros((node_slices[i].shape[0], d))
+            mean_grads[i] = np.eye(d)
+        return np.concatenate(node_moments), np.array(mean_grads), valid_nodes
+
+    def _split_node(self, node, X, node_X, rho, binned_X, bin_edges):
+        # Find the best split of the node and create its children. Returns whether the node was split.
+        node_X_estimate = X[node.est_sample_inds]
+        with self.profiler.phase('split_search', n_rows=node_X.shape[0]):
+            if self.split_finder == 'histogram':
+                split = self._find_histogram_split(node, rho, binned_X, bin_edges)
+            else:
+                split = self._find_random_split(node, X, node_X, node_X_estimate, rho)
+        # if there is no valid split then don't create any children
+        if split is None:
+            return False
+        node.feature, node.threshold, left_side, left_side_est = split
+
+        # Create child nodes with corresponding subsamples
+        node.left = Node(node.split_sample_inds[left_side], node.est_sample_inds[left_side_est])
+        node.right = Node(node.split_sample_inds[~left_side], node.est_sample_inds[~left_side_est])
+        return True
+
+    def _size_bounds(self, node_size):
+        # find the upper and lower bound on the size of the left split for the split
+        # to be valid so as for the split to be balanced and leave at least min_leaf_size
+        # on each side.
+        lower_bound = max((.5 - self.balancedness_tol) * node_size, self.min_leaf_size)
+        upper_bound = min((.5 + self.balancedness_tol) * node_size, node_size - self.min_leaf_size)
+        return lower_bound, upper_bound
+
+    def _balanced_split(self, size_left, node_size):
+        lower_bound, upper_bound = self._size_bounds(node_size)
+        return (lower_bound <= size_left) & (size_left <= upper_bound)
+
+    def _eta(self):
+        # eta specifies how much weight to put on individual heterogeneity vs common heterogeneity
+        # across parameters. we give some benefit to individual heterogeneity factors for cases
+        # where there might be large discontinuities in some parameter as the conditioning set varies
+        return np.random.uniform(0.25, 1)
+
+    def _split_scores(self, left_diff, right_diff, size_left, node_size):
+        # take the square of each of the entries of the influence vectors and normalize
+        # by size of each child
+        left_score = left_diff**2 / size_left.reshape(1, -1)
+        right_score = right_diff**2 / (node_size - size_left).reshape(1, -1)
+        # calculate the vector score of each candidate split as the average of left and right
+        # influence vectors
+        spl_score = (right_score + left_score) / 2
+
+        eta = self._eta()
+        # calculate the scalar score of each split by aggregating across the vector of scores
+        return np.max(spl_score, axis=0) * eta + np.mean(spl_score, axis=0) * (1 - eta)
+
+    def _find_random_split(self, node, X, node_X, node_X_estimate, rho):
+        # a split is determined by a feature and a sample pair
+        # the number of possible splits is at most (number of features) * (number of node samples)
+        n_proposals = min(self.n_proposals, node_X.size)
+        #  we draw random such pairs by drawing a random number in {0, n_feats * n_node_samples}
+        random_pair = self.random_state.choice(node_X.size, size=n_proposals, replace=False)
+        # parse row and column of random pair
+        thr_inds, dim_proposals = np.unravel_index(random_pair, node_X.shape)
+        # the sample of the pair is the integer division of the random number with n_feats
+        thr_proposals = node_X[thr_inds, dim_proposals]
+
+        if _score_random_splits is not None:
+            # Score all proposals with the compiled kernel
+            max_scores, mean_scores, valid_split = _score_random_splits(
+                X, node.split_sample_inds, node.est_sample_inds, np.ascontiguousarray(rho, dtype=np.float64),
+                dim_proposals, thr_proposals,
+                # cast the bounds so that the kernel is only compiled once
+                *map(float, self._size_bounds(node_X.shape[0]) + self._size_bounds(node_X_estimate.shape[0])))
+            if ~np.any(valid_split):
+                return None
+            eta = self._eta()
+            split_scores = np.where(valid_split, max_scores * eta + mean_scores * (1 - eta), -np.inf)
+            best_split_ind = np.argmax(split_scores)
+            feature = dim_proposals[best_split_ind]
+            threshold = thr_proposals[best_split_ind]
+            return feature, threshold, node_X[:, feature] < threshold, node_X_estimate[:, feature] < threshold
+
+        # calculate the binary indicator of whether sample i is on the left or the right
+        # side of proposed split j. So this is an n_samples x n_proposals matrix
+        side = node_X[:, dim_proposals] < thr_proposals
+        # calculate the number of samples on the left child for each proposed split
+        size_left = np.sum(side, axis=0)
+        # calculate the analogous binary indicator for the samples in the estimation set
+        side_est = node_X_estimate[:, dim_proposals] < thr_proposals
+        # calculate the number of estimation samples on the left child of each proposed split
+        size_est_left = np.sum(side_est, axis=0)
+
+        # the split has to be balanced both in the split and in the estimation sample set
+        valid_split = self._balanced_split(size_left, node_X.shape[0])
+        valid_split &= self._balanced_split(size_est_left, node_X_estimate.shape[0])
+
+        if ~np.any(valid_split):
+            return None
+
+        # filter only the valid splits
+        valid_dim_proposals = dim_proposals[valid_split]
+        valid_thr_proposals = thr_proposals[valid_split]
+        valid_side = side[:, valid_split]
+        valid_size_left = size_left[valid_split]
+        valid_side_est = side_est[:, valid_split]
+
+        # calculate the average influence vector of the samples in the left child
+        left_diff = np.matmul(rho.T, valid_side)
+        # calculate the average influence vector of the samples in the right child
+        right_diff = np.matmul(rho.T, 1 - valid_side)
+        split_scores = self._split_scores(left_diff, right_diff, valid_size_left, node_X.shape[0])
+
+        # Find split that minimizes criterion
+        best_split_ind = np.argmax(split_scores)
+        return (valid_dim_proposals[best_split_ind], valid_thr_proposals[best_split_ind],
+                valid_side[:, best_split_ind], valid_side_est[:, best_split_ind])
+
+    def _bin_features(self, X):
+        # Quantile-bin every feature into at most max_bins uint8 codes. The code of a value is the
+        # number of bin edges that are smaller or equal to it, so x < edges[k] if and only if code <= k.
+        sorted_X = np.sort(X, axis=0)
+        quantile_inds = (np.arange(1, self.max_bins) * X.shape[0]) // self.max_bins
+        bin_edges = []
+        binned_X = np.empty(X.shape, dtype=np.uint8)
+        for j in range(X.shape[1]):
+            edges = np.unique(sorted_X[quantile_inds, j])
+            bin_edges.append(edges)
+            binned_X[:, j] = np.searchsorted(edges, X[:, j], side='right')
+        return binned_X, bin_edges
+
+    def _find_histogram_split(self, node, rho, binned_X, bin_edges):
+        node_bins = binned_X[node.split_sample_inds]
+        node_bins_est = binned_X[node.est_sample_inds]
+        node_size_split, d_x = node_bins.shape
+        # offset the codes of each feature so that all the histograms can be accumulated at once
+        offsets = np.arange(d_x) * self.max_bins
+        flat_bins = (node_bins + offsets).ravel()
+        counts = np.bincount(flat_bins, minlength=d_x * self.max_bins).reshape(d_x, self.max_bins)
+        counts_est = np.bincount((node_bins_est + offsets).ravel(),
+                                 minlength=d_x * self.max_bins).reshape(d_x, self.max_bins)
+        # per bin sums of each coordinate of the pseudo-outcomes, shape (d_rho, d_x, max_bins)
+        sums = np.array([np.bincount(flat_bins, weights=np.repeat(rho_k, d_x),
+                                     minlength=d_x * self.max_bins).reshape(d_x, self.max_bins)
+                         for rho_k in rho.T])
+        # the left child of the k-th boundary of a feature contains the bins 0, ..., k
+        size_left = np.cumsum(counts, axis=1)
+        size_est_left = np.cumsum(counts_est, axis=1)
+        left_diff = np.cumsum(sums, axis=2)
+
+        n_edges = np.array([edges.shape[0] for edges in bin_edges])
+        valid_split = np.arange(self.max_bins) < n_edges.reshape(-1, 1)
+        valid_split &= self._balanced_split(size_left, node_size_split)
+        valid_split &= self._balanced_split(size_est_left, node_bins_est.shape[0])
+
+        if ~np.any(valid_split):
+            return None
+
+        valid_dims, valid_boundaries = np.nonzero(valid_split)
+        valid_size_left = size_left[valid_dims, valid_boundaries]
+        valid_left_diff = left_diff[:, valid_dims, valid_boundaries]
+        valid_right_diff = np.sum(rho, axis=0).reshape(-1, 1) - valid_left_diff
+        split_scores = self._split_scores(valid_left_diff, valid_right_diff, valid_size_left, node_size_split)
+
+        # Find split that minimizes criterion
+        best_split_ind = np.argmax(split_scores)
+        feature = valid_dims[best_split_ind]
+        boundary = valid_boundaries[best_split_ind]
+        return (feature, bin_edges[feature][boundary],
+                node_bins[:, feature] <= boundary, node_bins_est[:, feature] <= boundary)
+
+    def _build_flat_tree(self):
+        # Number the nodes in pre-order and store the tree as a structure of arrays
+        nodes = []
+        node_stack = [self.tree]
+        while len(node_stack) > 0:
+            node = node_stack.pop()
+            nodes.append(node)
+            if node.feature != -1:
+                node_stack.append(node.right)
+                node_stack.append(node.left)
+        node_index = {id(node): i for i, node in enumerate(nodes)}
+        n_nodes = len(nodes)
+        self.feature = np.full(n_nodes, -1, dtype=np.intp)
+        self.threshold = np.full(n_nodes, np.inf)
+        self.children_left = np.full(n_nodes, -1, dtype=np.intp)
+        self.children_right = np.full(n_nodes, -1, dtype=np.intp)
+        self.leaf_id = np.full(n_nodes, -1, dtype=np.intp)
+        leaf_est_inds = []
+        for i, node in enumerate(nodes):
+            if node.feature != -1:
+                self.feature[i] = node.feature
+                self.threshold[i] = node.threshold
+                self.children_left[i] = node_index[id(node.left)]
+                self.children_right[i] = node_index[id(node.right)]
+            else:
+                self.leaf_id[i] = len(leaf_est_inds)
+                leaf_est_inds.append(node.est_sample_inds)
+        self.leaf_est_indptr = np.zeros(len(leaf_est_inds) + 1, dtype=np.intp)
+        self.leaf_est_indptr[1:] = np.cumsum([len(inds) for inds in leaf_est_inds])
+        self.leaf_est_inds = np.concatenate(leaf_est_inds).astype(np.intp)
+
+    def apply(self, X):
+        """
+        Return the index of the leaf that each sample is predicted as.
+
+        Parameters
+        ----------
+        X : array-like, shape (m, d_x)
+            Feature vectors whose leaves we want to find.
 
-                # filter only the valid splits
-                valid_dim_proposals = dim_proposals[valid_split]
-                valid_thr_proposals = thr_proposals[valid_split]
-                valid_side = side[:, valid_split]
-                valid_size_left = size_left[valid_split]
-                valid_side_est = side_est[:, valid_split]
-
-                # calculate the average influence vector of the samples in the left child
-                left_diff = np.matmul(rho.T, valid_side)
-                # calculate the average influence vector of the samples in the right child
-                right_diff = np.matmul(rho.T, 1 - valid_side)
-                # take the square of each of the entries of the influence vectors and normalize
-                # by size of each child
-                left_score = left_diff**2 / valid_size_left.reshape(1, -1)
-                right_score = right_diff**2 / (node_size_split - valid_size_left).reshape(1, -1)
-                # calculate the vector score of each candidate split as the average of left and right
-                # influence vectors
-                spl_score = (right_score + left_score) / 2
-
-                # eta specifies how much weight to put on individual heterogeneity vs common heterogeneity
-                # across parameters. we give some benefit to individual heterogeneity factors for cases
-                # where there might be large discontinuities in some parameter as the conditioning set varies
-                eta = np.random.uniform(0.25, 1)
-                # calculate the scalar score of each split by aggregating across the vector of scores
-                split_scores = np.max(spl_score, axis=0) * eta + np.mean(spl_score, axis=0) * (1 - eta)
-
-                # Find split that minimizes criterion
-                best_split_ind = np.argmax(split_scores)
-                node.feature = valid_dim_proposals[best_split_ind]
-                node.threshold = valid_thr_proposals[best_split_ind]
-
-                # Create child nodes with corresponding subsamples
-                left_split_sample_inds = node.split_sample_inds[valid_side[:, best_split_ind]]
-                left_est_sample_inds = node.est_sample_inds[valid_side_est[:, best_split_ind]]
-                node.left = Node(left_split_sample_inds, left_est_sample_inds)
-                right_split_sample_inds = node.split_sample_inds[~valid_side[:, best_split_ind]]
-                right_est_sample_inds = node.est_sample_inds[~valid_side_est[:, best_split_ind]]
-                node.right = Node(right_split_sample_inds, right_est_sample_inds)
-
-                # add the created children to the list of not yet split nodes
-                node_list.append((node.left, depth + 1))
-                node_list.append((node.right, depth + 1))
+        Returns
+        -------
+        leaves : array, shape (m, )
+            The leaf id of each sample, i.e. an index into `leaf_est_indptr`.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        nodes = np.zeros(X.shape[0], dtype=np.intp)
+        # Indices of the samples that have not reached a leaf yet
+        active = np.arange(X.shape[0])[self.feature[nodes] != -1]
+        while active.shape[0] > 0:
+            active_nodes = nodes[active]
+            go_left = X[active, self.feature[active_nodes]] < self.threshold[active_nodes]
+            nodes[active] = np.where(go_left, self.children_left[active_nodes], self.children_right[active_nodes])
+            active = active[self.feature[nodes[active]] != -1]
+        return self.leaf_id[nodes]
+
+    def leaf_est_sample_inds(self, leaf):
+        """
+        Return the estimation sample indices of a leaf.
+
+        Parameters
+        ----------
+        leaf : int
+            The leaf id, as returned by `apply`.
+
+        Returns
+        -------
+        est_sample_inds : array, shape (n_leaf, )
+            Indices of the estimation samples that fall in the leaf.
+        """
+        return self.leaf_est_inds[self.leaf_est_indptr[leaf]:self.leaf_est_indptr[leaf + 1]]
 
     def print_tree_rec(self, node):
         if not node:
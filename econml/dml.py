@@ -12,9 +12,10 @@ from the treatment residuals.
 import numpy as np
 import copy
 from warnings import warn
-from .utilities import (shape, reshape, ndim, hstack, cross_product, transpose,
+from .utilities import (shape, reshape, ndim, hstack, cross_product, transpose, todense,
                         broadcast_unit_treatments, reshape_treatmentwise_effects,
-                        StatsModelsLinearRegression, LassoCVWrapper)
+                        StatsModelsLinearRegression, LassoCVWrapper, CrossProductOperator,
+                        _LinearOperatorRegression)
 from sklearn.model_selection import KFold, StratifiedKFold, check_cv
 from sklearn.linear_model import LinearRegression, LassoCV
 from sklearn.preprocessing import (PolynomialFeatures, LabelEncoder, OneHotEncoder,
@@ -28,6 +29,34 @@ from .inference import StatsModelsInference
 from ._rlearner import _RLearner
 
 
+class _FirstStageDesign:
+    """
+    The features of both first stage models of a DML estimator for a set of samples.
+
+    They are computed once per fit and sliced by rows for every crossfitting fold. The outcome model
+    uses all the columns, which can also be an implicit `CrossProductOperator`. The treatment model only
+    uses the raw features and controls, which are the first `n_xw` columns, because `cross_product` varies
+    its first argument fastest and the first column of the second argument is the constant.
+    """
+
+    def __init__(self, features, n_xw):
+        self.features = features
+        self.n_xw = n_xw
+
+    @property
+    def xw(self):
+        if isinstance(self.features, CrossProductOperator):
+            return self.features.X1
+        return self.features[:, :self.n_xw]
+
+    @property
+    def shape(self):
+        return self.features.shape
+
+    def __getitem__(self, inds):
+        return _FirstStageDesign(self.features[inds], self.n_xw)
+
+
 class DMLCateEstimator(_RLearner):
     """
     The base class for parametric Double ML estimators.
@@ -48,11 +77,19 @@ class DMLCateEstimator(_RLearner):
 
     featurizer: transformer
         The transformer used to featurize the raw features when fitting the final model.  Must implement
-        a `fit_transform` method.
+        a `fit_transform` method. When `linear_first_stages` is ``True``, a copy of it also expands the
+        features of the first stage models.
 
     linear_first_stages: bool
         Whether the first stage models are linear (in which case we will expand the features passed to
-        `model_y` accordingly)
+        `model_y` accordingly). The expanded features are computed once per fit, with a copy of the
+        featurizer that is fit on all the samples, and shared by the crossfitting folds. The featurizer is
+        thus also fit on the samples each fold holds out; this does not matter for featurizers whose fitted
+        state only depends on the number of features, like `PolynomialFeatures`, but a featurizer that learns
+        from the values of the data, like a scaler, sees the samples its first stage is evaluated on.
+        If `model_y` is a :class:`~econml.utilities.LinearOperatorRidge` or a
+        :class:`~econml.utilities.LinearOperatorLasso`, the expanded features are never materialized; they are
+        passed as a :class:`~econml.utilities.CrossProductOperator`, which keeps high dimensional controls feasible.
 
     discrete_treatment: bool, optional (default is ``False``)
         Whether the treatment values should be treated as categorical, rather than continuous, quantities
@@ -78,6 +115,26 @@ class DMLCateEstimator(_RLearner):
         If :class:`~numpy.random.mtrand.RandomState` instance, random_state is the random number generator;
         If None, the random number generator is the :class:`~numpy.random.mtrand.RandomState` instance used
         by `np.random`.
+
+    n_jobs: int or None, optional (default=None)
+        The number of crossfitting folds whose first stage models are fitted concurrently. ``None`` means 1
+        unless in a :obj:`joblib.parallel_backend` context and ``-1`` means using all processors.
+
+    backend: string, optional (default='loky')
+        The joblib backend used to fit the folds concurrently. With a process based backend the data is shared
+        with the workers through read-only memory maps; ``'threading'`` avoids copying the first stage models.
+
+    nuisance_cache: string or None, optional (default=None)
+        A directory in which the cross-fitted residuals of the first stage models are cached. Later fits on the
+        same data, with the same folds and first stage models, only fit the final model, even in other processes.
+
+    n_crossfit_repeats: int, optional (default=1)
+        The number of independent draws of the crossfitting folds. The residuals of all the draws are computed in
+        one parallel batch and aggregated for every sample before the final model is fit; their spread across the
+        draws is available as `nuisances_std_`.
+
+    crossfit_aggregation: 'mean' or 'median', optional (default='mean')
+        How the residuals of the repeated crossfitting draws are aggregated for every sample.
     """
 
     def __init__(self,
@@ -86,34 +143,22 @@ class DMLCateEstimator(_RLearner):
                  linear_first_stages=False,
                  discrete_treatment=False,
                  n_splits=2,
-                 random_state=None):
-
-        # TODO: consider whether we need more care around stateful featurizers,
-        #       since we clone it and fit separate copies
-
+                 random_state=None,
+                 n_jobs=None,
+                 backend='loky',
+                 nuisance_cache=None,
+                 n_crossfit_repeats=1,
+                 crossfit_aggregation='mean'):
+
+        # The first stage models are passed the `_FirstStageDesign` built by `_nuisance_features` as their
+        # features (and None as their controls), so featurization happens once per fit rather than per fold
         class FirstStageWrapper:
             def __init__(self, model, is_Y):
                 self._model = clone(model, safe=False)
-                self._featurizer = clone(featurizer, safe=False)
                 self._is_Y = is_Y
 
-            def _combine(self, X, W, n_samples, fitting=True):
-                if self._is_Y and linear_first_stages:
-                    if X is not None:
-                        F = self._featurizer.fit_transform(X) if fitting else self._featurizer.transform(X)
-                    else:
-                        X = np.ones((n_samples, 1))
-                        F = np.ones((n_samples, 1))
-                    if W is None:
-                        W = np.empty((n_samples, 0))
-                    XW = hstack([X, W])
-                    return cross_product(XW, hstack([np.ones((shape(XW)[0], 1)), F, W]))
-                else:
-                    if X is None:
-                        X = np.ones((n_samples, 1))
-                    if W is None:
-                        W = np.empty((n_samples, 0))
-                    return hstack([X, W])
+            def _combine(self, design):
+                return design.features if self._is_Y else design.xw
 
             def fit(self, X, W, Target, sample_weight=None):
                 if (not self._is_Y) and discrete_treatment:
@@ -123,16 +168,15 @@ class DMLCateEstimator(_RLearner):
                     Target = np.matmul(Target, np.arange(1, Target.shape[1] + 1)).flatten()
 
                 if sample_weight is not None:
-                    self._model.fit(self._combine(X, W, Target.shape[0]), Target, sample_weight=sample_weight)
+                    self._model.fit(self._combine(X), Target, sample_weight=sample_weight)
                 else:
-                    self._model.fit(self._combine(X, W, Target.shape[0]), Target)
+                    self._model.fit(self._combine(X), Target)
 
             def predict(self, X, W):
-                n_samples = X.shape[0] if X is not None else (W.shape[0] if W is not None else 1)
                 if (not self._is_Y) and discrete_treatment:
-                    return self._model.predict_proba(self._combine(X, W, n_samples, fitting=False))[:, 1:]
+                    return self._model.predict_proba(self._combine(X))[:, 1:]
                 else:
-                    return self._model.predict(self._combine(X, W, n_samples, fitting=False))
+                    return self._model.predict(self._combine(X))
 
         class FinalWrapper:
             def __init__(self):
@@ -177,7 +221,37 @@ class DMLCateEstimator(_RLearner):
                          model_final=FinalWrapper(),
                          discrete_treatment=discrete_treatment,
                          n_splits=n_splits,
-                         random_state=random_state)
+                         random_state=random_state,
+                         n_jobs=n_jobs,
+                         backend=backend,
+                         nuisance_cache=nuisance_cache,
+                         n_crossfit_repeats=n_crossfit_repeats,
+                         crossfit_aggregation=crossfit_aggregation)
+        self._linear_first_stages = linear_first_stages
+        self._first_stage_featurizer = clone(featurizer, safe=False)
+        # first stage models that only multiply with their design never need the interactions materialized
+        self._implicit_interactions = isinstance(model_y, _LinearOperatorRegression)
+
+    def _nuisance_features(self, X, W, n_samples, fitting=True):
+        # Build the features of the first stage models once, for both models and all the folds
+        if X is None:
+            X = np.ones((n_samples, 1))
+            F = np.ones((n_samples, 1))
+        elif self._linear_first_stages:
+            F = (self._first_stage_featurizer.fit_transform(X) if fitting
+                 else self._first_stage_featurizer.transform(X))
+        if W is None:
+            W = np.empty((n_samples, 0))
+        XW = hstack([X, W])
+        if self._linear_first_stages:
+            interactions = hstack([np.ones((n_samples, 1)), F, W])
+            if self._implicit_interactions:
+                features = CrossProductOperator(todense(XW), todense(interactions))
+            else:
+                features = cross_product(XW, interactions)
+        else:
+            features = XW
+        return _FirstStageDesign(features, shape(XW)[1]), None
 
     @property
     def featurizer(self):
@@ -213,11 +287,19 @@ class LinearDMLCateEstimator(StatsModelsCateEstimatorMixin, DMLCateEstimator):
     featurizer: transformer, optional
     (default is :class:`PolynomialFeatures(degree=1, include_bias=True) <sklearn.preprocessing.PolynomialFeatures>`)
         The transformer used to featurize the raw features when fitting the final model.  Must implement
-        a `fit_transform` method.
+        a `fit_transform` method. When `linear_first_stages` is ``True``, a copy of it also expands the
+        features of the first stage models.
 
     linear_first_stages: bool
         Whether the first stage models are linear (in which case we will expand the features passed to
-        `model_y` accordingly)
+        `model_y` accordingly). The expanded features are computed once per fit, with a copy of the
+        featurizer that is fit on all the samples, and shared by the crossfitting folds. The featurizer is
+        thus also fit on the samples each fold holds out; this does not matter for featurizers whose fitted
+        state only depends on the number of features, like `PolynomialFeatures`, but a featurizer that learns
+        from the values of the data, like a scaler, sees the samples its first stage is evaluated on.
+        If `model_y` is a :class:`~econml.utilities.LinearOperatorRidge` or a
+        :class:`~econml.utilities.LinearOperatorLasso`, the expanded features are never materialized; they are
+        passed as a :class:`~econml.utilities.CrossProductOperator`, which keeps high dimensional controls feasible.
 
     discrete_treatment: bool, optional (default is ``False``)
         Whether the treatment values should be treated as categorical, rather than continuous, quantities
@@ -244,6 +326,26 @@ class LinearDMLCateEstimator(StatsModelsCateEstimatorMixin, DMLCateEstimator):
         If None, the random number generator is the :class:`~numpy.random.mtrand.RandomState` instance used
         by `np.random`.
 
+    n_jobs: int or None, optional (default=None)
+        The number of crossfitting folds whose first stage models are fitted concurrently. ``None`` means 1
+        unless in a :obj:`joblib.parallel_backend` context and ``-1`` means using all processors.
+
+    backend: string, optional (default='loky')
+        The joblib backend used to fit the folds concurrently. With a process based backend the data is shared
+        with the workers through read-only memory maps; ``'threading'`` avoids copying the first stage models.
+
+    nuisance_cache: string or None, optional (default=None)
+        A directory in which the cross-fitted residuals of the first stage models are cached. Later fits on the
+        same data, with the same folds and first stage models, only fit the final model, even in other processes.
+
+    n_crossfit_repeats: int, optional (default=1)
+        The number of independent draws of the crossfitting folds. The residuals of all the draws are computed in
+        one parallel batch and aggregated for every sample before the final model is fit; their spread across the
+        draws is available as `nuisances_std_`.
+
+    crossfit_aggregation: 'mean' or 'median', optional (default='mean')
+        How the residuals of the repeated crossfitting draws are aggregated for every sample.
+
     """
 
     def __init__(self,
@@ -252,7 +354,12 @@ class LinearDMLCateEstimator(StatsModelsCateEstimatorMixin, DMLCateEstimator):
                  linear_first_stages=True,
                  discrete_treatment=False,
                  n_splits=2,
-                 random_state=None):
+                 random_state=None,
+                 n_jobs=None,
+                 backend='loky',
+                 nuisance_cache=None,
+                 n_crossfit_repeats=1,
+                 crossfit_aggregation='mean'):
         super().__init__(model_y=model_y,
                          model_t=model_t,
                          model_final=StatsModelsLinearRegression(fit_intercept=False),
@@ -260,7 +367,12 @@ class LinearDMLCateEstimator(StatsModelsCateEstimatorMixin, DMLCateEstimator):
                          linear_first_stages=linear_first_stages,
                          discrete_treatment=discrete_treatment,
                          n_splits=n_splits,
-                         random_state=random_state)
+                         random_state=random_state,
+                         n_jobs=n_jobs,
+                         backend=backend,
+                         nuisance_cache=nuisance_cache,
+                         n_crossfit_repeats=n_crossfit_repeats,
+                         crossfit_aggregation=crossfit_aggregation)
 
     # override only so that we can update the docstring to indicate support for `StatsModelsInference`
     def fit(self, Y, T, X=None, W=None, sample_weight=None, sample_var=None, inference=None):
@@ -290,6 +402,27 @@ class LinearDMLCateEstimator(StatsModelsCateEstimatorMixin, DMLCateEstimator):
         """
         return super().fit(Y, T, X=X, W=W, sample_weight=sample_weight, sample_var=sample_var, inference=inference)
 
+    # override only so that we can update the docstring to indicate support for `StatsModelsInference`
+    def refit_final(self, *, inference=None):
+        """
+        Estimate the final model again, reusing the residuals that were cross-fitted by the last call to `fit`.
+
+        This is useful after changing the parameters of the final model or of the featurizer, e.g. through
+        ``est.featurizer.set_params(degree=2)``, since the first stage models are not fitted again.
+
+        Parameters
+        ----------
+        inference: string, `Inference` instance, or None
+            Method for performing inference.  This estimator supports 'bootstrap'
+            (or an instance of :class:`.BootstrapInference`) and 'statsmodels'
+            (or an instance of :class:`.StatsModelsInference`)
+
+        Returns
+        -------
+        self
+        """
+        return super().refit_final(inference=inference)
+
     @property
     def statsmodels(self):
         return self.model_final
@@ -319,11 +452,19 @@ class SparseLinearDMLCateEstimator(DMLCateEstimator):
     featurizer: transformer, optional
     (default is :class:`PolynomialFeatures(degree=1, include_bias=True) <sklearn.preprocessing.PolynomialFeatures>`)
         The transformer used to featurize the raw features when fitting the final model.  Must implement
-        a `fit_transform` method.
+        a `fit_transform` method. When `linear_first_stages` is ``True``, a copy of it also expands the
+        features of the first stage models.
 
     linear_first_stages: bool
         Whether the first stage models are linear (in which case we will expand the features passed to
-        `model_y` accordingly)
+        `model_y` accordingly). The expanded features are computed once per fit, with a copy of the
+        featurizer that is fit on all the samples, and shared by the crossfitting folds. The featurizer is
+        thus also fit on the samples each fold holds out; this does not matter for featurizers whose fitted
+        state only depends on the number of features, like `PolynomialFeatures`, but a featurizer that learns
+        from the values of the data, like a scaler, sees the samples its first stage is evaluated on.
+        If `model_y` is a :class:`~econml.utilities.LinearOperatorRidge` or a
+        :class:`~econml.utilities.LinearOperatorLasso`, the expanded features are never materialized; they are
+        passed as a :class:`~econml.utilities.CrossProductOperator`, which keeps high dimensional controls feasible.
 
     discrete_treatment: bool, optional (default is ``False``)
         Whether the treatment values should be treated as categorical, rather than continuous, quantities
@@ -349,6 +490,26 @@ class SparseLinearDMLCateEstimator(DMLCateEstimator):
         If :class:`~numpy.random.mtrand.RandomState` instance, random_state is the random number generator;
         If None, the random number generator is the :class:`~numpy.random.mtrand.RandomState` instance used
         by `np.random`.
+
+    n_jobs: int or None, optional (default=None)
+        The number of crossfitting folds whose first stage models are fitted concurrently. ``None`` means 1
+        unless in a :obj:`joblib.parallel_backend` context and ``-1`` means using all processors.
+
+    backend: string, optional (default='loky')
+        The joblib backend used to fit the folds concurrently. With a process based backend the data is shared
+        with the workers through read-only memory maps; ``'threading'`` avoids copying the first stage models.
+
+    nuisance_cache: string or None, optional (default=None)
+        A directory in which the cross-fitted residuals of the first stage models are cached. Later fits on the
+        same data, with the same folds and first stage models, only fit the final model, even in other processes.
+
+    n_crossfit_repeats: int, optional (default=1)
+        The number of independent draws of the crossfitting folds. The residuals of all the draws are computed in
+        one parallel batch and aggregated for every sample before the final model is fit; their spread across the
+        draws is available as `nuisances_std_`.
+
+    crossfit_aggregation: 'mean' or 'median', optional (default='mean')
+        How the residuals of the repeated crossfitting draws are aggregated for every sample.
     """
 
     def __init__(self,
@@ -357,7 +518,12 @@ class SparseLinearDMLCateEstimator(DMLCateEstimator):
                  linear_first_stages=True,
                  discrete_treatment=False,
                  n_splits=2,
-                 random_state=None):
+                 random_state=None,
+                 n_jobs=None,
+                 backend='loky',
+                 nuisance_cache=None,
+                 n_crossfit_repeats=1,
+                 crossfit_aggregation='mean'):
         super().__init__(model_y=model_y,
                          model_t=model_t,
                          model_final=model_final,
@@ -365,7 +531,12 @@ class SparseLinearDMLCateEstimator(DMLCateEstimator):
                          linear_first_stages=linear_first_stages,
                          discrete_treatment=discrete_treatment,
                          n_splits=n_splits,
-                         random_state=random_state)
+                         random_state=random_state,
+                         n_jobs=n_jobs,
+                         backend=backend,
+                         nuisance_cache=nuisance_cache,
+                         n_crossfit_repeats=n_crossfit_repeats,
+                         crossfit_aggregation=crossfit_aggregation)
 
 
 class KernelDMLCateEstimator(LinearDMLCateEstimator):
@@ -412,10 +583,32 @@ class KernelDMLCateEstimator(LinearDMLCateEstimator):
         If :class:`~numpy.random.mtrand.RandomState` instance, random_state is the random number generator;
         If None, the random number generator is the :class:`~numpy.random.mtrand.RandomState` instance used
         by `np.random`.
+
+    n_jobs: int or None, optional (default=None)
+        The number of crossfitting folds whose first stage models are fitted concurrently. ``None`` means 1
+        unless in a :obj:`joblib.parallel_backend` context and ``-1`` means using all processors.
+
+    backend: string, optional (default='loky')
+        The joblib backend used to fit the folds concurrently. With a process based backend the data is shared
+        with the workers through read-only memory maps; ``'threading'`` avoids copying the first stage models.
+
+    nuisance_cache: string or None, optional (default=None)
+        A directory in which the cross-fitted residuals of the first stage models are cached. Later fits on the
+        same data, with the same folds and first stage models, only fit the final model, even in other processes.
+
+    n_crossfit_repeats: int, optional (default=1)
+        The number of independent draws of the crossfitting folds. The residuals of all the draws are computed in
+        one parallel batch and aggregated for every sample before the final model is fit; their spread across the
+        draws is available as `nuisances_std_`.
+
+    crossfit_aggregation: 'mean' or 'median', optional (default='mean')
+        How the residuals of the repeated crossfitting draws are aggregated for every sample.
     """
 
     def __init__(self, model_y=LassoCV(), model_t=LassoCV(),
-                 dim=20, bw=1.0, discrete_treatment=False, n_splits=2, random_state=None):
+                 dim=20, bw=1.0, discrete_treatment=False, n_splits=2, random_state=None,
+                 n_jobs=None, backend='loky', nuisance_cache=None,
+                 n_crossfit_repeats=1, crossfit_aggregation='mean'):
         class RandomFeatures(TransformerMixin):
             def __init__(self, random_state):
                 self._random_state = check_random_state(random_state)
@@ -430,4 +623,6 @@ class KernelDMLCateEstimator(LinearDMLCateEstimator):
 
         super().__init__(model_y=model_y, model_t=model_t,
                          featurizer=RandomFeatures(random_state),
-                         discrete_treatment=discrete_treatment, n_splits=n_splits, random_state=random_state)
+                         discrete_treatment=discrete_treatment, n_splits=n_splits, random_state=random_state,
+                         n_jobs=n_jobs, backend=backend, nuisance_cache=nuisance_cache,
+                         n_crossfit_repeats=n_crossfit_repeats, crossfit_aggregation=crossfit_aggregation)
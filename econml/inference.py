@@ -3,6 +3,8 @@
 
 import abc
 import numpy as np
+import scipy.stats
+from sklearn.utils import check_array
 from .bootstrap import BootstrapEstimator
 from .utilities import cross_product, broadcast_unit_treatments, reshape_treatmentwise_effects, ndim
 
@@ -131,3 +133,111 @@ class StatsModelsInference(Inference):
 
     def intercept__interval(self, *, alpha=0.1):
         return self.statsmodels.intercept__interval(alpha)
+
+
+class BLBInference(Inference):
+    """
+    Inference instance to perform a bag of little bootstraps.
+
+    This class can be used for inference by the `ContinuousTreatmentOrthoForest` and the
+    `DiscreteTreatmentOrthoForest`. Instead of refitting the estimator many times, the trees of
+    the forest are grown in bags of `bag_size` trees; all the trees of a bag subsample the same random
+    half of the training samples. The variance of the forest estimate is estimated from the dispersion
+    of the estimates of the different bags, which only requires a single fit. As in the bag of little
+    bootstraps of generalized random forests [Athey2019]_, the Monte Carlo noise of the finite bags is
+    removed from that dispersion: the two halves of the trees of every bag share their samples and only
+    differ by the randomness of their trees, so the variance between them, divided by the number of
+    halves minus one, is subtracted from the variance between the bags. Intervals use a normal
+    approximation.
+
+    Parameters
+    ----------
+    bag_size : int, optional (default 10)
+        Even number of trees in each bag. The number of trees of the forest must be a multiple of it,
+        and should be large enough to give at least 20 bags.
+
+    """
+
+    def __init__(self, bag_size=10):
+        if bag_size < 2 or bag_size % 2 != 0:
+            raise ValueError("The bag size must be an even number of at least 2 trees, got {0}".format(bag_size))
+        self.bag_size = bag_size
+
+    def prefit(self, estimator, *args, **kwargs):
+        # the trees must be grouped in bags before the estimator is fit
+        estimator._bag_size = self.bag_size
+
+    def fit(self, estimator, *args, **kwargs):
+        self._est = estimator
+
+    def _normal_interval(self, point, half_estimates, alpha):
+        # half_estimates has shape (n_bags, 2, ...): the estimates of the two halves of every bag
+        half_estimates = np.asarray(half_estimates)
+        between = np.var(np.mean(half_estimates, axis=1), axis=0, ddof=1)
+        within = np.mean(np.var(half_estimates, axis=1), axis=0) / (half_estimates.shape[1] - 1)
+        scale = scipy.stats.norm.ppf(1 - alpha / 2) * np.sqrt(np.maximum(between - within, 0))
+        return point - scale, point + scale
+
+    def const_marginal_effect_interval(self, X, *, alpha=0.1):
+        return self._normal_interval(*self._est._bag_const_marginal_effects(X), alpha)
+
+    def effect_interval(self, X, *, T0, T1, alpha=0.1):
+        X, T0, T1 = self._est._expand_treatments(X, T0, T1)
+        dT = T1 - T0
+        einsum_str = 'myt,mt->my'
+        if ndim(dT) == 1:
+            einsum_str = einsum_str.replace('t', '')
+        point, half_effects = self._est._bag_const_marginal_effects(X)
+        if ndim(point) == ndim(dT):  # y is a vector, rather than a 2D array
+            einsum_str = einsum_str.replace('y', '')
+        return self._normal_interval(np.einsum(einsum_str, point, dT),
+                                     [[np.einsum(einsum_str, eff, dT) for eff in halves] for halves in half_effects],
+                                     alpha)
+
+
+class ForestSandwichInference(Inference):
+    """
+    Inference instance based on the asymptotic normality of the local second stage of an OrthoForest.
+
+    This class can be used for inference by the `ContinuousTreatmentOrthoForest`. For every query point,
+    the local linear second stage is a weighted ridge regression of the outcome residuals on the
+    treatment residuals. Its covariance is estimated with the sandwich formula
+    :math:`J^{-1} M J^{-1}`, where :math:`J` is the weighted gram matrix of the regression and :math:`M`
+    the weighted outer product of the scores of the local moment at the estimated parameter.
+    The forest weights are treated as fixed. The intervals are computed at prediction time, without
+    refitting the estimator.
+
+    """
+
+    def fit(self, estimator, *args, **kwargs):
+        self._est = estimator
+
+    def _normal_interval(self, point, variance, alpha):
+        scale = scipy.stats.norm.ppf(1 - alpha / 2) * np.sqrt(np.maximum(variance, 0))
+        return point - scale, point + scale
+
+    def const_marginal_effect_interval(self, X, *, alpha=0.1):
+        X = check_array(X)
+        parameters, covariances = self._est._parameter_covariances(X)
+        X_aug = np.hstack((np.ones((X.shape[0], 1)), X))
+        d_t = parameters.shape[1] // X_aug.shape[1]
+        # The effect of every treatment is linear in the local parameters
+        directions = np.einsum('mj,tk->mtjk', X_aug, np.eye(d_t)).reshape(X.shape[0], d_t, -1)
+        point = np.einsum('mtp,mp->mt', directions, parameters)
+        variance = np.einsum('mtp,mpq,mtq->mt', directions, covariances, directions)
+        return self._normal_interval(point, variance, alpha)
+
+    def effect_interval(self, X, *, T0, T1, alpha=0.1):
+        X, T0, T1 = self._est._expand_treatments(X, T0, T1)
+        X = check_array(X)
+        parameters, covariances = self._est._parameter_covariances(X)
+        X_aug = np.hstack((np.ones((X.shape[0], 1)), X))
+        dT = T1 - T0
+        direction = np.einsum('mj,mt->mjt', X_aug, np.reshape(dT, (X.shape[0], -1))).reshape(X.shape[0], -1)
+        point = np.einsum('mp,mp->m', direction, parameters)
+        variance = np.einsum('mp,mpq,mq->m', direction, covariances, direction)
+        lower, upper = self._normal_interval(point, variance, alpha)
+        if ndim(dT) == 1:
+            # match the shape of the effect of a single treatment
+            return lower.reshape(-1, 1), upper.reshape(-1, 1)
+        return lower, upper
@@ -21,39 +21,335 @@ For more details on these methods, see our paper [Oprescu2019]_.
 """
 
 import abc
+import hashlib
 import inspect
+import os
+import pickle
+import threading
 import numpy as np
+import scipy.sparse
 import warnings
-from joblib import Parallel, delayed
+from collections import OrderedDict
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn import clone
 from sklearn.exceptions import NotFittedError
 from sklearn.linear_model import LassoCV, Lasso, LinearRegression, LogisticRegression, \
     LogisticRegressionCV, ElasticNet
 from sklearn.model_selection import KFold, StratifiedKFold
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OneHotEncoder, LabelEncoder, PolynomialFeatures, FunctionTransformer
+from sklearn.preprocessing import LabelEncoder, PolynomialFeatures, FunctionTransformer
 from sklearn.utils import check_random_state, check_array, column_or_1d
+try:
+    import cloudpickle
+except ImportError:
+    from joblib.externals import cloudpickle
 from .cate_estimator import BaseCateEstimator, LinearCateEstimator, TreatmentExpansionMixin
+from .inference import BLBInference, ForestSandwichInference
 from .causal_tree import CausalTree
-from .utilities import reshape_Y_T, MAX_RAND_SEED, check_inputs, WeightedModelWrapper, cross_product
+from .utilities import reshape_Y_T, MAX_RAND_SEED, check_inputs, WeightedModelWrapper, cross_product, \
+    PhaseProfile, _shared_memmaps, _memmapping_parallel
 
+# Number of query chunks handed to each worker by process based prediction backends
+_CHUNKS_PER_WORKER = 4
 
-def _build_tree_in_parallel(Y, T, X, W,
+# Training arrays that `BaseOrthoForest.save` stores as separate .npy files
+_SAVED_ARRAYS = ('Y_one', 'T_one', 'X_one', 'W_one', 'Y_two', 'T_two', 'X_two', 'W_two', '_shuffled_indices',
+                 'counts_one', 'counts_two', '_inverse_one', '_inverse_two')
+
+
+def _build_tree_in_parallel(Y, T, X, W, subsample_ind,
                             nuisance_estimator,
                             parameter_estimator,
                             moment_and_mean_gradient_estimator,
-                            min_leaf_size, max_depth, random_state):
+                            min_leaf_size, max_depth, random_state,
+                            split_finder='random', nuisance_scope='node', growth='depth_first',
+                            batch_parameter_estimator=None, batch_moment_and_mean_gradient_estimator=None,
+                            profile=False):
+    # The full (possibly memory mapped and read-only) data is shared by all the trees;
+    # the subsample of this tree is only materialized here, inside the worker
+    Y, T, X = Y[subsample_ind], T[subsample_ind], X[subsample_ind]
+    W = W[subsample_ind] if W is not None else None
     tree = CausalTree(nuisance_estimator=nuisance_estimator,
                       parameter_estimator=parameter_estimator,
                       moment_and_mean_gradient_estimator=moment_and_mean_gradient_estimator,
                       min_leaf_size=min_leaf_size,
                       max_depth=max_depth,
+                      split_finder=split_finder,
+                      nuisance_scope=nuisance_scope,
+                      growth=growth,
+                      batch_parameter_estimator=batch_parameter_estimator,
+                      batch_moment_and_mean_gradient_estimator=batch_moment_and_mean_gradient_estimator,
+                      profile=profile,
                       random_state=random_state)
     # Create splits of causal tree
     tree.create_splits(Y, T, X, W)
     return tree
 
 
+def _forest_leaves(trees, X):
+    # Leaf of every query in every tree, shape (m, n_trees): every tree routes all the queries at once
+    return np.column_stack([tree.apply(X) for tree in trees])
+
+
+def _forest_kernel(trees, subsample_ind, leaves, n_samples, block_size=64):
+    # Builds the (m, n_samples) sparse matrix of forest weights tree by tree from the leaves of the
+    # queries: each query gets weight 1 / leaf size on the estimation samples of its leaf in every tree.
+    # The entries of `block_size` trees are gathered before they are added to the kernel, so the
+    # kernel is only rebuilt once per block
+    n_queries = leaves.shape[0]
+    kernel = scipy.sparse.csr_matrix((n_queries, n_samples))
+    rows, cols, data = [], [], []
+    for t, tree in enumerate(trees):
+        starts = tree.leaf_est_indptr[leaves[:, t]]
+        counts = tree.leaf_est_indptr[leaves[:, t] + 1] - starts
+        offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cols.append(subsample_ind[t][tree.leaf_est_inds[np.repeat(starts, counts) + offsets]])
+        rows.append(np.repeat(np.arange(n_queries), counts))
+        data.append(np.repeat(1 / counts, counts))
+        if len(rows) == block_size or t == len(trees) - 1:
+            # Converting to CSR sums the repeated entries of the block, including the ones
+            # that bootstrap subsamples produce
+            kernel = kernel + scipy.sparse.coo_matrix(
+                (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(n_queries, n_samples)).tocsr()
+            rows, cols, data = [], [], []
+    return kernel / len(trees)
+
+
+def _save_trees(path, prefix, trees, subsample_ind):
+    # Stores the flat arrays of all the trees of a sub-forest back to back, with the offsets of every tree
+    arrays = {
+        'node_indptr': np.cumsum([0] + [tree.feature.shape[0] for tree in trees]),
+        'leaf_indptr': np.cumsum([0] + [tree.leaf_est_indptr.shape[0] for tree in trees]),
+        'est_indptr': np.cumsum([0] + [tree.leaf_est_inds.shape[0] for tree in trees]),
+        'threshold': np.concatenate([tree.threshold for tree in trees]),
+        'subsample_ind': subsample_ind.astype(np.int32)
+    }
+    for name in ('feature', 'children_left', 'children_right', 'leaf_id', 'leaf_est_indptr', 'leaf_est_inds'):
+        arrays[name] = np.concatenate([getattr(tree, name) for tree in trees]).astype(np.int32)
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, '{0}_{1}.npy'.format(prefix, name)), arr)
+
+
+def _load_trees(path, prefix, mmap_mode, **tree_params):
+    # Rebuilds the trees of a sub-forest saved by _save_trees. The arrays of every tree are views
+    # into the (memory mapped) arrays of the whole sub-forest, so nothing is read until it is used.
+    def load(name, mmap_mode=mmap_mode):
+        return np.load(os.path.join(path, '{0}_{1}.npy'.format(prefix, name)), mmap_mode=mmap_mode)
+    node_indptr, leaf_indptr, est_indptr = (load(name, mmap_mode=None)
+                                            for name in ('node_indptr', 'leaf_indptr', 'est_indptr'))
+    node_arrays = {name: load(name) for name in ('feature', 'threshold', 'children_left', 'children_right',
+                                                 'leaf_id')}
+    leaf_est_indptr = load('leaf_est_indptr')
+    leaf_est_inds = load('leaf_est_inds')
+    trees = []
+    for t in range(node_indptr.shape[0] - 1):
+        tree = CausalTree(**tree_params)
+        for name, arr in node_arrays.items():
+            setattr(tree, name, arr[node_indptr[t]:node_indptr[t + 1]])
+        tree.leaf_est_indptr = leaf_est_indptr[leaf_indptr[t]:leaf_indptr[t + 1]]
+        tree.leaf_est_inds = leaf_est_inds[est_indptr[t]:est_indptr[t + 1]]
+        trees.append(tree)
+    return load('subsample_ind'), trees
+
+
+class _StatePickler(cloudpickle.CloudPickler):
+    # Pickles the state of an estimator. The nuisance and parameter estimators are closures, which
+    # only cloudpickle can serialize, and the references back to the estimator itself (e.g. from its
+    # inference object or treatment transformer) are replaced by a persistent id so that the training
+    # data it holds is not pickled along
+    def __init__(self, file, estimator):
+        super().__init__(file)
+        self.estimator = estimator
+
+    def persistent_id(self, obj):
+        if obj is self.estimator:
+            return 'estimator'
+        return None
+
+
+class _StateUnpickler(pickle.Unpickler):
+    # Unpickles the state written by _StatePickler, binding the references to the estimator
+    # to the given (new) instance
+    def __init__(self, file, estimator):
+        super().__init__(file)
+        self.estimator = estimator
+
+    def persistent_load(self, pid):
+        if pid != 'estimator':
+            raise pickle.UnpicklingError("Unknown persistent id {0}.".format(pid))
+        return self.estimator
+
+
+def _unique_rows(Y, T, X, W):
+    # Collapses the identical (Y, T, X, W) rows. Returns the unique rows, their multiplicities and
+    # the index of the unique row of every original row
+    columns = [Y.reshape(Y.shape[0], -1), T.reshape(T.shape[0], -1), X]
+    if W is not None:
+        columns.append(W)
+    _, unique_ind, inverse, counts = np.unique(np.hstack(columns), axis=0, return_index=True,
+                                               return_inverse=True, return_counts=True)
+    unique_rows = tuple(arr[unique_ind] if arr is not None else None for arr in (Y, T, X, W))
+    return unique_rows, counts, inverse.reshape(-1)
+
+
+def _pointwise_data(data_one, data_two, weights,
+                    second_stage_nuisance_estimator,
+                    global_nuisance_estimates=None,
+                    profile=None):
+    # Gathers the samples with non-zero weight for a single query point, given its sparse row of forest
+    # weights over the concatenation of the two halves (Y, T, X, W) of the training data, and their
+    # second stage nuisance estimates
+    Y_one, T_one, X_one, W_one = data_one
+    Y_two, T_two, X_two, W_two = data_two
+    n_one = Y_one.shape[0]
+    split = np.searchsorted(weights.indices, n_one)
+    ind_w1 = weights.indices[:split]
+    ind_w2 = weights.indices[split:] - n_one
+    w_nonzero = weights.data
+    Y = np.concatenate((Y_one[ind_w1], Y_two[ind_w2]))
+    T = np.concatenate((T_one[ind_w1], T_two[ind_w2]))
+    X = np.concatenate((X_one[ind_w1], X_two[ind_w2]))
+    if global_nuisance_estimates is not None:
+        # Reuse the nuisance estimates that were cross-fitted at fit time
+        nuisance_estimates = tuple(nuisance[weights.indices] for nuisance in global_nuisance_estimates)
+    else:
+        # Crossfitting
+        # Compute weighted nuisance estimates
+        W = np.concatenate((W_one[ind_w1], W_two[ind_w2])) if W_one is not None else None
+        profile = profile if profile is not None else PhaseProfile(enabled=False)
+        with profile.phase('second_stage_nuisance', n_rows=w_nonzero.shape[0]):
+            nuisance_estimates = second_stage_nuisance_estimator(
+                Y, T, X, W, w_nonzero,
+                split_indices=(np.arange(len(ind_w1)), np.arange(len(ind_w1), len(w_nonzero))))
+    return Y, T, X, nuisance_estimates, w_nonzero
+
+
+def _pointwise_parameter(data_one, data_two, weights,
+                         second_stage_nuisance_estimator,
+                         second_stage_parameter_estimator,
+                         global_nuisance_estimates=None,
+                         profile=None,
+                         counts=None):
+    # Estimates the second stage parameter of a single query point. When the multiplicities `counts` of
+    # the deduplicated training rows are given, the ones of the local samples are passed to the estimator
+    profile = profile if profile is not None else PhaseProfile(enabled=False)
+    Y, T, X, nuisance_estimates, w_nonzero = _pointwise_data(data_one, data_two, weights,
+                                                             second_stage_nuisance_estimator,
+                                                             global_nuisance_estimates,
+                                                             profile)
+    with profile.phase('second_stage_solve', n_rows=w_nonzero.shape[0]):
+        if counts is not None:
+            return second_stage_parameter_estimator(Y, T, X, nuisance_estimates, w_nonzero,
+                                                    counts=counts[weights.indices])
+        return second_stage_parameter_estimator(Y, T, X, nuisance_estimates, w_nonzero)
+
+
+def _pointwise_parameters_in_parallel(data_one, data_two, weights,
+                                      second_stage_nuisance_estimator,
+                                      second_stage_parameter_estimator,
+                                      global_nuisance_estimates=None,
+                                      profile=False,
+                                      counts=None):
+    # Also returns the profile of the chunk, which the parent process merges into its own
+    chunk_profile = PhaseProfile(enabled=profile)
+    return [_pointwise_parameter(data_one, data_two, weights[i],
+                                 second_stage_nuisance_estimator,
+                                 second_stage_parameter_estimator,
+                                 global_nuisance_estimates,
+                                 chunk_profile,
+                                 counts) for i in range(weights.shape[0])], chunk_profile
+
+
+def _weighted_grams(weights, features, targets, reg, block_size=1024):
+    # Computes the stacks of weighted gram matrices and moments
+    #   F' diag(w_q) F + diag(reg),   F' diag(w_q) targets
+    # for every row w_q of the sparse weight matrix at once. Only the samples that some query weights
+    # enter, and their per sample outer products are aggregated with one sparse-dense product per block
+    # of block_size samples, so memory does not grow with the number of training samples.
+    weights = weights.tocsc()
+    p, d = features.shape[1], targets.shape[1]
+    gram = np.zeros((weights.shape[0], p * p))
+    moments = np.zeros((weights.shape[0], p * d))
+    used = np.flatnonzero(np.diff(weights.indptr))
+    for start in range(0, used.shape[0], block_size):
+        block = used[start:start + block_size]
+        block_weights = weights[:, block]
+        gram += block_weights @ np.einsum('ij,ik->ijk', features[block], features[block]).reshape(-1, p * p)
+        moments += block_weights @ np.einsum('ij,ik->ijk', features[block], targets[block]).reshape(-1, p * d)
+    gram = gram.reshape(-1, p, p) + np.diag(reg)
+    return gram, moments.reshape(-1, p, d)
+
+
+def _solve_grams(gram, moments):
+    # Solves the stack of small systems gram theta = moments
+    try:
+        theta = np.linalg.solve(gram, moments)
+    except np.linalg.LinAlgError:
+        # Some of the systems are singular, fall back to the minimum norm solution
+        theta = np.matmul(np.linalg.pinv(gram), moments)
+    return theta.reshape(theta.shape[0], -1)
+
+
+def _batched_weighted_ridge(weights, features, targets, reg):
+    # Solves the weighted ridge problems
+    #   (F' diag(w_q) F + diag(reg)) theta_q = F' diag(w_q) targets
+    # for every row w_q of the sparse weight matrix at once
+    return _solve_grams(*_weighted_grams(weights, features, targets, reg))
+
+
+def _truncate_kernel(kernel, max_support=None, weight_tol=0.):
+    # Keeps the heaviest weights of every row of the sparse kernel, always including the largest one,
+    # and rescales the rows to their original mass. Also returns the fraction of the mass that was kept.
+    rows = np.repeat(np.arange(kernel.shape[0]), np.diff(kernel.indptr))
+    # Rank of every weight within its row, by decreasing weight
+    order = np.lexsort((-kernel.data, rows))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0]) - kernel.indptr[rows]
+    keep = (kernel.data >= weight_tol) | (rank == 0)
+    if max_support is not None:
+        keep &= rank < max_support
+    truncated = scipy.sparse.csr_matrix((kernel.data[keep], (rows[keep], kernel.indices[keep])), shape=kernel.shape)
+    total_mass = np.asarray(kernel.sum(axis=1)).ravel()
+    kept_mass = np.asarray(truncated.sum(axis=1)).ravel()
+    retained = np.divide(kept_mass, total_mass, out=np.ones_like(total_mass), where=total_mass > 0)
+    scale = np.divide(1, retained, out=np.ones_like(retained), where=retained > 0)
+    return scipy.sparse.diags(scale) @ truncated, retained
+
+
+def _sandwich_covariances(weights, features, targets, reg, counts=None, block_size=1024):
+    # Weighted ridge estimates theta_q for every row w_q of the sparse weight matrix, as in
+    # _batched_weighted_ridge, and their sandwich covariances J_q^-1 M_q J_q^-1 where
+    #   J_q = F' diag(w_q) F + diag(reg),   M_q = sum_i w_qi^2 r_qi^2 F_i F_i' / c_i
+    # and r_qi = targets_i - F_i theta_q are the residuals of the local fit. A row with multiplicity
+    # c_i carries the total weight of its c_i copies, each of which contributes (w_qi / c_i)^2 to M_q.
+    # The gram matrices are shared with the ridge solve and M_q is accumulated over blocks of block_size
+    # non-zero weights, so memory does not grow with the number of training samples.
+    p = features.shape[1]
+    m = weights.shape[0]
+    gram, moments = _weighted_grams(weights, features, targets.reshape(-1, 1), reg, block_size)
+    theta = _solve_grams(gram, moments)
+    weights = weights.tocoo()
+    meat = np.zeros((m, p * p))
+    for start in range(0, weights.nnz, block_size):
+        rows = weights.row[start:start + block_size]
+        cols = weights.col[start:start + block_size]
+        residuals = targets[cols] - np.sum(features[cols] * theta[rows], axis=1)
+        scores = (weights.data[start:start + block_size] * residuals).reshape(-1, 1) * features[cols]
+        if counts is not None:
+            scores /= np.sqrt(counts[cols]).reshape(-1, 1)
+        meat += _node_sums(np.einsum('ij,ik->ijk', scores, scores).reshape(-1, p * p), rows, m)
+    inverse_gram = np.linalg.pinv(gram)
+    return theta, np.matmul(np.matmul(inverse_gram, meat.reshape(m, p, p)), inverse_gram)
+
+
+def _node_sums(values, node_ids, n_nodes):
+    # Sums the rows of values that belong to each of the n_nodes nodes
+    indicator = scipy.sparse.csr_matrix((np.ones(node_ids.shape[0]), (node_ids, np.arange(node_ids.shape[0]))),
+                                        shape=(n_nodes, node_ids.shape[0]))
+    return indicator @ values
+
+
 def _fit_weighted_pipeline(model_instance, X, y, sample_weight):
     if not isinstance(model_instance, Pipeline):
         model_instance.fit(X, y, sample_weight)
@@ -95,15 +391,11 @@ def _group_cross_fit(model_instance, X, y, t, split_indices, sample_weight=None,
     # Define an inner function that iterates over group predictions
 
     def group_predict(split, predict_func):
-        group_pred = []
-        zero_t = np.zeros((len(split), n_groups - 1))
-        for i in range(n_groups):
-            pred_i = predict_func(
-                np.concatenate((X[split], np.insert(zero_t, i, 1, axis=1)), axis=1)
-            )
-            group_pred.append(pred_i)
+        # Predict all the groups with a single call on the stacked copies of X[split]
+        stacked_t = np.repeat(np.eye(n_groups), len(split), axis=0)
+        group_pred = predict_func(np.concatenate((np.tile(X[split], (n_groups, 1)), stacked_t), axis=1))
         # Convert rows to columns
-        return np.asarray(group_pred).T
+        return np.reshape(group_pred, (n_groups, len(split))).T
 
     # Get predictions for the 2 splits
     if sample_weight is None:
@@ -130,11 +422,25 @@ class BaseOrthoForest(TreatmentExpansionMixin, LinearCateEstimator):
                  parameter_estimator,
                  second_stage_parameter_estimator,
                  moment_and_mean_gradient_estimator,
+                 second_stage_batch_parameter_estimator=None,
+                 batch_parameter_estimator=None,
+                 batch_moment_and_mean_gradient_estimator=None,
                  n_trees=500,
                  min_leaf_size=10, max_depth=10,
                  subsample_ratio=0.25,
                  bootstrap=False,
+                 split_finder='random',
+                 nuisance_scope='node',
+                 growth='depth_first',
+                 global_residualization=False,
+                 max_support=None,
+                 weight_tol=0.,
+                 deduplicate=False,
+                 warm_start=False,
                  n_jobs=-1,
+                 predict_backend='threading',
+                 leaf_cache_size=0,
+                 profile=False,
                  random_state=None):
         # Estimators
         self.nuisance_estimator = nuisance_estimator
@@ -142,23 +448,69 @@ class BaseOrthoForest(TreatmentExpansionMixin, LinearCateEstimator):
         self.parameter_estimator = parameter_estimator
         self.second_stage_parameter_estimator = second_stage_parameter_estimator
         self.moment_and_mean_gradient_estimator = moment_and_mean_gradient_estimator
+        self.second_stage_batch_parameter_estimator = second_stage_batch_parameter_estimator
+        self.batch_parameter_estimator = batch_parameter_estimator
+        self.batch_moment_and_mean_gradient_estimator = batch_moment_and_mean_gradient_estimator
         # OrthoForest parameters
         self.n_trees = n_trees
         self.min_leaf_size = min_leaf_size
         self.max_depth = max_depth
         self.bootstrap = bootstrap
         self.subsample_ratio = subsample_ratio
+        self.split_finder = split_finder
+        self.nuisance_scope = nuisance_scope
+        self.growth = growth
+        self.global_residualization = global_residualization
+        self.max_support = max_support
+        self.weight_tol = weight_tol
+        self.deduplicate = deduplicate
+        self.warm_start = warm_start
         self.n_jobs = n_jobs
+        self.predict_backend = predict_backend
+        self.leaf_cache_size = leaf_cache_size
+        self.profile = profile
         self.random_state = check_random_state(random_state)
         # Sub-forests
         self.forest_one_trees = None
         self.forest_two_trees = None
         self.forest_one_subsample_ind = None
         self.forest_two_subsample_ind = None
+        # Nuisance estimates on the whole training set, used when global_residualization=True
+        self.global_nuisance_estimates = None
+        # Point estimates of previously seen leaf signatures, shared by the threads that predict concurrently
+        self._leaf_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Time spent in each phase of fit and predict
+        self.profiler = PhaseProfile(enabled=profile)
         # Fit check
         self.model_is_fitted = False
         super().__init__()
 
+    def __getstate__(self):
+        # Locks cannot be pickled, every copy gets its own
+        state = self.__dict__.copy()
+        state.pop('_cache_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    def _get_inference_options(self):
+        # add the bag of little bootstraps to parent's options
+        options = super()._get_inference_options()
+        options.update(blb=BLBInference)
+        return options
+
+    def _prefit(self, Y, T, *args, **kwargs):
+        super()._prefit(Y, T, *args, **kwargs)
+        # Trees are grown independently unless a `BLBInference` groups them in bags
+        self._bag_size = 1
+        # Every fit starts a new profile
+        self.profiler = PhaseProfile(enabled=self.profile)
+
     @BaseCateEstimator._wrap_fit
     def fit(self, Y, T, X, W=None, inference=None):
         """Build an orthogonal random forest from a training set (Y, T, X, W).
@@ -179,7 +531,9 @@ class BaseOrthoForest(TreatmentExpansionMixin, LinearCateEstimator):
 
         inference: string, `Inference` instance, or None
             Method for performing inference.  This estimator supports 'bootstrap'
-            (or an instance of `BootstrapInference`)
+            (or an instance of `BootstrapInference`) and 'blb' (or an instance of `BLBInference`).
+            The `ContinuousTreatmentOrthoForest` also supports 'auto' (or an instance of
+            `ForestSandwichInference`)
 
         Returns
         -------
@@ -189,7 +543,25 @@ class BaseOrthoForest(TreatmentExpansionMixin, LinearCateEstimator):
         if Y.ndim > 1 and Y.shape[1] > 1:
             raise ValueError(
                 "The outcome matrix must be of shape ({0}, ) or ({0}, 1), instead got {1}.".format(len(X), Y.shape))
-        shuffled_inidces = self.random_state.permutation(X.shape[0])
+        warm_start = self.warm_start and self.model_is_fitted
+        if warm_start:
+            if X.shape[0] != self._shuffled_indices.shape[0]:
+                raise ValueError("The training data must be the same in every call to fit when warm_start=True, "
+                                 "expected {0} samples but got {1}.".format(self._shuffled_indices.shape[0],
+                                                                            X.shape[0]))
+            if self.n_trees < len(self.forest_one_trees):
+                raise ValueError("n_trees={0} must be larger or equal to the number of existing trees={1} "
+                                 "when warm_start=True.".format(self.n_trees, len(self.forest_one_trees)))
+            if self.n_trees == len(self.forest_one_trees):
+                warnings.warn("Warm-start fitting without increasing n_trees does not fit new trees.")
+            if self.deduplicate != (self._inverse_one is not None):
+                raise ValueError("deduplicate cannot change when warm_start=True.")
+            if self._bag_size != self._fitted_bag_size:
+                raise ValueError("The trees were grown in bags of {0} trees, the bag size cannot change to {1} "
+                                 "when warm_start=True.".format(self._fitted_bag_size, self._bag_size))
+        else:
+            self._shuffled_indices = self.random_state.permutation(X.shape[0])
+        shuffled_inidces = self._shuffled_indices
         n = X.shape[0] // 2
         self.Y_one = Y[shuffled_inidces[:n]]
         self.Y_two = Y[shuffled_inidces[n:]]
@@ -203,14 +575,32 @@ class BaseOrthoForest(TreatmentExpansionMixin, LinearCateEstimator):
         else:
             self.W_one = None
             self.W_two = None
-        self.forest_one_subsample_ind, self.forest_one_trees = self._fit_forest(Y=self.Y_one,
-                                                                                T=self.T_one,
-                                                                                X=self.X_one,
-                                                                                W=self.W_one)
-        self.forest_two_subsample_ind, self.forest_two_trees = self._fit_forest(Y=self.Y_two,
-                                                                                T=self.T_two,
-                                                                                X=self.X_two,
-                                                                                W=self.W_two)
+        self.counts_one, self._inverse_one = None, None
+        self.counts_two, self._inverse_two = None, None
+        if self.deduplicate:
+            # Only the unique rows of each half are stored, the subsamples of the trees are mapped to them
+            (self.Y_one, self.T_one, self.X_one, self.W_one), self.counts_one, self._inverse_one = \
+                _unique_rows(self.Y_one, self.T_one, self.X_one, self.W_one)
+            (self.Y_two, self.T_two, self.X_two, self.W_two), self.counts_two, self._inverse_two = \
+                _unique_rows(self.Y_two, self.T_two, self.X_two, self.W_two)
+        if not warm_start:
+            self.forest_one_subsample_ind, self.forest_one_trees = None, []
+            self.forest_two_subsample_ind, self.forest_two_trees = None, []
+        self.forest_one_subsample_ind, self.forest_one_trees = self._fit_forest(
+            Y=self.Y_one, T=self.T_one, X=self.X_one, W=self.W_one,
+            subsample_ind=self.forest_one_subsample_ind, trees=self.forest_one_trees, inverse=self._inverse_one)
+        self.forest_two_subsample_ind, self.forest_two_trees = self._fit_forest(
+            Y=self.Y_two, T=self.T_two, X=self.X_two, W=self.W_two,
+            subsample_ind=self.forest_two_subsample_ind, trees=self.forest_two_trees, inverse=self._inverse_two)
+        if not self.global_residualization:
+            self.global_nuisance_estimates = None
+        elif not warm_start or self.global_nuisance_estimates is None:
+            # When warm starting, the nuisances of the (unchanged) training data are kept
+            self.global_nuisance_estimates = self._fit_global_nuisances()
+        # The cached estimates belong to the previous forests
+        self.clear_cache()
+        # Warm starts must keep growing the trees in bags of the same size
+        self._fitted_bag_size = self._bag_size
         self.model_is_fitted = True
 
     def const_marginal_effect(self, X):
@@ -229,89 +619,396 @@ class BaseOrthoForest(TreatmentExpansionMixin, LinearCateEstimator):
         if not self.model_is_fitted:
             raise NotFittedError('This {0} instance is not fitted yet.'.format(self.__class__.__name__))
         X = check_array(X)
-        results = Parallel(n_jobs=self.n_jobs, verbose=3, backend='threading')(
-            delayed(self._pointwise_effect)(X_single) for X_single in X)
-        # TODO: Check performance
-        return np.asarray(results)
-
-    def _pointwise_effect(self, X_single):
-        w1, w2 = self._get_weights(X_single)
-        mask_w1 = (w1 != 0)
-        mask_w2 = (w2 != 0)
-        w1_nonzero = w1[mask_w1]
-        w2_nonzero = w2[mask_w2]
-        # Must normalize weights
-        w_nonzero = np.concatenate((w1_nonzero, w2_nonzero))
-        W_none = self.W_one is None
-        # Crossfitting
-        # Compute weighted nuisance estimates
-        nuisance_estimates = self.second_stage_nuisance_estimator(
-            np.concatenate((self.Y_one[mask_w1], self.Y_two[mask_w2])),
-            np.concatenate((self.T_one[mask_w1], self.T_two[mask_w2])),
-            np.concatenate((self.X_one[mask_w1], self.X_two[mask_w2])),
-            np.concatenate((self.W_one[mask_w1], self.W_two[mask_w2])) if not W_none else None,
-            w_nonzero,
-            split_indices=(np.arange(len(w1_nonzero)), np.arange(
-                len(w1_nonzero), len(w_nonzero)))
-        )
-        parameter_estimate = self.second_stage_parameter_estimator(
-            np.concatenate((self.Y_one[mask_w1], self.Y_two[mask_w2])),
-            np.concatenate((self.T_one[mask_w1], self.T_two[mask_w2])),
-            np.concatenate((self.X_one[mask_w1], self.X_two[mask_w2])),
-            nuisance_estimates,
-            w_nonzero
-        )
-        return parameter_estimate
-
-    def _fit_forest(self, Y, T, X, W=None):
+        weights, _, leaves = self._truncated_forest_kernel(X)
+        return self._batch_effect(X, weights, leaves)
+
+    def forest_kernel(self, X):
+        """Calculate the forest weights of the training samples for a batch of query points.
+
+        Parameters
+        ----------
+        X : array-like, shape (m, d_x)
+            Feature vectors of the query points.
+
+        Returns
+        -------
+        weights : scipy.sparse.csr_matrix, shape (m, n)
+            Weight of each training sample for each query point. The first ``n // 2`` columns
+            correspond to the samples the first sub-forest was trained on and are estimated
+            using the second sub-forest. The remaining columns correspond to the samples of
+            the second sub-forest, weighted by the first sub-forest. With ``deduplicate=True``
+            the columns are the unique rows of each half, weighted by their total weight.
+        """
+        if not self.model_is_fitted:
+            raise NotFittedError('This {0} instance is not fitted yet.'.format(self.__class__.__name__))
+        X = check_array(X)
+        with self.profiler.phase('weights', n_rows=X.shape[0]):
+            weights = scipy.sparse.hstack(self._sub_forest_kernels(self._forest_leaves(X)), format='csr')
+            weights.sort_indices()
+        return weights
+
+    def _forest_leaves(self, X, trees=slice(None)):
+        # Leaves of the queries in the two sub-forests, restricted to a slice of their trees
+        return _forest_leaves(self.forest_one_trees[trees], X), _forest_leaves(self.forest_two_trees[trees], X)
+
+    def _sub_forest_kernels(self, leaves, trees=slice(None)):
+        # Weights of the two sub-forests, restricted to the slice of their trees the leaves were computed on
+        leaves_one, leaves_two = leaves
+        w1 = _forest_kernel(self.forest_one_trees[trees], self.forest_one_subsample_ind[trees], leaves_one,
+                            self.Y_one.shape[0])
+        w2 = _forest_kernel(self.forest_two_trees[trees], self.forest_two_subsample_ind[trees], leaves_two,
+                            self.Y_two.shape[0])
+        return w1, w2
+
+    def retained_weight_mass(self, X):
+        """Calculate the fraction of the forest weight used by the second stage of a batch of query points.
+
+        The fraction is smaller than one when the weights are truncated with `max_support` or `weight_tol`.
+
+        Parameters
+        ----------
+        X : array-like, shape (m, d_x)
+            Feature vectors of the query points.
+
+        Returns
+        -------
+        retained_mass : array-like, shape (m, )
+            Fraction of the forest weight of each query point that is kept, averaged over the two
+            halves of the training data.
+        """
+        if not self.model_is_fitted:
+            raise NotFittedError('This {0} instance is not fitted yet.'.format(self.__class__.__name__))
+        X = check_array(X)
+        return self._truncated_forest_kernel(X)[1]
+
+    def _truncated_forest_kernel(self, X):
+        # Forest weights used by the second stage and the fraction of their mass that is kept. Also returns
+        # the leaves of the queries, which identify their estimates in the cache, so that the trees are only
+        # traversed once
+        with self.profiler.phase('weights', n_rows=X.shape[0]):
+            leaves = self._forest_leaves(X)
+            weights, retained = self._truncated_sub_forest_kernel(leaves)
+        return weights, retained, leaves
+
+    def _truncated_sub_forest_kernel(self, leaves, trees=slice(None)):
+        # Weights of a slice of the trees, given the leaves of the queries in those trees, truncated separately
+        # on each half of the data so that both folds of the cross-fitting keep samples
+        w1, w2 = self._sub_forest_kernels(leaves, trees)
+        retained = np.ones(leaves[0].shape[0])
+        if self.max_support is not None or self.weight_tol > 0:
+            w1, retained_one = _truncate_kernel(w1.tocsr(), self.max_support, self.weight_tol)
+            w2, retained_two = _truncate_kernel(w2.tocsr(), self.max_support, self.weight_tol)
+            retained = (retained_one + retained_two) / 2
+        weights = scipy.sparse.hstack((w1, w2), format='csr')
+        weights.sort_indices()
+        return weights, retained
+
+    def _bag_const_marginal_effects(self, X):
+        # Constant marginal effects of the whole forest, shape (m, d_t), and the ones estimated by each of
+        # the two halves of the trees of every bag on its own, shape (n_bags, 2, m, d_t). The bags were grown
+        # on different random halves of the samples, so their dispersion measures the variance of the forest
+        # estimate, while the two halves of a bag share their samples and only differ by the randomness of
+        # their trees. The queries are routed through the trees once, the kernels of the halves are sliced
+        # from their leaves and the estimates of all the halves are computed in a single batch
+        if not self.model_is_fitted:
+            raise NotFittedError('This {0} instance is not fitted yet.'.format(self.__class__.__name__))
+        n_bags = len(self.forest_one_trees) // self._bag_size
+        if self._bag_size < 2 or self._bag_size % 2 != 0 or n_bags < 2:
+            raise ValueError("The trees must be grown in at least 2 bags of an even number of trees, "
+                             "fit with inference='blb' to grow them in bags.")
+        X = check_array(X)
+        half_size = self._bag_size // 2
+        halves = [slice(start, start + half_size) for start in range(0, n_bags * self._bag_size, half_size)]
+        with self.profiler.phase('weights', n_rows=X.shape[0] * (len(halves) + 1)):
+            leaves = self._forest_leaves(X)
+            weights = self._truncated_sub_forest_kernel(leaves)[0]
+            half_weights = scipy.sparse.vstack([
+                self._truncated_sub_forest_kernel(tuple(tree_leaves[:, half] for tree_leaves in leaves), half)[0]
+                for half in halves], format='csr')
+        point = self._batch_effect(X, weights, leaves)
+        half_effects = self._batch_effect(np.tile(X, (len(halves), 1)), half_weights)
+        return point, half_effects.reshape((n_bags, 2) + point.shape)
+
+    def clear_cache(self):
+        """Empty the cache of point estimates and reset its hit and miss counters."""
+        self._leaf_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def save(self, path):
+        """Save the fitted forest to a directory of .npy files that `load` can memory map.
+
+        The trees of each sub-forest are stored as flat int32 arrays, together with the subsample
+        indices and the halves of the training data. The remaining (small) state of the estimator
+        is pickled.
+
+        Parameters
+        ----------
+        path : string
+            Directory to save the forest to. It is created if it does not exist.
+        """
+        if not self.model_is_fitted:
+            raise NotFittedError('This {0} instance is not fitted yet.'.format(self.__class__.__name__))
+        os.makedirs(path, exist_ok=True)
+        for name in _SAVED_ARRAYS:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, '{0}.npy'.format(name)), getattr(self, name))
+        _save_trees(path, 'forest_one', self.forest_one_trees, self.forest_one_subsample_ind)
+        _save_trees(path, 'forest_two', self.forest_two_trees, self.forest_two_subsample_ind)
+        n_global_nuisances = 0
+        if self.global_nuisance_estimates is not None:
+            n_global_nuisances = len(self.global_nuisance_estimates)
+            for i, nuisance in enumerate(self.global_nuisance_estimates):
+                np.save(os.path.join(path, 'global_nuisance_{0}.npy'.format(i)), nuisance)
+        heavy = set(_SAVED_ARRAYS) | {'forest_one_trees', 'forest_two_trees', 'forest_one_subsample_ind',
+                                      'forest_two_subsample_ind', 'global_nuisance_estimates', '_leaf_cache'}
+        state = {name: value for name, value in self.__getstate__().items() if name not in heavy}
+        with open(os.path.join(path, 'estimator.pkl'), 'wb') as f:
+            cloudpickle.dump(type(self), f)
+            _StatePickler(f, self).dump((state, n_global_nuisances))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a forest saved with `save`.
+
+        Parameters
+        ----------
+        path : string
+            Directory the forest was saved to.
+
+        mmap : bool, optional (default=True)
+            Whether to memory map the arrays read-only instead of reading them into memory.
+            Memory mapped arrays are only read when they are used and their pages are shared by all
+            the processes that load the same directory.
+
+        Returns
+        -------
+        estimator : BaseOrthoForest
+            The fitted forest.
+        """
+        with open(os.path.join(path, 'estimator.pkl'), 'rb') as f:
+            saved_cls = pickle.load(f)
+            if not issubclass(saved_cls, cls):
+                raise ValueError("The directory contains a {0}, not a {1}.".format(saved_cls.__name__,
+                                                                                   cls.__name__))
+            est = saved_cls.__new__(saved_cls)
+            state, n_global_nuisances = _StateUnpickler(f, est).load()
+        est.__setstate__(state)
+        mmap_mode = 'r' if mmap else None
+        for name in _SAVED_ARRAYS:
+            filename = os.path.join(path, '{0}.npy'.format(name))
+            setattr(est, name, np.load(filename, mmap_mode=mmap_mode) if os.path.exists(filename) else None)
+        tree_params = dict(nuisance_estimator=est.nuisance_estimator,
+                           parameter_estimator=est.parameter_estimator,
+                           moment_and_mean_gradient_estimator=est.moment_and_mean_gradient_estimator,
+                           min_leaf_size=est.min_leaf_size,
+                           max_depth=est.max_depth,
+                           split_finder=est.split_finder,
+                           nuisance_scope=est.nuisance_scope,
+                           growth=est.growth,
+                           batch_parameter_estimator=est.batch_parameter_estimator,
+                           batch_moment_and_mean_gradient_estimator=est.batch_moment_and_mean_gradient_estimator)
+        est.forest_one_subsample_ind, est.forest_one_trees = _load_trees(path, 'forest_one', mmap_mode, **tree_params)
+        est.forest_two_subsample_ind, est.forest_two_trees = _load_trees(path, 'forest_two', mmap_mode, **tree_params)
+        est.global_nuisance_estimates = None
+        if n_global_nuisances > 0:
+            est.global_nuisance_estimates = tuple(
+                np.load(os.path.join(path, 'global_nuisance_{0}.npy'.format(i)), mmap_mode=mmap_mode)
+                for i in range(n_global_nuisances))
+        est.clear_cache()
+        return est
+
+    def _leaf_signatures(self, leaves):
+        # Queries that fall in the same leaf of every tree of both sub-forests have identical weights,
+        # so the hash of their leaf ids identifies their point estimate
+        leaves = np.ascontiguousarray(np.hstack(leaves), dtype=np.int32)
+        # The truncation of the weights also determines the estimate
+        truncation = repr((self.max_support, self.weight_tol)).encode()
+        return [hashlib.sha1(row.tobytes() + truncation).digest() for row in leaves]
+
+    def _fit_global_nuisances(self):
+        # Cross-fit the second stage nuisances once across the two halves of the training data
+        n_one = self.Y_one.shape[0]
+        n = n_one + self.Y_two.shape[0]
+        with self.profiler.phase('second_stage_nuisance', n_rows=n):
+            nuisance_estimates = self.second_stage_nuisance_estimator(
+                np.concatenate((self.Y_one, self.Y_two)),
+                np.concatenate((self.T_one, self.T_two)),
+                np.concatenate((self.X_one, self.X_two)),
+                np.concatenate((self.W_one, self.W_two)) if self.W_one is not None else None,
+                sample_weight=np.concatenate((self.counts_one, self.counts_two)) if self.deduplicate else None,
+                split_indices=(np.arange(n_one), np.arange(n_one, n))
+            )
+        if nuisance_estimates is None:
+            raise ValueError("The nuisance estimates could not be calculated on the training data.")
+        return nuisance_estimates
+
+    def _pointwise_effect(self, X_single, weights, profile=None, parameter_estimator=None, counts=None):
+        return _pointwise_parameter((self.Y_one, self.T_one, self.X_one, self.W_one),
+                                    (self.Y_two, self.T_two, self.X_two, self.W_two),
+                                    weights,
+                                    self.second_stage_nuisance_estimator,
+                                    parameter_estimator or self.second_stage_parameter_estimator,
+                                    self.global_nuisance_estimates,
+                                    profile,
+                                    counts)
+
+    def _batch_effect(self, X, weights, leaves=None):
+        # The estimates are cached by the leaves of the queries in all the trees, when they are given
+        if leaves is None or self.leaf_cache_size <= 0:
+            return self._batch_parameters(X, weights)
+        signatures = self._leaf_signatures(leaves)
+        parameters = [None] * X.shape[0]
+        # Rows that need to be estimated, by signature; duplicates within the batch are estimated once.
+        # Threads that predict concurrently (e.g. in `chunked_predict`) only hold the lock while they read
+        # or update the cache, the missing estimates are computed outside of it
+        missing = OrderedDict()
+        with self._cache_lock:
+            for i, signature in enumerate(signatures):
+                if signature in self._leaf_cache:
+                    self._leaf_cache.move_to_end(signature)
+                    parameters[i] = self._leaf_cache[signature]
+                    self.cache_hits += 1
+                elif signature in missing:
+                    missing[signature].append(i)
+                    self.cache_hits += 1
+                else:
+                    missing[signature] = [i]
+                    self.cache_misses += 1
+        if len(missing) > 0:
+            first_rows = [rows[0] for rows in missing.values()]
+            estimates = self._batch_parameters(X[first_rows], weights[first_rows])
+            with self._cache_lock:
+                for (signature, rows), estimate in zip(missing.items(), estimates):
+                    for i in rows:
+                        parameters[i] = estimate
+                    self._leaf_cache[signature] = estimate
+                    self._leaf_cache.move_to_end(signature)
+                while len(self._leaf_cache) > self.leaf_cache_size:
+                    # Evict the least recently used estimate
+                    self._leaf_cache.popitem(last=False)
+        return np.asarray(parameters)
+
+    def _batch_parameters(self, X, weights, parameter_estimator=None, counts=None):
+        # `parameter_estimator` replaces the pointwise second stage parameter estimator, e.g. to also
+        # return the covariance of the parameters; it receives the multiplicities of the local samples
+        # as `counts` when they are given
+        if parameter_estimator is None and self.global_residualization and \
+                self.second_stage_batch_parameter_estimator is not None:
+            # The second stage only depends on the stored residuals, so all queries can be solved together
+            with self.profiler.phase('second_stage_solve', n_rows=weights.nnz):
+                return self.second_stage_batch_parameter_estimator(
+                    np.concatenate((self.Y_one, self.Y_two)),
+                    np.concatenate((self.T_one, self.T_two)),
+                    np.concatenate((self.X_one, self.X_two)),
+                    self.global_nuisance_estimates,
+                    weights
+                )
+        if self.predict_backend == 'threading':
+            # Every query is profiled on its own, so that the threads do not share a profile
+            profiles = [PhaseProfile(enabled=self.profile) for _ in range(X.shape[0])]
+            results = Parallel(n_jobs=self.n_jobs, verbose=3, backend='threading')(
+                delayed(self._pointwise_effect)(X_single, weights[i], profiles[i], parameter_estimator, counts)
+                for i, X_single in enumerate(X))
+            for profile in profiles:
+                self.profiler.merge(profile)
+            return np.asarray(results)
+        # Process based backends: the training data is memory mapped once for all the workers
+        # and every worker estimates a contiguous chunk of queries
+        n_chunks = min(X.shape[0], _CHUNKS_PER_WORKER * effective_n_jobs(self.n_jobs))
+        chunks = np.array_split(np.arange(X.shape[0]), n_chunks)
+        global_nuisance_estimates = self.global_nuisance_estimates \
+            if self.global_nuisance_estimates is not None else ()
+        n_global = len(global_nuisance_estimates)
+        with _shared_memmaps(self.Y_one, self.T_one, self.X_one, self.W_one,
+                             self.Y_two, self.T_two, self.X_two, self.W_two,
+                             *global_nuisance_estimates, counts) as shared:
+            results = _memmapping_parallel(n_jobs=self.n_jobs, backend=self.predict_backend, verbose=3)(
+                delayed(_pointwise_parameters_in_parallel)(
+                    tuple(shared[:4]),
+                    tuple(shared[4:8]),
+                    weights[chunk],
+                    self.second_stage_nuisance_estimator,
+                    parameter_estimator or self.second_stage_parameter_estimator,
+                    tuple(shared[8:8 + n_global]) if self.global_nuisance_estimates is not None else None,
+                    self.profile,
+                    shared[8 + n_global])
+                for chunk in chunks)
+        for _, chunk_profile in results:
+            self.profiler.merge(chunk_profile)
+        return np.concatenate([np.asarray(chunk_results) for chunk_results, _ in results])
+
+    def _fit_forest(self, Y, T, X, W=None, subsample_ind=None, trees=(), inverse=None):
+        # Only the trees beyond the existing ones are built. When the rows are deduplicated, `inverse`
+        # maps every original row to its unique row in (Y, T, X, W); the subsamples are drawn from
+        # the original rows, as without deduplication, and then mapped to the unique rows
+        n_new_trees = self.n_trees - len(trees)
+        if n_new_trees <= 0:
+            return subsample_ind, trees
+        n_rows = inverse.shape[0] if inverse is not None else X.shape[0]
         # Generate subsample indices
-        if self.bootstrap:
-            subsample_ind = self.random_state.choice(X.shape[0], size=(self.n_trees, X.shape[0]), replace=True)
+        if self._bag_size > 1:
+            if n_new_trees % self._bag_size != 0:
+                raise ValueError("The number of trees to build ({0}) must be a multiple of the bag size ({1}) "
+                                 "of the bag of little bootstraps.".format(n_new_trees, self._bag_size))
+            # The trees of a bag subsample a random half of the samples that is shared by the whole bag
+            bags = []
+            for _ in range(n_new_trees // self._bag_size):
+                half_sample = self.random_state.choice(n_rows, size=n_rows // 2, replace=False)
+                bags.append(half_sample[self._draw_subsamples(half_sample.shape[0], self._bag_size)])
+            new_subsample_ind = np.concatenate(bags)
         else:
-            if self.subsample_ratio > 1.0:
-                # Safety check
-                self.subsample_ratio = 1.0
-            subsample_size = int(self.subsample_ratio * X.shape[0])
-            subsample_ind = np.zeros((self.n_trees, subsample_size))
-            for t in range(self.n_trees):
-                subsample_ind[t] = self.random_state.choice(X.shape[0], size=subsample_size, replace=False)
-            subsample_ind = subsample_ind.astype(int)
-        # Build trees in parallel
-        return subsample_ind, Parallel(n_jobs=self.n_jobs, verbose=3, max_nbytes=None)(
+            new_subsample_ind = self._draw_subsamples(n_rows, n_new_trees)
+        if inverse is not None:
+            new_subsample_ind = inverse[new_subsample_ind]
+        if subsample_ind is not None and subsample_ind.shape[1] != new_subsample_ind.shape[1]:
+            raise ValueError("The subsample size of the new trees ({0}) differs from the one of the existing trees "
+                             "({1}); subsample_ratio and bootstrap cannot change when warm_start=True.".format(
+                                 new_subsample_ind.shape[1], subsample_ind.shape[1]))
+        # Build trees in parallel. All the workers share a single read-only memory mapped copy
+        # of the data and only receive the subsample indices of their tree.
+        random_states = self.random_state.randint(MAX_RAND_SEED, size=n_new_trees)
+        with self.profiler.phase('build_trees', n_rows=new_subsample_ind.size):
+            if effective_n_jobs(self.n_jobs) == 1:
+                new_trees = self._build_trees(Y, T, X, W, new_subsample_ind, random_states)
+            else:
+                with _shared_memmaps(Y, T, X, W) as (Y, T, X, W):
+                    new_trees = self._build_trees(Y, T, X, W, new_subsample_ind, random_states)
+        for tree in new_trees:
+            # The trees were profiled in the workers
+            self.profiler.merge(tree.profiler)
+        if subsample_ind is None:
+            return new_subsample_ind, list(new_trees)
+        return np.concatenate((subsample_ind, new_subsample_ind)), list(trees) + list(new_trees)
+
+    def _draw_subsamples(self, n_samples, n_trees):
+        if self.bootstrap:
+            return self.random_state.choice(n_samples, size=(n_trees, n_samples), replace=True)
+        if self.subsample_ratio > 1.0:
+            # Safety check
+            self.subsample_ratio = 1.0
+        subsample_size = int(self.subsample_ratio * n_samples)
+        subsample_ind = np.empty((n_trees, subsample_size), dtype=int)
+        for t in range(n_trees):
+            subsample_ind[t] = self.random_state.choice(n_samples, size=subsample_size, replace=False)
+        return subsample_ind
+
+    def _build_trees(self, Y, T, X, W, subsample_ind, random_states):
+        return _memmapping_parallel(n_jobs=self.n_jobs, verbose=3)(
             delayed(_build_tree_in_parallel)(
-                Y[s], T[s], X[s], W[s] if W is not None else None,
+                Y, T, X, W, s,
                 self.nuisance_estimator,
                 self.parameter_estimator,
                 self.moment_and_mean_gradient_estimator,
                 self.min_leaf_size, self.max_depth,
-                self.random_state.randint(MAX_RAND_SEED)) for s in subsample_ind)
-
-    def _get_weights(self, X_single):
-        # Calculates weights
-        w1 = np.zeros(self.Y_one.shape[0])
-        w2 = np.zeros(self.Y_two.shape[0])
-        for t, tree in enumerate(self.forest_one_trees):
-            leaf = tree.find_split(X_single)
-            weight_indexes = self.forest_one_subsample_ind[t][leaf.est_sample_inds]
-            leaf_weight = 1 / len(leaf.est_sample_inds)
-            if self.bootstrap:
-                # Bootstraping has repetitions in tree sample
-                unique, counts = np.unique(weight_indexes, return_counts=True)
-                w1[unique] += leaf_weight * counts
-            else:
-                w1[weight_indexes] += leaf_weight
-        for t, tree in enumerate(self.forest_two_trees):
-            leaf = tree.find_split(X_single)
-            # Similar for `a` weights
-            weight_indexes = self.forest_two_subsample_ind[t][leaf.est_sample_inds]
-            leaf_weight = 1 / len(leaf.est_sample_inds)
-            if self.bootstrap:
-                # Bootstraping has repetitions in tree sample
-                unique, counts = np.unique(weight_indexes, return_counts=True)
-                w2[unique] += leaf_weight * counts
-            else:
-                w2[weight_indexes] += leaf_weight
-        return (w1 / self.n_trees, w2 / self.n_trees)
+                random_state,
+                split_finder=self.split_finder,
+                nuisance_scope=self.nuisance_scope,
+                growth=self.growth,
+                batch_parameter_estimator=self.batch_parameter_estimator,
+                batch_moment_and_mean_gradient_estimator=self.batch_moment_and_mean_gradient_estimator,
+                profile=self.profile)
+            for s, random_state in zip(subsample_ind, random_states))
 
 
 class ContinuousTreatmentOrthoForest(BaseOrthoForest):
@@ -339,6 +1036,21 @@ class ContinuousTreatmentOrthoForest(BaseOrthoForest):
     bootstrap : boolean, optional (default=False)
         Whether to use bootstrap subsampling.
 
+    split_finder : string, optional (default='random')
+        How the causal trees generate candidate splits. ``'random'`` evaluates a random subset of
+        (feature, threshold) pairs at every node, ``'histogram'`` bins the features into quantile
+        bins once per tree and evaluates every bin boundary, which is faster on large nodes.
+
+    nuisance_scope : string, optional (default='node')
+        Where the nuisance models are fitted while growing the trees. ``'node'`` refits them on
+        every node, ``'root'`` fits them once per tree on the root sample and reuses the
+        resulting residuals in all the child nodes, which is much faster for deep trees.
+
+    growth : string, optional (default='depth_first')
+        Order in which the causal trees are grown. ``'level'`` grows them breadth first and
+        estimates the parameters, moments and gradients of all the nodes of a depth together,
+        with a single batched inversion of their gradients.
+
     lambda_reg : float, optional (default=0.01)
         The regularization coefficient in the ell_2 penalty imposed on the
         locally linear part of the second stage fit. This is not applied to
@@ -362,11 +1074,67 @@ class ContinuousTreatmentOrthoForest(BaseOrthoForest):
         `fit` and `predict` methods. If parameter is set to `None`, it defaults to the
         value of `model_Y` parameter.
 
+    global_residualization : boolean, optional (default=False)
+        Whether to cross-fit `model_T_final` and `model_Y_final` once on the whole training set
+        at fit time instead of on the weighted neighbourhood of every query point at prediction
+        time. Prediction then only solves a weighted local linear regression on the stored
+        residuals, which is much faster but does not localize the nuisance models.
+
+    max_support : int or None, optional (default=None)
+        Maximum number of training samples of each half of the data used by the second stage
+        of every query point. Only the samples with the largest forest weights are kept and the
+        weights are renormalized, which approximates the estimate but makes prediction faster
+        when the forest weights have a long tail. ``None`` keeps all the samples.
+
+    weight_tol : float, optional (default=0.)
+        Training samples whose forest weight is smaller than `weight_tol` are dropped from the
+        second stage of a query point, after which the weights are renormalized. The forest weights
+        of each half of the data sum to one, so this is a fraction of the total weight.
+        The fraction of the weight that is kept is reported by `retained_weight_mass`.
+
+    deduplicate : boolean, optional (default=False)
+        Whether to collapse the identical (Y, T, X, W) rows of each half of the training data into
+        unique rows with multiplicities `counts_one` and `counts_two` at `fit`. The trees are grown on
+        the same samples as without deduplication, while the forest weights and the second stage
+        only handle the unique rows, whose weights are the sums of the weights of their copies.
+        This saves memory and prediction time when many rows are repeated, and gives the same
+        estimates when the nuisance models weight their samples exactly. `max_support` and
+        `weight_tol` then apply to the unique rows.
+
+    warm_start : boolean, optional (default=False)
+        When set to ``True``, calling `fit` on an already fitted estimator keeps its trees and only
+        builds the trees needed to reach `n_trees`, using the same split of the samples between the
+        two sub-forests. The same training data must be passed to every call.
+
     n_jobs : int, optional (default=-1)
         The number of jobs to run in parallel for both `fit` and `predict`.
         ``-1`` means using all processors. Since `OrthoForest` methods are
         computationally heavy, it is recommended to set `n_jobs` to -1.
 
+    predict_backend : string, optional (default='threading')
+        The joblib backend used to parallelize prediction across query points. With a process
+        based backend (e.g. ``'loky'`` or ``'multiprocessing'``) the queries are split into
+        chunks that are estimated by separate worker processes, which share a single memory
+        mapped copy of the training data. This scales better when the final models hold the GIL.
+
+    leaf_cache_size : int, optional (default=0)
+        Maximum number of point estimates kept in a least recently used cache at prediction time.
+        Query points that fall in the same leaf of every tree get identical forest weights, so the
+        cache is keyed by a hash of the leaf ids of the query and such points are only estimated once.
+        The cache is emptied on every call to `fit` and its usage is reported by the `cache_hits`
+        and `cache_misses` attributes. Threads that predict concurrently, as in a threaded `chunked_predict`,
+        share it. ``0`` disables the cache.
+
+    profile : boolean, optional (default=False)
+        Whether to record the wall time, number of calls and number of rows of the phases of `fit`
+        and of the predictions in the `profiler` attribute, a `PhaseProfile` whose `report` method
+        summarizes them. The phases are the growth of the trees (``'build_trees'``) and, within the
+        trees, the nuisance estimation (``'node_nuisance'``), the parameter estimation
+        (``'node_parameter'``) and the split search (``'split_search'``) of the nodes, the computation
+        of the forest weights (``'weights'``), the second stage nuisance estimation
+        (``'second_stage_nuisance'``) and the second stage parameter estimation (``'second_stage_solve'``).
+        The profile is restarted by every call to `fit` and accumulates over the predictions.
+
     random_state : int, RandomState instance or None, optional (default=None)
         If int, random_state is the seed used by the random number generator;
         If RandomState instance, random_state is the random number generator;
@@ -380,12 +1148,23 @@ class ContinuousTreatmentOrthoForest(BaseOrthoForest):
                  min_leaf_size=10, max_depth=10,
                  subsample_ratio=0.7,
                  bootstrap=False,
+                 split_finder='random',
+                 nuisance_scope='node',
+                 growth='depth_first',
                  lambda_reg=0.01,
                  model_T=WeightedModelWrapper(LassoCV(cv=3)),
                  model_Y=WeightedModelWrapper(LassoCV(cv=3)),
                  model_T_final=None,
                  model_Y_final=None,
+                 global_residualization=False,
+                 max_support=None,
+                 weight_tol=0.,
+                 deduplicate=False,
+                 warm_start=False,
                  n_jobs=-1,
+                 predict_backend='threading',
+                 leaf_cache_size=0,
+                 profile=False,
                  random_state=None):
         # Copy and/or define models
         self.lambda_reg = lambda_reg
@@ -406,34 +1185,86 @@ class ContinuousTreatmentOrthoForest(BaseOrthoForest):
         parameter_estimator = ContinuousTreatmentOrthoForest.parameter_estimator_func
         second_stage_parameter_estimator =\
             ContinuousTreatmentOrthoForest.second_stage_parameter_estimator_gen(self.lambda_reg)
+        second_stage_batch_parameter_estimator =\
+            ContinuousTreatmentOrthoForest.second_stage_batch_parameter_estimator_gen(self.lambda_reg)
         # Define
         moment_and_mean_gradient_estimator = ContinuousTreatmentOrthoForest.moment_and_mean_gradient_estimator_func
+        batch_parameter_estimator = ContinuousTreatmentOrthoForest.batch_parameter_estimator_func
+        batch_moment_and_mean_gradient_estimator =\
+            ContinuousTreatmentOrthoForest.batch_moment_and_mean_gradient_estimator_func
         super(ContinuousTreatmentOrthoForest, self).__init__(
             nuisance_estimator,
             second_stage_nuisance_estimator,
             parameter_estimator,
             second_stage_parameter_estimator,
             moment_and_mean_gradient_estimator,
+            second_stage_batch_parameter_estimator=second_stage_batch_parameter_estimator,
+            batch_parameter_estimator=batch_parameter_estimator,
+            batch_moment_and_mean_gradient_estimator=batch_moment_and_mean_gradient_estimator,
             n_trees=n_trees,
             min_leaf_size=min_leaf_size,
             max_depth=max_depth,
             subsample_ratio=subsample_ratio,
             bootstrap=bootstrap,
+            split_finder=split_finder,
+            nuisance_scope=nuisance_scope,
+            growth=growth,
+            global_residualization=global_residualization,
+            max_support=max_support,
+            weight_tol=weight_tol,
+            deduplicate=deduplicate,
+            warm_start=warm_start,
             n_jobs=n_jobs,
+            predict_backend=predict_backend,
+            leaf_cache_size=leaf_cache_size,
+            profile=profile,
             random_state=random_state)
 
-    def _pointwise_effect(self, X_single):
+    def _batch_effect(self, X, weights, leaves=None):
         """
-        We need to post-process the parameters returned by the _pointwise_effect
+        We need to post-process the parameters returned by the _batch_effect
         of the BaseOrthoForest class due to the local linear correction. The
         base class function will return the intercept and the coefficient of the
-        local linear fit. We multiply it with the input co-variate to get the
-        predicted effect.
+        local linear fit for every query point. We multiply them with the input
+        co-variates to get the predicted effects.
         """
-        parameter = super(ContinuousTreatmentOrthoForest, self)._pointwise_effect(X_single)
-        X_aug = np.append([1], X_single)
-        parameter = parameter.reshape((X_aug.shape[0], -1)).T
-        return np.dot(parameter, X_aug)
+        parameters = super(ContinuousTreatmentOrthoForest, self)._batch_effect(X, weights, leaves)
+        X_aug = np.hstack((np.ones((X.shape[0], 1)), X))
+        parameters = parameters.reshape((X.shape[0], X_aug.shape[1], -1))
+        return np.einsum('ijk,ij->ik', parameters, X_aug)
+
+    def _get_inference_options(self):
+        # add the sandwich variance of the second stage to parent's options
+        options = super()._get_inference_options()
+        options.update(auto=ForestSandwichInference)
+        return options
+
+    def _parameter_covariances(self, X):
+        # Local linear parameters of every query point, shape (m, (d_x + 1) * d_t), and the sandwich
+        # covariances of their second stage, shape (m, (d_x + 1) * d_t, (d_x + 1) * d_t)
+        if not self.model_is_fitted:
+            raise NotFittedError('This {0} instance is not fitted yet.'.format(self.__class__.__name__))
+        X = check_array(X)
+        weights = self._truncated_forest_kernel(X)[0]
+        counts = np.concatenate((self.counts_one, self.counts_two)) if self.deduplicate else None
+        covariance_estimator = self.second_stage_covariance_estimator_gen(self.lambda_reg)
+        if self.global_nuisance_estimates is not None:
+            # The residuals are shared by all the query points, which are solved together
+            with self.profiler.phase('second_stage_solve', n_rows=weights.nnz):
+                return covariance_estimator(np.concatenate((self.Y_one, self.Y_two)),
+                                            np.concatenate((self.T_one, self.T_two)),
+                                            np.concatenate((self.X_one, self.X_two)),
+                                            self.global_nuisance_estimates, weights, counts)
+
+        # Every query point has its own locally cross-fitted residuals, which are computed by the same
+        # workers as the point estimates; each of them returns its parameters and covariance flattened
+        def pointwise_estimator(Y, T, X, nuisance_estimates, sample_weight, counts=None):
+            theta, cov = covariance_estimator(Y, T, X, nuisance_estimates,
+                                              scipy.sparse.csr_matrix(sample_weight.reshape(1, -1)), counts)
+            return np.concatenate((theta.ravel(), cov.ravel()))
+        results = self._batch_parameters(X, weights, pointwise_estimator, counts)
+        n_params = (X.shape[1] + 1) * (self.T_one.shape[1] if self.T_one.ndim == 2 else 1)
+        return results[:, :n_params], results[:, n_params:].reshape(-1, n_params, n_params)
 
     @staticmethod
     def nuisance_estimator_generator(model_T, model_Y, random_state=None, second_stage=True):
@@ -515,6 +1346,55 @@ class ContinuousTreatmentOrthoForest(BaseOrthoForest):
 
         return parameter_estimator_func
 
+    @staticmethod
+    def second_stage_batch_parameter_estimator_gen(lambda_reg):
+        """
+        Batched version of the estimator generated by `second_stage_parameter_estimator_gen`.
+        The generated function takes the sparse (m, n) matrix of weights of m query points
+        and returns the (m, d_t * (d_x + 1)) local linear parameters of all of them.
+        """
+        def parameter_estimator_func(Y, T, X,
+                                     nuisance_estimates,
+                                     weights):
+            """Calculate the parameters of interest for a batch of weightings of the points (Y, T)."""
+            # Compute residuals
+            Y_hat, T_hat = nuisance_estimates
+            Y_res, T_res = reshape_Y_T(Y - Y_hat, T - T_hat)
+            X_aug = PolynomialFeatures(degree=1, include_bias=True).fit_transform(X)
+            XT_res = cross_product(T_res, X_aug)
+            # ell_2 regularization
+            diagonal = np.ones(XT_res.shape[1])
+            diagonal[:T_res.shape[1]] = 0
+            # Ridge regression estimates
+            return _batched_weighted_ridge(weights, XT_res, Y_res.reshape(-1, 1), lambda_reg * diagonal)
+
+        return parameter_estimator_func
+
+    @staticmethod
+    def second_stage_covariance_estimator_gen(lambda_reg):
+        """
+        Sandwich covariance version of the estimator generated by `second_stage_batch_parameter_estimator_gen`.
+        The generated function takes the sparse (m, n) matrix of weights of m query points and, when the rows
+        were deduplicated, their multiplicities, and returns the (m, p) local linear parameters of the query
+        points and their (m, p, p) sandwich covariances, where p = d_t * (d_x + 1).
+        """
+        def covariance_estimator_func(Y, T, X,
+                                      nuisance_estimates,
+                                      weights,
+                                      counts=None):
+            """Calculate the parameters of interest and their covariances for a batch of weightings."""
+            # Compute residuals
+            Y_hat, T_hat = nuisance_estimates
+            Y_res, T_res = reshape_Y_T(Y - Y_hat, T - T_hat)
+            X_aug = PolynomialFeatures(degree=1, include_bias=True).fit_transform(X)
+            XT_res = cross_product(T_res, X_aug)
+            # ell_2 regularization of the linear part only
+            diagonal = np.ones(XT_res.shape[1])
+            diagonal[:T_res.shape[1]] = 0
+            return _sandwich_covariances(weights, XT_res, Y_res, lambda_reg * diagonal, counts)
+
+        return covariance_estimator_func
+
     @staticmethod
     def moment_and_mean_gradient_estimator_func(Y, T, X, W,
                                                 nuisance_estimates,
@@ -531,6 +1411,40 @@ class ContinuousTreatmentOrthoForest(BaseOrthoForest):
         mean_gradient = - np.matmul(T_res.T, T_res) / T_res.shape[0]
         return moments, mean_gradient
 
+    @staticmethod
+    def batch_parameter_estimator_func(Y, T, X,
+                                       nuisance_estimates,
+                                       node_ids, n_nodes):
+        """Calculate the parameters of interest of several nodes, given the node of every point (Y, T)."""
+        # Compute residuals
+        Y_hat, T_hat = nuisance_estimates
+        Y_res, T_res = reshape_Y_T(Y - Y_hat, T - T_hat)
+        d_t = T_res.shape[1]
+        # Per node normal equations of the OLS on residuals
+        TT = _node_sums(np.einsum('ij,ik->ijk', T_res, T_res).reshape(-1, d_t * d_t), node_ids, n_nodes)
+        TY = _node_sums(T_res * Y_res.reshape(-1, 1), node_ids, n_nodes)
+        # Minimum norm solutions, as returned by LinearRegression; shape is (n_nodes, d_T)
+        return np.matmul(np.linalg.pinv(TT.reshape(n_nodes, d_t, d_t)), TY.reshape(n_nodes, d_t, 1))[:, :, 0]
+
+    @staticmethod
+    def batch_moment_and_mean_gradient_estimator_func(Y, T, X, W,
+                                                      nuisance_estimates,
+                                                      parameter_estimates,
+                                                      node_ids, n_nodes):
+        """Calculate the moments at points given by (Y, T, X, W) and the mean gradients of their nodes."""
+        # Compute residuals
+        Y_hat, T_hat = nuisance_estimates
+        Y_res, T_res = reshape_Y_T(Y - Y_hat, T - T_hat)
+        d_t = T_res.shape[1]
+        # Compute moments
+        # Moments shape is (n, d_T)
+        moments = (Y_res - np.sum(T_res * parameter_estimates[node_ids], axis=1)).reshape(-1, 1) * T_res
+        # Compute moment gradients, shape is (n_nodes, d_T, d_T)
+        TT = _node_sums(np.einsum('ij,ik->ijk', T_res, T_res).reshape(-1, d_t * d_t), node_ids, n_nodes)
+        counts = np.bincount(node_ids, minlength=n_nodes)
+        mean_gradients = - TT.reshape(n_nodes, d_t, d_t) / counts.reshape(-1, 1, 1)
+        return moments, mean_gradients
+
 
 class DiscreteTreatmentOrthoForest(BaseOrthoForest):
     """
@@ -558,6 +1472,21 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
     bootstrap : boolean, optional (default=False)
         Whether to use bootstrap subsampling.
 
+    split_finder : string, optional (default='random')
+        How the causal trees generate candidate splits. ``'random'`` evaluates a random subset of
+        (feature, threshold) pairs at every node, ``'histogram'`` bins the features into quantile
+        bins once per tree and evaluates every bin boundary, which is faster on large nodes.
+
+    nuisance_scope : string, optional (default='node')
+        Where the nuisance models are fitted while growing the trees. ``'node'`` refits them on
+        every node, ``'root'`` fits them once per tree on the root sample and reuses the
+        resulting residuals in all the child nodes, which is much faster for deep trees.
+
+    growth : string, optional (default='depth_first')
+        Order in which the causal trees are grown. ``'level'`` grows them breadth first and
+        estimates the parameters, moments and gradients of all the nodes of a depth together,
+        with a single batched inversion of their gradients.
+
     lambda_reg : float, optional (default=0.01)
         The regularization coefficient in the ell_2 penalty imposed on the
         locally linear part of the second stage fit. This is not applied to
@@ -587,11 +1516,67 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
         helper class. The model(s) must implement `fit` and `predict` methods.
         If parameter is set to `None`, it defaults to the value of `model_Y` parameter.
 
+    global_residualization : boolean, optional (default=False)
+        Whether to cross-fit `propensity_model_final` and `model_Y_final` once on the whole training
+        set at fit time instead of on the weighted neighbourhood of every query point at prediction
+        time. Prediction then only solves a weighted local linear regression on the stored
+        nuisance estimates, which is much faster but does not localize the nuisance models.
+
+    max_support : int or None, optional (default=None)
+        Maximum number of training samples of each half of the data used by the second stage
+        of every query point. Only the samples with the largest forest weights are kept and the
+        weights are renormalized, which approximates the estimate but makes prediction faster
+        when the forest weights have a long tail. ``None`` keeps all the samples.
+
+    weight_tol : float, optional (default=0.)
+        Training samples whose forest weight is smaller than `weight_tol` are dropped from the
+        second stage of a query point, after which the weights are renormalized. The forest weights
+        of each half of the data sum to one, so this is a fraction of the total weight.
+        The fraction of the weight that is kept is reported by `retained_weight_mass`.
+
+    deduplicate : boolean, optional (default=False)
+        Whether to collapse the identical (Y, T, X, W) rows of each half of the training data into
+        unique rows with multiplicities `counts_one` and `counts_two` at `fit`. The trees are grown on
+        the same samples as without deduplication, while the forest weights and the second stage
+        only handle the unique rows, whose weights are the sums of the weights of their copies.
+        This saves memory and prediction time when many rows are repeated, and gives the same
+        estimates when the nuisance models weight their samples exactly. `max_support` and
+        `weight_tol` then apply to the unique rows.
+
+    warm_start : boolean, optional (default=False)
+        When set to ``True``, calling `fit` on an already fitted estimator keeps its trees and only
+        builds the trees needed to reach `n_trees`, using the same split of the samples between the
+        two sub-forests. The same training data must be passed to every call.
+
     n_jobs : int, optional (default=-1)
         The number of jobs to run in parallel for both `fit` and `predict`.
         ``-1`` means using all processors. Since `OrthoForest` methods are
         computationally heavy, it is recommended to set `n_jobs` to -1.
 
+    predict_backend : string, optional (default='threading')
+        The joblib backend used to parallelize prediction across query points. With a process
+        based backend (e.g. ``'loky'`` or ``'multiprocessing'``) the queries are split into
+        chunks that are estimated by separate worker processes, which share a single memory
+        mapped copy of the training data. This scales better when the final models hold the GIL.
+
+    leaf_cache_size : int, optional (default=0)
+        Maximum number of point estimates kept in a least recently used cache at prediction time.
+        Query points that fall in the same leaf of every tree get identical forest weights, so the
+        cache is keyed by a hash of the leaf ids of the query and such points are only estimated once.
+        The cache is emptied on every call to `fit` and its usage is reported by the `cache_hits`
+        and `cache_misses` attributes. Threads that predict concurrently, as in a threaded `chunked_predict`,
+        share it. ``0`` disables the cache.
+
+    profile : boolean, optional (default=False)
+        Whether to record the wall time, number of calls and number of rows of the phases of `fit`
+        and of the predictions in the `profiler` attribute, a `PhaseProfile` whose `report` method
+        summarizes them. The phases are the growth of the trees (``'build_trees'``) and, within the
+        trees, the nuisance estimation (``'node_nuisance'``), the parameter estimation
+        (``'node_parameter'``) and the split search (``'split_search'``) of the nodes, the computation
+        of the forest weights (``'weights'``), the second stage nuisance estimation
+        (``'second_stage_nuisance'``) and the second stage parameter estimation (``'second_stage_solve'``).
+        The profile is restarted by every call to `fit` and accumulates over the predictions.
+
     random_state : int, RandomState instance or None, optional (default=None)
         If int, random_state is the seed used by the random number generator;
         If RandomState instance, random_state is the random number generator;
@@ -606,13 +1591,24 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
                  min_leaf_size=10, max_depth=10,
                  subsample_ratio=0.7,
                  bootstrap=False,
+                 split_finder='random',
+                 nuisance_scope='node',
+                 growth='depth_first',
                  lambda_reg=0.01,
                  propensity_model=LogisticRegression(penalty='l1', solver='saga',
                                                      multi_class='auto'),  # saga solver supports l1
                  model_Y=WeightedModelWrapper(LassoCV(cv=3)),
                  propensity_model_final=None,
                  model_Y_final=None,
+                 global_residualization=False,
+                 max_support=None,
+                 weight_tol=0.,
+                 deduplicate=False,
+                 warm_start=False,
                  n_jobs=-1,
+                 predict_backend='threading',
+                 leaf_cache_size=0,
+                 profile=False,
                  random_state=None):
         # Copy and/or define models
         self.propensity_model = clone(propensity_model, safe=False)
@@ -631,9 +1627,14 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
         parameter_estimator = DiscreteTreatmentOrthoForest.parameter_estimator_func
         second_stage_parameter_estimator =\
             DiscreteTreatmentOrthoForest.second_stage_parameter_estimator_gen(lambda_reg)
+        second_stage_batch_parameter_estimator =\
+            DiscreteTreatmentOrthoForest.second_stage_batch_parameter_estimator_gen(lambda_reg)
         # Define moment and mean gradient estimator
         moment_and_mean_gradient_estimator =\
             DiscreteTreatmentOrthoForest.moment_and_mean_gradient_estimator_func
+        batch_parameter_estimator = DiscreteTreatmentOrthoForest.batch_parameter_estimator_func
+        batch_moment_and_mean_gradient_estimator =\
+            DiscreteTreatmentOrthoForest.batch_moment_and_mean_gradient_estimator_func
         # Define autoencoder
         self._label_encoder = LabelEncoder()
         super(DiscreteTreatmentOrthoForest, self).__init__(
@@ -642,12 +1643,26 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
             parameter_estimator,
             second_stage_parameter_estimator,
             moment_and_mean_gradient_estimator,
+            second_stage_batch_parameter_estimator=second_stage_batch_parameter_estimator,
+            batch_parameter_estimator=batch_parameter_estimator,
+            batch_moment_and_mean_gradient_estimator=batch_moment_and_mean_gradient_estimator,
             n_trees=n_trees,
             min_leaf_size=min_leaf_size,
             max_depth=max_depth,
             subsample_ratio=subsample_ratio,
             bootstrap=bootstrap,
+            split_finder=split_finder,
+            nuisance_scope=nuisance_scope,
+            growth=growth,
+            global_residualization=global_residualization,
+            max_support=max_support,
+            weight_tol=weight_tol,
+            deduplicate=deduplicate,
+            warm_start=warm_start,
             n_jobs=n_jobs,
+            predict_backend=predict_backend,
+            leaf_cache_size=leaf_cache_size,
+            profile=profile,
             random_state=random_state)
 
     def fit(self, Y, T, X, W=None, inference=None):
@@ -671,7 +1686,7 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
 
         inference: string, `Inference` instance, or None
             Method for performing inference.  This estimator supports 'bootstrap'
-            (or an instance of `BootstrapInference`)
+            (or an instance of `BootstrapInference`) and 'blb' (or an instance of `BLBInference`)
 
         Returns
         -------
@@ -694,41 +1709,41 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
         # Call `fit` from parent class
         return super().fit(Y, T, X, W=W, inference=inference)
 
-    def _pointwise_effect(self, X_single):
+    def _batch_effect(self, X, weights, leaves=None):
         """
-        We need to post-process the parameters returned by the _pointwise_effect
+        We need to post-process the parameters returned by the _batch_effect
         of the BaseOrthoForest class due to the local linear correction. The
         base class function will return the intercept and the coefficient of the
-        local linear fit. We multiply it with the input co-variate to get the
-        predicted effect.
+        local linear fit for every query point. We multiply them with the input
+        co-variates to get the predicted effects.
         """
-        parameter = super(DiscreteTreatmentOrthoForest, self)._pointwise_effect(X_single)
-        X_aug = np.append([1], X_single)
-        parameter = parameter.reshape((X_aug.shape[0], -1)).T
-        return np.dot(parameter, X_aug)
+        parameters = super(DiscreteTreatmentOrthoForest, self)._batch_effect(X, weights, leaves)
+        X_aug = np.hstack((np.ones((X.shape[0], 1)), X))
+        parameters = parameters.reshape((X.shape[0], X_aug.shape[1], -1))
+        return np.einsum('ijk,ij->ik', parameters, X_aug)
 
     @staticmethod
     def nuisance_estimator_generator(propensity_model, model_Y, n_T, random_state=None, second_stage=False):
         """Generate nuissance estimator given model inputs from the class."""
+        # One-hot encodings of the label encoded treatments, shared by all the calls
+        treatment_encodings = np.eye(n_T)
+
         def nuisance_estimator(Y, T, X, W, sample_weight=None, split_indices=None):
+            T_codes = T.reshape(-1).astype(int)
+            treatment_counts = np.bincount(T_codes, minlength=n_T)
             # Test that T contains all treatments. If not, return None
-            ohe_T = OneHotEncoder(sparse=False, categories='auto').fit_transform(T.reshape(-1, 1))
-            if ohe_T.shape[1] < n_T:
+            if np.any(treatment_counts == 0):
                 return None
+            ohe_T = treatment_encodings[T_codes]
             # Nuissance estimates evaluated with cross-fitting
             this_random_state = check_random_state(random_state)
             if split_indices is None:
+                # Check if there is only one example of some class, which cannot be stratified
+                if np.any(treatment_counts < 2):
+                    return None
                 # Define 2-fold iterator
-                kfold_it = StratifiedKFold(n_splits=2, shuffle=True, random_state=this_random_state).split(X, T)
-                # Check if there is only one example of some class
-                with warnings.catch_warnings():
-                    warnings.filterwarnings('error')
-                    try:
-                        split_indices = list(kfold_it)[0]
-                    except Warning as warn:
-                        msg = str(warn)
-                        if "The least populated class in y has only 1 members" in msg:
-                            return None
+                kfold_it = StratifiedKFold(n_splits=2, shuffle=True, random_state=this_random_state).split(X, T_codes)
+                split_indices = list(kfold_it)[0]
             if W is not None:
                 X_tilde = np.concatenate((X, W), axis=1)
             else:
@@ -792,6 +1807,28 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
 
         return parameter_estimator_func
 
+    @staticmethod
+    def second_stage_batch_parameter_estimator_gen(lambda_reg):
+        """
+        Batched version of the estimator generated by `second_stage_parameter_estimator_gen`.
+        The generated function takes the sparse (m, n) matrix of weights of m query points
+        and returns the (m, (d_x + 1) * (n_T - 1)) local linear parameters of all of them.
+        """
+        def parameter_estimator_func(Y, T, X,
+                                     nuisance_estimates,
+                                     weights):
+            """Calculate the parameters of interest for a batch of weightings of the points (Y, T)."""
+            # Compute partial moments
+            pointwise_params = DiscreteTreatmentOrthoForest._partial_moments(Y, T, nuisance_estimates)
+            X_aug = PolynomialFeatures(degree=1, include_bias=True).fit_transform(X)
+            # ell_2 regularization
+            diagonal = np.ones(X_aug.shape[1])
+            diagonal[0] = 0
+            # Ridge regression estimates
+            return _batched_weighted_ridge(weights, X_aug, pointwise_params, lambda_reg * diagonal)
+
+        return parameter_estimator_func
+
     @staticmethod
     def moment_and_mean_gradient_estimator_func(Y, T, X, W,
                                                 nuisance_estimates,
@@ -808,18 +1845,43 @@ class DiscreteTreatmentOrthoForest(BaseOrthoForest):
         mean_gradient = np.diag(np.ones(n_T) * (-1))
         return moments, mean_gradient
 
+    @staticmethod
+    def batch_parameter_estimator_func(Y, T, X,
+                                       nuisance_estimates,
+                                       node_ids, n_nodes):
+        """Calculate the parameters of interest of several nodes, given the node of every point (Y, T)."""
+        # Compute partial moments
+        pointwise_params = DiscreteTreatmentOrthoForest._partial_moments(Y, T, nuisance_estimates)
+        counts = np.bincount(node_ids, minlength=n_nodes)
+        # Parameter shape is (n_nodes, d_T-1)
+        return _node_sums(pointwise_params, node_ids, n_nodes) / counts.reshape(-1, 1)
+
+    @staticmethod
+    def batch_moment_and_mean_gradient_estimator_func(Y, T, X, W,
+                                                      nuisance_estimates,
+                                                      parameter_estimates,
+                                                      node_ids, n_nodes):
+        """Calculate the moments at points given by (Y, T, X, W) and the mean gradients of their nodes."""
+        # Compute partial moments
+        partial_moments = DiscreteTreatmentOrthoForest._partial_moments(Y, T, nuisance_estimates)
+        # Compute moments
+        # Moments shape is (n, d_T-1)
+        moments = partial_moments - parameter_estimates[node_ids]
+        # Compute moment gradients, shape is (n_nodes, d_T-1, d_T-1)
+        n_T = nuisance_estimates[0].shape[1] - 1
+        mean_gradients = np.tile(np.diag(np.ones(n_T) * (-1)), (n_nodes, 1, 1))
+        return moments, mean_gradients
+
     @staticmethod
     def _partial_moments(Y, T, nuisance_estimates):
         Y_hat, propensities = nuisance_estimates
-        partial_moments = np.zeros((len(Y), Y_hat.shape[1] - 1))
-        mask_0 = (T == 0)
-        for i in range(0, Y_hat.shape[1] - 1):
-            # Need to calculate this in an elegant way for when propensity is 0
-            partial_moments[:, i] = Y_hat[:, i + 1] - Y_hat[:, 0]
-            mask_i = (T == (i + 1))
-            partial_moments[:, i][mask_i] += (Y - Y_hat[:, i + 1])[mask_i] / propensities[:, i + 1][mask_i]
-            partial_moments[:, i][mask_0] -= (Y - Y_hat[:, 0])[mask_0] / propensities[:, 0][mask_0]
-        return partial_moments
+        T_codes = T.reshape(-1).astype(int)
+        rows = np.arange(len(T_codes))
+        # Inverse propensity weighted residual of every sample, only divided by the propensity of its own
+        # treatment so that zero propensities of the other treatments are never used
+        ipw_residuals = (Y.reshape(-1) - Y_hat[rows, T_codes]) / propensities[rows, T_codes]
+        ohe_T = np.eye(Y_hat.shape[1])[T_codes]
+        return Y_hat[:, 1:] - Y_hat[:, [0]] + (ohe_T[:, 1:] - ohe_T[:, [0]]) * ipw_residuals.reshape(-1, 1)
 
     def _check_treatment(self, T):
         try:
@@ -1,16 +1,20 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import copy
+import os
+import tempfile
 import unittest
 import pytest
 from sklearn.base import TransformerMixin
-from sklearn.linear_model import LinearRegression, Lasso, LogisticRegression
+from sklearn.linear_model import LinearRegression, Lasso, LogisticRegression, Ridge
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OneHotEncoder, FunctionTransformer
+from sklearn.preprocessing import OneHotEncoder, FunctionTransformer, PolynomialFeatures
+from sklearn.exceptions import NotFittedError
 from sklearn.model_selection import KFold
 from econml.dml import DMLCateEstimator, LinearDMLCateEstimator, SparseLinearDMLCateEstimator, KernelDMLCateEstimator
 import numpy as np
-from econml.utilities import shape, hstack, vstack, reshape, cross_product
+from econml.utilities import shape, hstack, vstack, reshape, cross_product, CrossProductOperator, LinearOperatorRidge
 from econml.inference import BootstrapInference
 from contextlib import ExitStack
 
@@ -167,6 +171,30 @@ class TestDML(unittest.TestCase):
                                        [0, 2, 1, -2, 0, -1, -1, 1, 0])
         dml.score(np.array([2, 3, 1, 3, 2, 1, 1, 1]), np.array([3, 2, 1, 2, 3, 1, 1, 1]), np.ones((8, 1)))
 
+    def test_chunked_predict(self):
+        """Test that we can score inputs stored on disk in chunks."""
+        np.random.seed(123)
+        X = np.random.normal(size=(200, 3))
+        T = np.random.normal(size=(200, 2))
+        Y = T[:, 0] * (1 + X[:, 0]) + np.random.normal(size=(200,))
+        dml = LinearDMLCateEstimator(LinearRegression(), LinearRegression(), featurizer=FunctionTransformer())
+        dml.fit(Y, T, X)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            X_disk = np.memmap(os.path.join(temp_dir, 'X.dat'), dtype=float, mode='w+', shape=X.shape)
+            X_disk[:] = X
+            out = np.memmap(os.path.join(temp_dir, 'out.dat'), dtype=float, mode='w+', shape=(200, 2))
+            for n_jobs in [1, 2]:
+                out[:] = 0
+                dml.chunked_predict(X_disk, out, chunk_size=30, n_jobs=n_jobs)
+                np.testing.assert_allclose(out, dml.const_marginal_effect(X))
+            # iterables of blocks and per row treatments
+            effect_out = np.zeros(200)
+            dml.chunked_predict((X[i:i + 50] for i in range(0, 200, 50)), effect_out, method='effect',
+                                T0=0, T1=T)
+            np.testing.assert_allclose(effect_out, dml.effect(X, T0=0, T1=T))
+            with self.assertRaises(ValueError):
+                dml.chunked_predict(X_disk, np.zeros((100, 2)))
+
     def test_can_custom_splitter(self):
         # test that we can fit with a KFold instance
         dml = LinearDMLCateEstimator(LinearRegression(), LogisticRegression(C=1000),
@@ -180,6 +208,146 @@ class TestDML(unittest.TestCase):
         dml.fit(np.array([1, 2, 3, 1, 2, 3]), np.array([1, 2, 3, 1, 2, 3]), np.ones((6, 1)))
         dml.score(np.array([1, 2, 3, 1, 2, 3]), np.array([1, 2, 3, 1, 2, 3]), np.ones((6, 1)))
 
+    def test_refit_final(self):
+        """Test that the final model can be refit without refitting the first stages"""
+        np.random.seed(123)
+        X = np.random.normal(size=(500, 2))
+        W = np.random.normal(size=(500, 3))
+        T = X[:, 0] + W[:, 0] + np.random.normal(size=(500,))
+        Y = T * (1 + X[:, 1] ** 2) + W[:, 1] + np.random.normal(size=(500,))
+
+        def make_dml(degree):
+            return LinearDMLCateEstimator(LinearRegression(), LinearRegression(),
+                                          featurizer=PolynomialFeatures(degree=degree),
+                                          linear_first_stages=False, random_state=123)
+
+        with pytest.raises(NotFittedError):
+            make_dml(1).refit_final()
+        dml = make_dml(1).fit(Y, T, X, W)
+        nuisances = dml.nuisances_
+        dml.featurizer.set_params(degree=2)
+        dml.refit_final(inference='statsmodels')
+        assert dml.nuisances_ is nuisances
+        # the folds and the first stages are the same, so this matches a full fit with the new featurizer
+        full = make_dml(2).fit(Y, T, X, W)
+        np.testing.assert_allclose(dml.const_marginal_effect(X), full.const_marginal_effect(X))
+        lb, ub = dml.const_marginal_effect_interval(X)
+        assert np.all(lb <= ub)
+        # the cached inputs are not copied along with the estimator
+        with pytest.raises(NotFittedError):
+            copy.deepcopy(dml).refit_final()
+
+    def test_nuisance_cache(self):
+        """Test that the cross-fitted residuals are reused across estimators that share a cache"""
+        np.random.seed(123)
+        X = np.random.normal(size=(500, 2))
+        W = np.random.normal(size=(500, 3))
+        T = X[:, 0] + W[:, 0] + np.random.normal(size=(500,))
+        Y = T * (1 + X[:, 1]) + W[:, 1] + np.random.normal(size=(500,))
+        with tempfile.TemporaryDirectory() as cache:
+            def make_dml(linear_first_stages=False, model_y=LinearRegression()):
+                return LinearDMLCateEstimator(model_y, LinearRegression(), featurizer=PolynomialFeatures(degree=1),
+                                              linear_first_stages=linear_first_stages, random_state=123,
+                                              nuisance_cache=cache)
+
+            dml = make_dml().fit(Y, T, X, W)
+            assert len(os.listdir(cache)) == 1
+            cached = make_dml().fit(Y, T, X, W)
+            assert len(os.listdir(cache)) == 1
+            for nuis, cached_nuis in zip(dml.nuisances_, cached.nuisances_):
+                np.testing.assert_array_equal(nuis, cached_nuis)
+            np.testing.assert_array_equal(dml.coef_, cached.coef_)
+            assert len(cached.models_y) == 2
+            # different data or a different first stage create new entries
+            make_dml().fit(Y + 1, T, X, W)
+            make_dml(linear_first_stages=True).fit(Y, T, X, W)
+            make_dml(model_y=Lasso(alpha=0.1)).fit(Y, T, X, W)
+            assert len(os.listdir(cache)) == 4
+
+    def test_repeated_crossfitting(self):
+        """Test that the residuals of several crossfitting draws are aggregated"""
+        np.random.seed(123)
+        X = np.random.normal(size=(500, 2))
+        W = np.random.normal(size=(500, 3))
+        T = X[:, 0] + W[:, 0] + np.random.normal(size=(500,))
+        Y = T * (1 + X[:, 1]) + W[:, 1] + np.random.normal(size=(500,))
+        single = LinearDMLCateEstimator(LinearRegression(), LinearRegression(),
+                                        featurizer=PolynomialFeatures(degree=1),
+                                        linear_first_stages=False, random_state=123).fit(Y, T, X, W)
+        assert single.nuisances_std_ is None
+        for aggregation in ['mean', 'median']:
+            dml = LinearDMLCateEstimator(LinearRegression(), LinearRegression(),
+                                         featurizer=PolynomialFeatures(degree=1), linear_first_stages=False,
+                                         random_state=123, n_crossfit_repeats=3, crossfit_aggregation=aggregation,
+                                         n_jobs=2, backend='threading')
+            dml.fit(Y, T, X, W, inference='statsmodels')
+            assert len(dml.models_y) == len(dml.models_t) == 6
+            for nuis, std in zip(dml.nuisances_, dml.nuisances_std_):
+                assert std.shape == nuis.shape
+                assert np.all(std >= 0) and np.any(std > 0)
+            np.testing.assert_allclose(dml.coef_, single.coef_, atol=0.1)
+            lb, ub = dml.coef__interval()
+            assert np.all(lb <= ub)
+        with pytest.raises(ValueError):
+            LinearDMLCateEstimator(n_crossfit_repeats=0)
+        with pytest.raises(ValueError):
+            LinearDMLCateEstimator(crossfit_aggregation='max')
+
+    def test_first_stage_design(self):
+        """Test that the features of both first stage models are built once and shared"""
+        np.random.seed(123)
+        X = np.random.normal(size=(100, 2))
+        W = np.random.normal(size=(100, 3))
+        T = X[:, 0] + W[:, 0] + np.random.normal(size=(100,))
+        Y = T * (1 + X[:, 1]) + W[:, 1] + np.random.normal(size=(100,))
+        XW = np.hstack([X, W])
+        for linear_first_stages in [False, True]:
+            dml = DMLCateEstimator(LinearRegression(), LinearRegression(), LinearRegression(fit_intercept=False),
+                                   featurizer=PolynomialFeatures(degree=2), linear_first_stages=linear_first_stages)
+            design, controls = dml._nuisance_features(X, W, 100)
+            assert controls is None
+            if linear_first_stages:
+                F = PolynomialFeatures(degree=2).fit_transform(X)
+                np.testing.assert_allclose(design.features, cross_product(XW, np.hstack([np.ones((100, 1)), F, W])))
+            else:
+                np.testing.assert_array_equal(design.features, XW)
+            # the treatment model only uses the raw features and controls
+            np.testing.assert_array_equal(design.features[:, :design.n_xw], XW)
+            np.testing.assert_array_equal(design[[0, 2]].features, design.features[[0, 2]])
+
+            dml.fit(Y, T, X, W)
+            assert all(mdl.coef_.shape[-1] == design.shape[1] for mdl in dml.models_y)
+            assert all(mdl.coef_.shape[-1] == XW.shape[1] for mdl in dml.models_t)
+            dml.score(Y, T, X, W)
+
+        # without features the constant takes their place
+        design, _ = dml._nuisance_features(None, W, 100)
+        np.testing.assert_array_equal(design.features[:, :design.n_xw], np.hstack([np.ones((100, 1)), W]))
+
+    def test_implicit_first_stage_interactions(self):
+        """Test that first stage models that accept linear operators never materialize the interactions"""
+        np.random.seed(123)
+        X = np.random.normal(size=(200, 2))
+        W = np.random.normal(size=(200, 3))
+        T = X[:, 0] + W[:, 0] + np.random.normal(size=(200,))
+        Y = T * (1 + X[:, 1]) + W[:, 1] * X[:, 0] + np.random.normal(size=(200,))
+        implicit = LinearDMLCateEstimator(LinearOperatorRidge(alpha=1, tol=1e-12), Ridge(alpha=1),
+                                          linear_first_stages=True, n_splits=KFold(2))
+        dense = LinearDMLCateEstimator(Ridge(alpha=1), Ridge(alpha=1),
+                                       linear_first_stages=True, n_splits=KFold(2))
+        design, _ = implicit._nuisance_features(X, W, 200)
+        assert isinstance(design.features, CrossProductOperator)
+        np.testing.assert_array_equal(design.xw, np.hstack([X, W]))
+        np.testing.assert_allclose(design.features.toarray(), dense._nuisance_features(X, W, 200)[0].features)
+
+        implicit.fit(Y, T, X, W)
+        dense.fit(Y, T, X, W)
+        for mdl_implicit, mdl_dense in zip(implicit.models_y, dense.models_y):
+            np.testing.assert_allclose(mdl_implicit.coef_, mdl_dense.coef_, atol=1e-6)
+        np.testing.assert_allclose(implicit.coef_, dense.coef_, atol=1e-6)
+        np.testing.assert_allclose(implicit.intercept_, dense.intercept_, atol=1e-6)
+        implicit.score(Y, T, X, W)
+
     def test_can_use_statsmodel_inference(self):
         """Test that we can use statsmodels to generate confidence intervals"""
         dml = LinearDMLCateEstimator(LinearRegression(), LogisticRegression(C=1000),
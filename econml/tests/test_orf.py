@@ -3,7 +3,9 @@
 
 import numpy as np
 import unittest
+import unittest.mock
 import pytest
+import tempfile
 import warnings
 from numpy.random import binomial, choice, normal, uniform
 from sklearn.exceptions import DataConversionWarning
@@ -11,7 +13,10 @@ from sklearn.linear_model import LinearRegression, Lasso, LassoCV, LogisticRegre
 from sklearn.multioutput import MultiOutputRegressor
 from sklearn.pipeline import Pipeline
 from econml.ortho_forest import ContinuousTreatmentOrthoForest, DiscreteTreatmentOrthoForest, \
-    WeightedModelWrapper
+    WeightedModelWrapper, _group_cross_fit
+from econml.causal_tree import CausalTree
+from econml.inference import BLBInference
+import econml.causal_tree
 
 
 class TestOrthoForest(unittest.TestCase):
@@ -153,6 +158,559 @@ class TestOrthoForest(unittest.TestCase):
         expected_te = np.array([TestOrthoForest.expected_exp_te, TestOrthoForest.expected_const_te]).T
         self._test_te(est, expected_te, tol=0.5, treatment_type='multi')
 
+    def test_discrete_treatment_nuisances(self):
+        np.random.seed(123)
+        n, n_T = 60, 3
+        X = np.random.normal(size=(n, 2))
+        T = np.random.choice(n_T, size=n)
+        Y = X[:, 0] + T + np.random.normal(size=n)
+        ohe_T = np.eye(n_T)[T]
+        split_indices = (np.arange(0, n, 2), np.arange(1, n, 2))
+        # The stacked prediction of all the arms matches a prediction per arm
+        for sample_weight in [None, np.random.uniform(1, 2, size=n)]:
+            expected = np.zeros((n, n_T))
+            for split, other in [split_indices, split_indices[::-1]]:
+                model = LinearRegression().fit(np.hstack((X, ohe_T))[other], Y[other],
+                                               sample_weight=None if sample_weight is None else sample_weight[other])
+                for t in range(n_T):
+                    expected[split, t] = model.predict(np.hstack((X[split], np.tile(np.eye(n_T)[t], (len(split), 1)))))
+            np.testing.assert_allclose(_group_cross_fit(LinearRegression(), X, Y, ohe_T, split_indices,
+                                                        sample_weight=sample_weight), expected)
+        # The gathered moments match a masked loop over the arms, even with zero propensities of the other arms
+        Y_hat = np.random.normal(size=(n, n_T))
+        propensities = np.random.uniform(.1, 1, size=(n, n_T))
+        propensities[np.arange(n), (T + 1) % n_T] = 0
+        expected = np.zeros((n, n_T - 1))
+        for i in range(n_T - 1):
+            expected[:, i] = Y_hat[:, i + 1] - Y_hat[:, 0]
+            mask_i, mask_0 = T == i + 1, T == 0
+            expected[mask_i, i] += (Y - Y_hat[:, i + 1])[mask_i] / propensities[mask_i, i + 1]
+            expected[mask_0, i] -= (Y - Y_hat[:, 0])[mask_0] / propensities[mask_0, 0]
+        np.testing.assert_allclose(DiscreteTreatmentOrthoForest._partial_moments(Y, T, (Y_hat, propensities)),
+                                   expected)
+        # Nodes that miss an arm, or that cannot be stratified because an arm has a single member, are not estimated
+        nuisance_estimator = DiscreteTreatmentOrthoForest.nuisance_estimator_generator(
+            LogisticRegression(), LinearRegression(), n_T, random_state=123)
+        self.assertIsNotNone(nuisance_estimator(Y, T, X, None))
+        missing = T != 2
+        self.assertIsNone(nuisance_estimator(Y[missing], T[missing], X[missing], None))
+        single = np.concatenate((np.flatnonzero(T != 2), np.flatnonzero(T == 2)[:1]))
+        self.assertIsNone(nuisance_estimator(Y[single], T[single], X[single], None))
+
+    def test_causal_tree_apply(self):
+        np.random.seed(123)
+        X = TestOrthoForest.X
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        for split_finder in ['random', 'histogram']:
+            tree = CausalTree(
+                nuisance_estimator=ContinuousTreatmentOrthoForest.nuisance_estimator_generator(
+                    LinearRegression(), LinearRegression(), random_state=123, second_stage=False),
+                parameter_estimator=ContinuousTreatmentOrthoForest.parameter_estimator_func,
+                moment_and_mean_gradient_estimator=(
+                    ContinuousTreatmentOrthoForest.moment_and_mean_gradient_estimator_func),
+                min_leaf_size=20, split_finder=split_finder, random_state=123)
+            tree.create_splits(Y, T, X, None)
+            self.assertGreater(len(tree.leaf_est_indptr) - 1, 1)
+            x_test = np.concatenate((X[:50], TestOrthoForest.x_test))
+            leaves = tree.apply(x_test)
+            for x, leaf in zip(x_test, leaves):
+                np.testing.assert_array_equal(tree.find_split(x).est_sample_inds, tree.leaf_est_sample_inds(leaf))
+            # The estimation samples of each leaf must be routed back to that leaf
+            est_leaves = tree.apply(X[tree.leaf_est_inds])
+            np.testing.assert_array_equal(est_leaves, np.repeat(np.arange(len(tree.leaf_est_indptr) - 1),
+                                                                np.diff(tree.leaf_est_indptr)))
+
+    def test_causal_tree_invalid_parameters(self):
+        estimators = dict(
+            nuisance_estimator=ContinuousTreatmentOrthoForest.nuisance_estimator_generator(
+                LinearRegression(), LinearRegression(), random_state=123, second_stage=False),
+            parameter_estimator=ContinuousTreatmentOrthoForest.parameter_estimator_func,
+            moment_and_mean_gradient_estimator=ContinuousTreatmentOrthoForest.moment_and_mean_gradient_estimator_func)
+        for params in [{'split_finder': 'exact'}, {'max_bins': 1}, {'max_bins': 257},
+                       {'nuisance_scope': 'leaf'}, {'growth': 'best_first'}]:
+            with self.subTest(params=params):
+                with pytest.raises(ValueError):
+                    CausalTree(**estimators, **params)
+        # The extremes of the valid range of bins are accepted
+        for max_bins in [2, 256]:
+            CausalTree(**estimators, split_finder='histogram', max_bins=max_bins)
+
+    @pytest.mark.skipif(econml.causal_tree._score_random_splits is None, reason="numba is not installed")
+    def test_numba_split_kernel(self):
+        # The compiled split scoring kernel must grow the same trees as the NumPy implementation
+        X = TestOrthoForest.X
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        kernel = econml.causal_tree._score_random_splits
+        trees = []
+        try:
+            for score_random_splits in [kernel, None]:
+                econml.causal_tree._score_random_splits = score_random_splits
+                np.random.seed(123)
+                tree = CausalTree(
+                    nuisance_estimator=ContinuousTreatmentOrthoForest.nuisance_estimator_generator(
+                        LinearRegression(), LinearRegression(), random_state=123, second_stage=False),
+                    parameter_estimator=ContinuousTreatmentOrthoForest.parameter_estimator_func,
+                    moment_and_mean_gradient_estimator=(
+                        ContinuousTreatmentOrthoForest.moment_and_mean_gradient_estimator_func),
+                    min_leaf_size=20, random_state=123)
+                tree.create_splits(Y, T, X, None)
+                trees.append(tree)
+        finally:
+            econml.causal_tree._score_random_splits = kernel
+        np.testing.assert_array_equal(trees[0].feature, trees[1].feature)
+        np.testing.assert_array_equal(trees[0].threshold, trees[1].threshold)
+        np.testing.assert_array_equal(trees[0].leaf_est_inds, trees[1].leaf_est_inds)
+
+    def test_forest_kernel(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        for bootstrap in [False, True]:
+            est = ContinuousTreatmentOrthoForest(n_trees=5, min_leaf_size=20, bootstrap=bootstrap, n_jobs=1,
+                                                 model_T=LinearRegression(), model_Y=LinearRegression(),
+                                                 random_state=123)
+            est.fit(Y, T, TestOrthoForest.X)
+            weights = est.forest_kernel(TestOrthoForest.x_test)
+            self.assertSequenceEqual((TestOrthoForest.x_test.shape[0], TestOrthoForest.n), weights.shape)
+            np.testing.assert_allclose(weights.sum(axis=1), 2)
+            for x, row in zip(TestOrthoForest.x_test, weights.toarray()):
+                expected = []
+                forests = [(est.forest_one_trees, est.forest_one_subsample_ind, est.Y_one),
+                           (est.forest_two_trees, est.forest_two_subsample_ind, est.Y_two)]
+                for trees, subsample_ind, Y_half in forests:
+                    w = np.zeros(Y_half.shape[0])
+                    for t, tree in enumerate(trees):
+                        est_inds = tree.find_split(x).est_sample_inds
+                        np.add.at(w, subsample_ind[t][est_inds], 1 / len(est_inds))
+                    expected.append(w / len(trees))
+                np.testing.assert_allclose(row, np.concatenate(expected))
+
+    def test_global_residualization(self):
+        np.random.seed(123)
+        TE = np.array([self._exp_te(x) for x in TestOrthoForest.X])
+        # Continuous treatments
+        T = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_T) + \
+            TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_Y) + \
+            T * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=20, min_leaf_size=10, max_depth=50, subsample_ratio=0.30,
+                                             n_jobs=1, global_residualization=True,
+                                             model_T=Lasso(alpha=0.024), model_Y=Lasso(alpha=0.024),
+                                             model_T_final=LassoCV(cv=3), model_Y_final=LassoCV(cv=3),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        Y_hat, T_hat = est.global_nuisance_estimates
+        self.assertSequenceEqual((TestOrthoForest.n,), Y_hat.shape)
+        self.assertSequenceEqual((TestOrthoForest.n,), T_hat.shape)
+        self._test_te(est, TestOrthoForest.expected_exp_te, tol=0.5)
+        self._test_batch_effect(est)
+        # Binary treatments
+        log_odds = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_T) + \
+            TestOrthoForest.eta_sample(TestOrthoForest.n)
+        T = np.random.binomial(1, 1 / (1 + np.exp(-log_odds)))
+        Y = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_Y) + \
+            T * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = DiscreteTreatmentOrthoForest(n_trees=20, min_leaf_size=10, max_depth=30, subsample_ratio=0.30,
+                                           n_jobs=1, global_residualization=True,
+                                           propensity_model=LogisticRegression(C=1 / 0.024, solver='liblinear',
+                                                                               penalty='l1'),
+                                           model_Y=Lasso(alpha=0.024),
+                                           random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        Y_hat, propensities = est.global_nuisance_estimates
+        self.assertSequenceEqual((TestOrthoForest.n, 2), Y_hat.shape)
+        self.assertSequenceEqual((TestOrthoForest.n, 2), propensities.shape)
+        self._test_te(est, TestOrthoForest.expected_exp_te, tol=0.7, treatment_type='discrete')
+        self._test_batch_effect(est)
+
+    def test_root_nuisance_scope(self):
+        np.random.seed(123)
+        TE = np.array([self._exp_te(x) for x in TestOrthoForest.X])
+        T = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_T) + \
+            TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_Y) + \
+            T * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=20, min_leaf_size=10, max_depth=50, subsample_ratio=0.30,
+                                             n_jobs=1, nuisance_scope='root', global_residualization=True,
+                                             model_T=Lasso(alpha=0.024), model_Y=Lasso(alpha=0.024),
+                                             model_T_final=LassoCV(cv=3), model_Y_final=LassoCV(cv=3),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        self.assertTrue(all(len(tree.leaf_est_indptr) > 2 for tree in est.forest_one_trees))
+        self._test_te(est, TestOrthoForest.expected_exp_te, tol=0.5)
+        log_odds = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_T) + \
+            TestOrthoForest.eta_sample(TestOrthoForest.n)
+        T = np.random.binomial(1, 1 / (1 + np.exp(-log_odds)))
+        Y = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_Y) + \
+            T * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = DiscreteTreatmentOrthoForest(n_trees=20, min_leaf_size=10, max_depth=30, subsample_ratio=0.30,
+                                           n_jobs=1, nuisance_scope='root', global_residualization=True,
+                                           propensity_model=LogisticRegression(C=1 / 0.024, solver='liblinear',
+                                                                               penalty='l1'),
+                                           model_Y=Lasso(alpha=0.024),
+                                           random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        self._test_te(est, TestOrthoForest.expected_exp_te, tol=0.7, treatment_type='discrete')
+
+    def test_level_growth(self):
+        np.random.seed(123)
+        TE = np.array([self._exp_te(x) for x in TestOrthoForest.X])
+        T = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_T) + \
+            TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_Y) + \
+            T * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        log_odds = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_T) + \
+            TestOrthoForest.eta_sample(TestOrthoForest.n)
+        T_discrete = np.random.binomial(1, 1 / (1 + np.exp(-log_odds)))
+        Y_discrete = np.dot(TestOrthoForest.W[:, TestOrthoForest.support], TestOrthoForest.coefs_Y) + \
+            T_discrete * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        for treatment_type, Y, T in [('continuous', Y, T), ('discrete', Y_discrete, T_discrete)]:
+            forests = []
+            for batched in [True, False]:
+                if treatment_type == 'continuous':
+                    est = ContinuousTreatmentOrthoForest(n_trees=20, min_leaf_size=10, max_depth=50,
+                                                         subsample_ratio=0.30, n_jobs=1, nuisance_scope='root',
+                                                         growth='level', global_residualization=True,
+                                                         model_T=Lasso(alpha=0.024), model_Y=Lasso(alpha=0.024),
+                                                         random_state=123)
+                else:
+                    est = DiscreteTreatmentOrthoForest(n_trees=20, min_leaf_size=10, max_depth=30,
+                                                       subsample_ratio=0.30, n_jobs=1, nuisance_scope='root',
+                                                       growth='level', global_residualization=True,
+                                                       propensity_model=LogisticRegression(
+                                                           C=1 / 0.024, solver='liblinear', penalty='l1'),
+                                                       model_Y=Lasso(alpha=0.024),
+                                                       random_state=123)
+                if not batched:
+                    # Fall back to the per node estimators on the stacked level
+                    est.batch_parameter_estimator = None
+                est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+                forests.append(est.forest_one_trees + est.forest_two_trees)
+            for batched_tree, tree in zip(*forests):
+                self.assertGreater(len(batched_tree.leaf_est_indptr), 2)
+                np.testing.assert_array_equal(batched_tree.feature, tree.feature)
+                np.testing.assert_allclose(batched_tree.threshold, tree.threshold)
+            tol = 0.5 if treatment_type == 'continuous' else 0.7
+            self._test_te(est, TestOrthoForest.expected_exp_te, tol=tol, treatment_type=treatment_type)
+
+    def test_leaf_cache(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=5, min_leaf_size=20, n_jobs=1, leaf_cache_size=8,
+                                             model_T=LinearRegression(), model_Y=LinearRegression(),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        # Every query is duplicated, so that half of the queries are served by the cache
+        x_test = np.concatenate((TestOrthoForest.x_test, TestOrthoForest.x_test))
+        cached_te = est.const_marginal_effect(x_test)
+        self.assertEqual(est.cache_hits + est.cache_misses, x_test.shape[0])
+        self.assertGreaterEqual(est.cache_hits, TestOrthoForest.x_test.shape[0])
+        self.assertLessEqual(len(est._leaf_cache), 8)
+        np.testing.assert_allclose(cached_te[:TestOrthoForest.x_test.shape[0]],
+                                   cached_te[TestOrthoForest.x_test.shape[0]:])
+        # The weights and the cache signatures share a single traversal of every tree
+        with unittest.mock.patch.object(CausalTree, 'apply', autospec=True, side_effect=CausalTree.apply) as apply:
+            est.const_marginal_effect(x_test)
+        self.assertEqual(apply.call_count, len(est.forest_one_trees) + len(est.forest_two_trees))
+        # Blocks predicted by concurrent threads share the cache
+        est.clear_cache()
+        x_many = np.tile(x_test, (10, 1))
+        out = est.chunked_predict(x_many, np.zeros((x_many.shape[0],) + cached_te.shape[1:]), chunk_size=7, n_jobs=4)
+        np.testing.assert_allclose(out, np.tile(cached_te, (10, 1)))
+        self.assertEqual(est.cache_hits + est.cache_misses, x_many.shape[0])
+        self.assertLessEqual(len(est._leaf_cache), 8)
+        est.leaf_cache_size = 0
+        np.testing.assert_allclose(est.const_marginal_effect(x_test), cached_te)
+        # Refitting invalidates the cache
+        est.leaf_cache_size = 8
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        self.assertEqual(len(est._leaf_cache), 0)
+        self.assertEqual(est.cache_hits + est.cache_misses, 0)
+
+    def test_warm_start(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=3, min_leaf_size=20, n_jobs=1, warm_start=True,
+                                             model_T=LinearRegression(), model_Y=LinearRegression(),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        trees = est.forest_one_trees + est.forest_two_trees
+        subsample_ind = est.forest_one_subsample_ind
+        X_one = est.X_one
+        est.n_trees = 6
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        # The existing trees are kept and only the missing ones are built
+        self.assertEqual(len(est.forest_one_trees), 6)
+        self.assertEqual(len(est.forest_two_trees), 6)
+        self.assertTrue(all(a is b for a, b in zip(trees, est.forest_one_trees[:3] + est.forest_two_trees[:3])))
+        np.testing.assert_array_equal(est.forest_one_subsample_ind[:3], subsample_ind)
+        np.testing.assert_array_equal(est.X_one, X_one)
+        self.assertSequenceEqual(est.const_marginal_effect(TestOrthoForest.x_test).shape,
+                                 (TestOrthoForest.x_test.shape[0], 1))
+        est.n_trees = 2
+        self.assertRaises(ValueError, est.fit, Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        # Without warm start the forests are rebuilt from scratch
+        est.warm_start = False
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        self.assertEqual(len(est.forest_one_trees), 2)
+        # A forest grown in bags cannot be extended with trees grown in bags of another size
+        est = ContinuousTreatmentOrthoForest(n_trees=4, min_leaf_size=20, n_jobs=1, warm_start=True,
+                                             model_T=LinearRegression(), model_Y=LinearRegression(),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W, inference=BLBInference(bag_size=2))
+        est.n_trees = 8
+        self.assertRaises(ValueError, est.fit, Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        self.assertRaises(ValueError, est.fit, Y, T, TestOrthoForest.X, TestOrthoForest.W,
+                          inference=BLBInference(bag_size=4))
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W, inference=BLBInference(bag_size=2))
+        self.assertEqual(len(est.forest_one_trees), 8)
+
+    def test_save_load(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=4, min_leaf_size=20, n_jobs=1, global_residualization=True,
+                                             model_T=LinearRegression(), model_Y=LinearRegression(),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W, inference='auto')
+        te = est.const_marginal_effect(TestOrthoForest.x_test)
+        lower, upper = est.const_marginal_effect_interval(TestOrthoForest.x_test)
+        with tempfile.TemporaryDirectory() as path:
+            est.save(path)
+            for mmap in [True, False]:
+                loaded = ContinuousTreatmentOrthoForest.load(path, mmap=mmap)
+                self.assertEqual(isinstance(loaded.X_one, np.memmap), mmap)
+                self.assertEqual(isinstance(loaded.forest_one_trees[0].feature, np.memmap), mmap)
+                self.assertEqual(loaded.forest_one_subsample_ind.dtype, np.int32)
+                np.testing.assert_array_equal(loaded.const_marginal_effect(TestOrthoForest.x_test), te)
+                # The inference refers to the loaded estimator
+                loaded_lower, loaded_upper = loaded.const_marginal_effect_interval(TestOrthoForest.x_test)
+                np.testing.assert_allclose(loaded_lower, lower)
+                np.testing.assert_allclose(loaded_upper, upper)
+            self.assertRaises(ValueError, DiscreteTreatmentOrthoForest.load, path)
+        # Discrete treatments, with local residualization
+        T = np.random.binomial(1, 0.5, size=TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = DiscreteTreatmentOrthoForest(n_trees=4, min_leaf_size=20, n_jobs=1,
+                                           propensity_model=LogisticRegression(), model_Y=LinearRegression(),
+                                           random_state=123)
+        est.fit(Y, T, TestOrthoForest.X)
+        with tempfile.TemporaryDirectory() as path:
+            est.save(path)
+            loaded = DiscreteTreatmentOrthoForest.load(path)
+            self.assertIsNone(loaded.W_one)
+            np.testing.assert_array_equal(loaded.effect(TestOrthoForest.x_test, T0=0, T1=1),
+                                          est.effect(TestOrthoForest.x_test, T0=0, T1=1))
+
+    def test_profile(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        for global_residualization in [True, False]:
+            est = ContinuousTreatmentOrthoForest(n_trees=2, min_leaf_size=20, n_jobs=1, profile=True,
+                                                 global_residualization=global_residualization,
+                                                 model_T=LinearRegression(), model_Y=LinearRegression(),
+                                                 random_state=123)
+            est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+            report = est.profiler.report()
+            for phase in ['build_trees', 'node_nuisance', 'node_parameter', 'split_search']:
+                self.assertGreater(report[phase]['n_calls'], 0)
+                self.assertGreater(report[phase]['wall_time'], 0)
+            # The nuisances of the root of a tree are estimated on half of its subsample
+            self.assertGreaterEqual(report['node_nuisance']['n_rows'], est.forest_one_subsample_ind.shape[1] // 2)
+            est.const_marginal_effect(TestOrthoForest.x_test)
+            report = est.profiler.report()
+            self.assertEqual(report['weights']['n_rows'], TestOrthoForest.x_test.shape[0])
+            n_solves = 1 if global_residualization else TestOrthoForest.x_test.shape[0]
+            self.assertEqual(report['second_stage_solve']['n_calls'], n_solves)
+            self.assertEqual(report['second_stage_nuisance']['n_calls'], n_solves)
+            # A new fit starts a new profile
+            est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+            self.assertNotIn('weights', est.profiler.report())
+        # Nothing is recorded by default
+        est = ContinuousTreatmentOrthoForest(n_trees=2, min_leaf_size=20, n_jobs=1,
+                                             model_T=LinearRegression(), model_Y=LinearRegression())
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        self.assertEqual(len(est.profiler.report()), 0)
+
+    def test_deduplicate(self):
+        np.random.seed(123)
+        X = np.round(TestOrthoForest.X, 1)
+        T = np.random.binomial(1, 0.5, size=TestOrthoForest.n)
+        Y = T * X[:, 0] + np.random.binomial(1, 0.5, size=TestOrthoForest.n)
+        for global_residualization in [True, False]:
+            te = []
+            for deduplicate in [False, True]:
+                est = ContinuousTreatmentOrthoForest(n_trees=4, min_leaf_size=20, n_jobs=1,
+                                                     global_residualization=global_residualization,
+                                                     deduplicate=deduplicate,
+                                                     model_T=LinearRegression(), model_Y=LinearRegression(),
+                                                     random_state=123)
+                est.fit(Y, T, X)
+                te.append(est.const_marginal_effect(TestOrthoForest.x_test))
+            # Only the unique rows of each half are kept
+            self.assertLessEqual(est.X_one.shape[0], 2 * 11 * 2)
+            self.assertEqual(np.sum(est.counts_one) + np.sum(est.counts_two), TestOrthoForest.n)
+            self.assertLess(est.forest_one_subsample_ind.max(), est.X_one.shape[0])
+            # The estimates do not change
+            np.testing.assert_allclose(te[1], te[0], rtol=1e-5, atol=1e-8)
+
+    def test_weight_truncation(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=5, min_leaf_size=20, n_jobs=1,
+                                             model_T=LinearRegression(), model_Y=LinearRegression(),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        exact_te = est.const_marginal_effect(TestOrthoForest.x_test)
+        np.testing.assert_array_equal(est.retained_weight_mass(TestOrthoForest.x_test), 1)
+        # Keeping the whole support does not change the estimates
+        est.max_support = TestOrthoForest.n
+        np.testing.assert_allclose(est.const_marginal_effect(TestOrthoForest.x_test), exact_te)
+        np.testing.assert_allclose(est.retained_weight_mass(TestOrthoForest.x_test), 1)
+        est.max_support = 30
+        est.weight_tol = 1e-3
+        weights = est._truncated_forest_kernel(TestOrthoForest.x_test)[0]
+        n_one = est.Y_one.shape[0]
+        self.assertLessEqual(np.max((weights[:, :n_one] > 0).sum(axis=1)), 30)
+        self.assertLessEqual(np.max((weights[:, n_one:] > 0).sum(axis=1)), 30)
+        self.assertGreaterEqual(weights[:, n_one:].data.min(), 1e-3)
+        # The truncated weights of each half are renormalized
+        np.testing.assert_allclose(weights[:, :n_one].sum(axis=1), 1)
+        retained = est.retained_weight_mass(TestOrthoForest.x_test)
+        self.assertTrue(np.all((retained > 0) & (retained < 1)))
+        truncated_te = est.const_marginal_effect(TestOrthoForest.x_test)
+        self.assertSequenceEqual(truncated_te.shape, exact_te.shape)
+
+    def test_blb_inference(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        TE = np.array([self._exp_te(x) for x in TestOrthoForest.X])
+        Y = T * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=40, min_leaf_size=10, max_depth=50, subsample_ratio=0.5,
+                                             n_jobs=1, nuisance_scope='root', global_residualization=True,
+                                             model_T=LinearRegression(), model_Y=LinearRegression(),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, inference=BLBInference(bag_size=4))
+        # The trees of a bag share a half of the samples
+        bag = np.unique(est.forest_one_subsample_ind[:4])
+        self.assertLessEqual(bag.shape[0], est.Y_one.shape[0] // 2)
+        te = est.const_marginal_effect(TestOrthoForest.x_test)
+        lower, upper = est.const_marginal_effect_interval(TestOrthoForest.x_test, alpha=0.05)
+        self.assertSequenceEqual(lower.shape, te.shape)
+        # The clipped variance can vanish, so the bounds may touch the point estimates
+        self.assertTrue(np.all(lower <= te) and np.all(te <= upper))
+        eff_lower, eff_upper = est.effect_interval(TestOrthoForest.x_test, T0=0, T1=2, alpha=0.05)
+        self.assertSequenceEqual(eff_lower.shape, est.effect(TestOrthoForest.x_test, T0=0, T1=2).shape)
+        np.testing.assert_allclose(eff_lower, 2 * lower)
+        np.testing.assert_allclose(eff_upper, 2 * upper)
+        # Bags must hold an even number of trees
+        self.assertRaises(ValueError, BLBInference, bag_size=3)
+        # The trees must fill complete bags
+        est.n_trees = 42
+        self.assertRaises(ValueError, est.fit, Y, T, TestOrthoForest.X, inference=BLBInference(bag_size=4))
+        # Without bags, the intervals are not available
+        est.n_trees = 40
+        est.fit(Y, T, TestOrthoForest.X)
+        self.assertRaises(ValueError, est._bag_const_marginal_effects, TestOrthoForest.x_test)
+
+    @pytest.mark.slow
+    def test_blb_coverage(self):
+        # On a known linear effect, the corrected BLB standard errors must match the spread of the
+        # point estimates across replications, while the raw spread of the bag estimates overstates it
+        x_test = np.arange(0.25, 0.8, 0.1).reshape(-1, 1)
+        true_te = 1 + x_test[:, 0]
+        n, n_reps = 1000, 20
+        points, std_errs, raw_std_errs = [], [], []
+        for seed in range(n_reps):
+            np.random.seed(seed)
+            X = uniform(0, 1, size=(n, 1))
+            W = normal(size=(n, 3))
+            T = W[:, 0] + uniform(-1, 1, size=n)
+            Y = (1 + X[:, 0]) * T + W[:, 1] + uniform(-1, 1, size=n)
+            est = ContinuousTreatmentOrthoForest(n_trees=200, min_leaf_size=10, max_depth=50, subsample_ratio=0.5,
+                                                 n_jobs=1, nuisance_scope='root', global_residualization=True,
+                                                 model_T=LinearRegression(), model_Y=LinearRegression(),
+                                                 random_state=seed)
+            est.fit(Y, T, X, W, inference=BLBInference(bag_size=10))
+            lower, upper = est.const_marginal_effect_interval(x_test, alpha=0.05)
+            point, half_effects = est._bag_const_marginal_effects(x_test)
+            np.testing.assert_allclose((lower + upper) / 2, point)
+            points.append(point[:, 0])
+            std_errs.append((upper - lower)[:, 0] / (2 * 1.959964))
+            raw_std_errs.append(np.std(np.mean(half_effects, axis=1), axis=0, ddof=1)[:, 0])
+        points, std_errs, raw_std_errs = np.array(points), np.array(std_errs), np.array(raw_std_errs)
+        ratio = np.mean(std_errs) / np.mean(np.std(points, axis=0))
+        self.assertGreater(ratio, 0.7)
+        self.assertLess(ratio, 1.5)
+        self.assertLess(np.mean(std_errs), np.mean(raw_std_errs))
+        covered = (points - 1.959964 * std_errs <= true_te) & (true_te <= points + 1.959964 * std_errs)
+        self.assertGreaterEqual(np.mean(covered), 0.75)
+
+    def test_sandwich_inference(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        TE = np.array([self._exp_te(x) for x in TestOrthoForest.X])
+        Y = T * TE + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        for global_residualization in [True, False]:
+            est = ContinuousTreatmentOrthoForest(n_trees=20, min_leaf_size=10, max_depth=50, subsample_ratio=0.5,
+                                                 n_jobs=1, nuisance_scope='root',
+                                                 global_residualization=global_residualization,
+                                                 model_T=LinearRegression(), model_Y=LinearRegression(),
+                                                 profile=True, random_state=123)
+            est.fit(Y, T, TestOrthoForest.X, inference='auto')
+            te = est.const_marginal_effect(TestOrthoForest.x_test)
+            n_calls = {phase: est.profiler.report()[phase]['n_calls']
+                       for phase in ['second_stage_solve', 'second_stage_nuisance']}
+            lower, upper = est.const_marginal_effect_interval(TestOrthoForest.x_test, alpha=0.05)
+            # The covariances are estimated by the second stage engine, pointwise without global residuals
+            n_solves = 1 if global_residualization else TestOrthoForest.x_test.shape[0]
+            report = est.profiler.report()
+            self.assertEqual(report['second_stage_solve']['n_calls'], n_calls['second_stage_solve'] + n_solves)
+            self.assertEqual(report['second_stage_nuisance']['n_calls'],
+                             n_calls['second_stage_nuisance'] + (0 if global_residualization else n_solves))
+            # and on any backend
+            est.n_jobs, est.predict_backend = 2, 'loky'
+            loky_lower, loky_upper = est.const_marginal_effect_interval(TestOrthoForest.x_test, alpha=0.05)
+            np.testing.assert_allclose(loky_lower, lower)
+            np.testing.assert_allclose(loky_upper, upper)
+            self.assertSequenceEqual(lower.shape, te.shape)
+            # The intervals are centered on the point estimates
+            np.testing.assert_allclose((lower + upper) / 2, te, atol=1e-6)
+            self.assertTrue(np.all(lower < te) and np.all(te < upper))
+            self.assertGreaterEqual(np.mean((lower[:, 0] <= TestOrthoForest.expected_exp_te) &
+                                            (TestOrthoForest.expected_exp_te <= upper[:, 0])), 0.7)
+            eff_lower, eff_upper = est.effect_interval(TestOrthoForest.x_test, T0=0, T1=2, alpha=0.05)
+            self.assertSequenceEqual(eff_lower.shape, est.effect(TestOrthoForest.x_test, T0=0, T1=2).shape)
+            np.testing.assert_allclose(eff_lower, 2 * lower)
+            np.testing.assert_allclose(eff_upper, 2 * upper)
+
+    def test_process_predict_backend(self):
+        np.random.seed(123)
+        T = TestOrthoForest.eta_sample(TestOrthoForest.n)
+        Y = T * np.exp(2 * TestOrthoForest.X[:, 0]) + TestOrthoForest.epsilon_sample(TestOrthoForest.n)
+        est = ContinuousTreatmentOrthoForest(n_trees=5, min_leaf_size=20, n_jobs=2,
+                                             model_T=LinearRegression(), model_Y=LinearRegression(),
+                                             random_state=123)
+        est.fit(Y, T, TestOrthoForest.X, TestOrthoForest.W)
+        threading_te = est.const_marginal_effect(TestOrthoForest.x_test)
+        est.predict_backend = 'loky'
+        np.testing.assert_allclose(est.const_marginal_effect(TestOrthoForest.x_test), threading_te)
+
+    def _test_batch_effect(self, learner_instance):
+        # The batched second stage solver must agree with the pointwise one
+        batch_te = learner_instance.const_marginal_effect(TestOrthoForest.x_test)
+        batch_estimator = learner_instance.second_stage_batch_parameter_estimator
+        learner_instance.second_stage_batch_parameter_estimator = None
+        pointwise_te = learner_instance.const_marginal_effect(TestOrthoForest.x_test)
+        learner_instance.second_stage_batch_parameter_estimator = batch_estimator
+        np.testing.assert_allclose(batch_te, pointwise_te)
+
     def _test_te(self, learner_instance, expected_te, tol, treatment_type='continuous'):
         # Compute the treatment effect on test points
         te_hat = learner_instance.const_marginal_effect(
@@ -1,7 +1,7 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
-from econml._ortho_learner import _OrthoLearner, _crossfit
+from econml._ortho_learner import _OrthoLearner, _crossfit, _repeated_crossfit
 from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import PolynomialFeatures
 from sklearn.linear_model import LinearRegression, LassoCV, Lasso
@@ -112,6 +112,68 @@ class TestOrthoLearner(unittest.TestCase):
                                                           folds,
                                                           X, y, W=y, Z=None)
 
+    def test_crossfit_parallel(self):
+
+        class Wrapper:
+
+            def __init__(self, model):
+                self._model = model
+
+            def fit(self, X, y, W=None):
+                self._model.fit(X, y)
+                return self
+
+            def predict(self, X, y, W=None):
+                return self._model.predict(X), y - self._model.predict(X)
+
+        np.random.seed(123)
+        X = np.random.normal(size=(5000, 3))
+        y = X[:, 0] + np.random.normal(size=(5000,))
+        # the last fold only tests a subset of the data, so that the missing rows stay NaN
+        folds = list(KFold(3).split(X, y))[:2] + [(np.arange(1000), np.arange(4000, 4500))]
+        model = Lasso(alpha=0.01)
+        nuisance, model_list, fitted_inds = _crossfit(Wrapper(model), folds, X, y, W=y)
+        for backend in ['loky', 'threading']:
+            par_nuisance, par_model_list, par_fitted_inds = _crossfit(Wrapper(model), folds, X, y, W=y,
+                                                                      n_jobs=2, backend=backend)
+            for nuis, par_nuis in zip(nuisance, par_nuisance):
+                np.testing.assert_array_equal(nuis, par_nuis)
+            for mdl, par_mdl in zip(model_list, par_model_list):
+                np.testing.assert_array_equal(mdl._model.coef_, par_mdl._model.coef_)
+            np.testing.assert_array_equal(fitted_inds, par_fitted_inds)
+        assert np.all(np.isnan(nuisance[0][4500:]))
+
+        with pytest.raises(AttributeError) as e_info:
+            _crossfit(Wrapper(model), [(np.arange(100), np.arange(100))], X, y, n_jobs=2)
+
+    def test_repeated_crossfit(self):
+
+        class Wrapper:
+
+            def __init__(self, model):
+                self._model = model
+
+            def fit(self, X, y, W=None):
+                self._model.fit(X, y)
+                return self
+
+            def predict(self, X, y, W=None):
+                return y - self._model.predict(X)
+
+        np.random.seed(123)
+        X = np.random.normal(size=(1000, 3))
+        y = X[:, 0] + np.random.normal(size=(1000,))
+        fold_repeats = [list(KFold(2, shuffle=True, random_state=seed).split(X, y)) for seed in range(3)]
+        model = Lasso(alpha=0.01)
+        for n_jobs in [1, 2]:
+            repeats = _repeated_crossfit(Wrapper(model), fold_repeats, X, y, W=y, n_jobs=n_jobs)
+            assert len(repeats) == 3
+            for folds, (nuisance, model_list, fitted_inds) in zip(fold_repeats, repeats):
+                expected_nuisance, _, expected_fitted_inds = _crossfit(Wrapper(model), folds, X, y, W=y)
+                np.testing.assert_array_equal(nuisance[0], expected_nuisance[0])
+                np.testing.assert_array_equal(fitted_inds, expected_fitted_inds)
+                assert len(model_list) == 2
+
     def test_ol(self):
 
         class ModelNuisance:
@@ -8,11 +8,49 @@ import random
 import numpy as np
 import sparse as sp
 import pytest
-from econml.utilities import einsum_sparse, todense, tocoo, transpose
+from sklearn.linear_model import Ridge
+from econml.utilities import (einsum_sparse, todense, tocoo, transpose, cross_product, WeightedLasso,
+                              CrossProductOperator, LinearOperatorRidge, LinearOperatorLasso)
 
 
 class TestUtilities(unittest.TestCase):
 
+    def test_cross_product_operator(self):
+        np.random.seed(123)
+        X1 = np.random.normal(size=(50, 3))
+        X2 = np.random.normal(size=(50, 4))
+        dense = cross_product(X1, X2)
+        op = CrossProductOperator(X1, X2)
+        self.assertEqual(op.shape, dense.shape)
+        np.testing.assert_allclose(op.toarray(), dense)
+        v = np.random.normal(size=(12,))
+        np.testing.assert_allclose(op @ v, dense @ v)
+        M = np.random.normal(size=(12, 2))
+        np.testing.assert_allclose(op @ M, dense @ M)
+        u = np.random.normal(size=(50,))
+        np.testing.assert_allclose(op.T @ u, dense.T @ u)
+        np.testing.assert_allclose(op[[1, 4, 7]].toarray(), dense[[1, 4, 7]])
+
+    def test_linear_operator_regression(self):
+        np.random.seed(123)
+        X1 = np.random.normal(size=(200, 3))
+        X2 = np.hstack([np.ones((200, 1)), np.random.normal(size=(200, 3))])
+        dense = cross_product(X1, X2)
+        coefs = np.random.normal(size=(12, 2)) * (np.random.uniform(size=(12, 1)) > .5)
+        y = dense @ coefs + np.random.normal(size=(200, 2))
+        sample_weight = np.random.uniform(1, 2, size=(200,))
+        for ours, theirs, tol in [(LinearOperatorRidge(alpha=3, tol=1e-12), Ridge(alpha=3), 1e-6),
+                                  (LinearOperatorLasso(alpha=.05, tol=1e-10, max_iter=10000),
+                                   WeightedLasso(alpha=.05, tol=1e-10, max_iter=10000), 1e-4)]:
+            for target in [y, y[:, 0]]:
+                with self.subTest(model=ours, target_dims=target.ndim):
+                    ours.fit(CrossProductOperator(X1, X2), target, sample_weight=sample_weight)
+                    theirs.fit(dense, target, sample_weight=sample_weight)
+                    np.testing.assert_allclose(ours.coef_, theirs.coef_, atol=tol)
+                    np.testing.assert_allclose(ours.intercept_, theirs.intercept_, atol=tol)
+                    np.testing.assert_allclose(ours.predict(CrossProductOperator(X1, X2)), theirs.predict(dense),
+                                               atol=10 * tol)
+
     def test_einsum_errors(self):
         # number of inputs in specification must match number of inputs
         with self.assertRaises(Exception):
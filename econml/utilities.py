@@ -4,12 +4,21 @@
 """Utility methods."""
 
 import numpy as np
+import os
+import shutil
+import tempfile
+import joblib
 import scipy.sparse
 import sparse as sp
 import itertools
+import threading
+import time
+from contextlib import contextmanager
 from operator import getitem
-from collections import defaultdict, Counter
-from sklearn.base import TransformerMixin
+from collections import defaultdict, Counter, OrderedDict
+from sklearn.base import TransformerMixin, BaseEstimator, RegressorMixin
+from sklearn.exceptions import ConvergenceWarning
+from scipy.sparse.linalg import LinearOperator, aslinearoperator, lsqr
 from sklearn.linear_model import LassoCV, MultiTaskLassoCV, Lasso, MultiTaskLasso
 from functools import reduce
 from sklearn.utils import check_array, check_X_y
@@ -1808,3 +1817,328 @@ class LassoCVWrapper:
     def predict(self, X):
         predictions = self.model.predict(X)
         return reshape(predictions, (-1, 1)) if self.needs_unravel else predictions
+
+
+class PhaseProfile:
+    """
+    Accumulates the wall time, the number of calls and the number of rows processed by named phases.
+
+    Wrap every call of a phase in the `phase` context manager; profiles built in other threads or
+    processes can be combined with `merge`. Phases can be recorded concurrently by several threads.
+    When the profile is disabled nothing is recorded.
+
+    Parameters
+    ----------
+    enabled : bool, optional (default=True)
+        Whether to record the phases.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled, every copy gets its own
+        state = self.__dict__.copy()
+        state.pop('_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, n_rows=0):
+        """Time the enclosed block as one call of the phase `name` that processes `n_rows` rows."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, n_rows=n_rows)
+
+    def add(self, name, wall_time, n_calls=1, n_rows=0):
+        """Record `n_calls` calls of the phase `name`, taking `wall_time` seconds and processing `n_rows` rows."""
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._stats.setdefault(name, [0., 0, 0])
+            stats[0] += wall_time
+            stats[1] += n_calls
+            stats[2] += n_rows
+
+    def merge(self, other):
+        """Add the phases recorded by another profile to this one."""
+        for name, (wall_time, n_calls, n_rows) in list(other._stats.items()):
+            self.add(name, wall_time, n_calls=n_calls, n_rows=n_rows)
+
+    def reset(self):
+        """Forget all the recorded phases."""
+        self._stats = OrderedDict()
+
+    def report(self):
+        """
+        Summarize the recorded phases.
+
+        Returns
+        -------
+        report : OrderedDict
+            Maps the name of every phase, in the order they were first recorded, to a dictionary with
+            its total `'wall_time'` in seconds, its number of calls `'n_calls'` and the number of rows
+            it processed `'n_rows'`. Phases that ran in parallel workers report the sum of their times.
+        """
+        return OrderedDict((name, {'wall_time': wall_time, 'n_calls': n_calls, 'n_rows': n_rows})
+                           for name, (wall_time, n_calls, n_rows) in self._stats.items())
+
+
+class CrossProductOperator(LinearOperator):
+    """
+    Implicit representation of ``cross_product(X1, X2)`` as a :class:`~scipy.sparse.linalg.LinearOperator`.
+
+    The cross product of an n x d1 and an n x d2 matrix has d1*d2 columns, which for a few hundred
+    features in each factor is too large to store. This operator only stores the two factors and multiplies
+    with the cross product in O(n*d1*d2) time and O(n*(d1 + d2)) memory, with the same column order as
+    `cross_product`, i.e. column ``i + d1 * j`` is ``X1[:, i] * X2[:, j]``.
+
+    Parameters
+    ----------
+    X1 : n x d1 array
+        First matrix of n samples of d1 features (or an n-element vector)
+    X2 : n x d2 array
+        Second matrix of n samples of d2 features (or an n-element vector)
+    """
+
+    def __init__(self, X1, X2):
+        X1 = np.asarray(X1)
+        X2 = np.asarray(X2)
+        self.X1 = X1.reshape(-1, 1) if X1.ndim == 1 else X1
+        self.X2 = X2.reshape(-1, 1) if X2.ndim == 1 else X2
+        assert self.X1.shape[0] == self.X2.shape[0]
+        super().__init__(dtype=np.result_type(self.X1, self.X2),
+                         shape=(self.X1.shape[0], self.X1.shape[1] * self.X2.shape[1]))
+
+    def __getitem__(self, inds):
+        """Select a subset of the rows, e.g. the training samples of a crossfitting fold."""
+        return CrossProductOperator(self.X1[inds], self.X2[inds])
+
+    def _matmat(self, B):
+        (n, d1), d2 = self.X1.shape, self.X2.shape[1]
+        B = np.asarray(B).reshape(d2, d1, -1)
+        # (X1 @ B[j]) is the product of the columns that share the factor X2[:, j]
+        partial = np.matmul(self.X1, B.transpose(1, 0, 2).reshape(d1, -1)).reshape(n, d2, -1)
+        return np.einsum('tj,tjk->tk', self.X2, partial)
+
+    def _matvec(self, x):
+        return self._matmat(np.reshape(x, (-1, 1)))[:, 0]
+
+    def _rmatmat(self, R):
+        (n, d1), d2 = self.X1.shape, self.X2.shape[1]
+        R = np.asarray(R).reshape(n, -1)
+        k = R.shape[1]
+        weighted = (self.X2[:, :, np.newaxis] * R[:, np.newaxis, :]).reshape(n, d2 * k)
+        return np.matmul(self.X1.T, weighted).reshape(d1, d2, k).transpose(1, 0, 2).reshape(d1 * d2, k)
+
+    def _rmatvec(self, r):
+        return self._rmatmat(np.reshape(r, (-1, 1)))[:, 0]
+
+    def toarray(self):
+        """Materialize the cross product as a dense array."""
+        return cross_product(self.X1, self.X2)
+
+
+class _LinearOperatorRegression(BaseEstimator, RegressorMixin):
+    # Base class of the linear regressions that only access their design through products with it,
+    # so that it can be any linear operator, such as a `CrossProductOperator`, besides a dense or sparse matrix
+
+    def __init__(self, alpha=1.0, fit_intercept=True, max_iter=1000, tol=1e-4):
+        self.alpha = alpha
+        self.fit_intercept = fit_intercept
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def fit(self, X, y, sample_weight=None):
+        """
+        Fit the model.
+
+        Parameters
+        ----------
+        X : (n, d) array, sparse matrix or :class:`~scipy.sparse.linalg.LinearOperator`
+            The design
+        y : (n,) or (n, k) array
+            The target(s)
+        sample_weight : (n,) array, optional
+            Individual weights for each sample
+
+        Returns
+        -------
+        self
+        """
+        op = aslinearoperator(X)
+        n, d = op.shape
+        y = np.asarray(y, dtype=float)
+        Y = y.reshape(n, -1)
+        w = np.ones(n) if sample_weight is None else np.asarray(sample_weight, dtype=float)
+        sqrt_w = np.sqrt(w)
+        if self.fit_intercept:
+            x_mean = op.rmatvec(w) / w.sum()
+            y_mean = w @ Y / w.sum()
+        else:
+            x_mean = np.zeros(d)
+            y_mean = np.zeros(Y.shape[1])
+
+        # the centered design, with its rows scaled by the square root of the weights
+        def matvec(b):
+            return sqrt_w * (op.matvec(b) - x_mean @ b)
+
+        def rmatvec(r):
+            r = sqrt_w * np.ravel(r)
+            return op.rmatvec(r) - x_mean * r.sum()
+        design = LinearOperator((n, d), matvec=matvec, rmatvec=rmatvec, dtype=float)
+        coef = np.column_stack([self._solve(design, sqrt_w * (Y[:, i] - y_mean[i]), w.sum())
+                                for i in range(Y.shape[1])]).T
+        intercept = y_mean - coef @ x_mean
+        self.coef_ = coef[0] if y.ndim == 1 else coef
+        self.intercept_ = intercept[0] if y.ndim == 1 else intercept
+        return self
+
+    def predict(self, X):
+        """
+        Predict using the linear model.
+
+        Parameters
+        ----------
+        X : (m, d) array, sparse matrix or :class:`~scipy.sparse.linalg.LinearOperator`
+            The design
+
+        Returns
+        -------
+        prediction : (m,) or (m, k) array
+        """
+        op = aslinearoperator(X)
+        if np.ndim(self.coef_) == 1:
+            return op.matvec(self.coef_) + self.intercept_
+        return op.matmat(self.coef_.T) + self.intercept_
+
+
+class LinearOperatorRidge(_LinearOperatorRegression):
+    """
+    Ridge regression whose design can be a :class:`~scipy.sparse.linalg.LinearOperator`.
+
+    Minimizes the same objective as :class:`~sklearn.linear_model.Ridge`,
+    ``||y - Xw||^2_2 + alpha * ||w||^2_2``, with LSQR, which only multiplies with the design and its
+    transpose. Combined with a :class:`CrossProductOperator` it can fit linear models on interaction
+    designs that do not fit in memory.
+
+    Parameters
+    ----------
+    alpha : float, optional (default=1.0)
+        Regularization strength
+    fit_intercept : bool, optional (default=True)
+        Whether to fit an intercept
+    max_iter : int, optional (default=1000)
+        Maximum number of LSQR iterations per target
+    tol : float, optional (default=1e-4)
+        Tolerance of LSQR
+
+    Attributes
+    ----------
+    coef_ : array, shape (n_features,) | (n_targets, n_features)
+        The coefficients
+    intercept_ : float | array, shape (n_targets,)
+        The intercept
+    """
+
+    def _solve(self, design, target, weight_sum):
+        return lsqr(design, target, damp=np.sqrt(self.alpha), atol=self.tol, btol=self.tol,
+                    iter_lim=self.max_iter)[0]
+
+
+class LinearOperatorLasso(_LinearOperatorRegression):
+    """
+    Lasso regression whose design can be a :class:`~scipy.sparse.linalg.LinearOperator`.
+
+    Minimizes the same objective as :class:`~sklearn.linear_model.Lasso` (and :class:`WeightedLasso`),
+    ``(1 / (2 * n_samples)) * ||y - Xw||^2_2 + alpha * ||w||_1``, with accelerated proximal gradient
+    descent (FISTA), which only multiplies with the design and its transpose. Combined with a
+    :class:`CrossProductOperator` it can fit linear models on interaction designs that do not fit in memory.
+
+    Parameters
+    ----------
+    alpha : float, optional (default=1.0)
+        Constant that multiplies the L1 term
+    fit_intercept : bool, optional (default=True)
+        Whether to fit an intercept
+    max_iter : int, optional (default=1000)
+        Maximum number of iterations per target
+    tol : float, optional (default=1e-4)
+        The optimization stops when the largest coefficient update is smaller than `tol` times
+        the largest coefficient
+
+    Attributes
+    ----------
+    coef_ : array, shape (n_features,) | (n_targets, n_features)
+        The coefficients
+    intercept_ : float | array, shape (n_targets,)
+        The intercept
+    """
+
+    def _solve(self, design, target, weight_sum):
+        d = design.shape[1]
+        # Lipschitz constant of the gradient, from a few power iterations (with some slack, since they
+        # approach the largest eigenvalue of the Gram matrix from below)
+        v = np.random.RandomState(0).normal(size=d)
+        lipschitz = 0
+        for _ in range(30):
+            v = design.rmatvec(design.matvec(v))
+            lipschitz = np.linalg.norm(v)
+            if lipschitz == 0:
+                return np.zeros(d)
+            v /= lipschitz
+        step = weight_sum / (1.1 * lipschitz)
+
+        coef = np.zeros(d)
+        momentum = coef
+        t = 1
+        for _ in range(self.max_iter):
+            gradient = design.rmatvec(design.matvec(momentum) - target) / weight_sum
+            new_coef = momentum - step * gradient
+            new_coef = np.sign(new_coef) * np.maximum(np.abs(new_coef) - step * self.alpha, 0)
+            new_t = (1 + np.sqrt(1 + 4 * t * t)) / 2
+            momentum = new_coef + ((t - 1) / new_t) * (new_coef - coef)
+            converged = np.max(np.abs(new_coef - coef)) <= self.tol * max(np.max(np.abs(new_coef)), 1e-12)
+            coef, t = new_coef, new_t
+            if converged:
+                break
+        else:
+            warnings.warn("LinearOperatorLasso did not converge; consider increasing max_iter.", ConvergenceWarning)
+        return coef
+
+
+@contextmanager
+def _shared_memmaps(*arrays):
+    # Dumps the arrays once to a temporary folder and reopens them as read-only memory maps.
+    # joblib then only sends the file names to the worker processes, instead of pickling
+    # (or hashing) the data again for every task.
+    temp_folder = tempfile.mkdtemp(prefix='econml_')
+    try:
+        memmaps = []
+        for i, arr in enumerate(arrays):
+            if arr is None:
+                memmaps.append(None)
+            else:
+                filename = os.path.join(temp_folder, 'array_{}.pkl'.format(i))
+                joblib.dump(arr, filename)
+                memmaps.append(joblib.load(filename, mmap_mode='r'))
+        yield memmaps
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+def _memmapping_parallel(n_jobs=None, backend='loky', **kwargs):
+    # Parallel for the process based paths. The data shared with _shared_memmaps is sent to the workers
+    # as file names, and any other argument larger than 1MB is automatically memory mapped read-only
+    # instead of being pickled again for every task.
+    return joblib.Parallel(n_jobs=n_jobs, backend=backend, max_nbytes='1M', mmap_mode='r', **kwargs)